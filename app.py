@@ -8,8 +8,14 @@ from flask import (
     url_for,
     session,
     render_template,
+    make_response,
+    jsonify,
+    g,
 )
 import os
+import time
+import atexit
+import threading
 import socket
 import logging
 import datetime
@@ -17,11 +23,26 @@ import coloredlogs
 from random import randrange
 from flask.helpers import send_from_directory
 from stravalib.client import Client
-from src.segment_crawler import SegmentsData, SegmentCrawler, retrieve_fastest_times
+from src.segment_crawler import SegmentsData, SegmentCrawler, retrieve_fastest_times, segment_bounds
 from src.regions import RegionsData
+from src.storage import open_store
+from src.details import DetailCache, DetailPipeline
+from src.crawl_state import CrawlState
+from src.quota import QuotaExhausted, QuotaScheduler, ScheduledClient
+from src.jobs import JobConflict, JobRunner
+from src.splitting import MedianSplitter
+from src.polyline import PolylineCache
+from src.columnar import columns_filename, load_columns
+from src.page_cache import VersionedCache, data_version, make_etag
+from src.metrics import REGISTRY
+from src.registry import DatasetRegistry
+from src.profiling import SamplingProfiler, profile_filename, profiled
 
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET")
+# Requests with ?profile=1, or an X-Profile header, are profiled when this is
+# set, writing flame graph stacks to PROFILE_DIR
+app.config["PROFILE_REQUESTS"] = bool(os.getenv("PROFILE_REQUESTS"))
 
 STRAVA_CLIENT_ID = os.getenv("STRAVA_ID")
 STRAVA_SECRET = os.getenv("STRAVA_SECRET")
@@ -38,17 +59,113 @@ coloredlogs.install(
 # with eveyr activity retrieved
 logging.getLogger("stravalib").setLevel(logging.ERROR)
 
+# Loaded segments and rendered pages, reused until the data files change
+CACHE = VersionedCache()
+
+
+# Details of every segment fetched from the API, shared by all locations
+DETAILS_CACHE_PATH = "data/segment_details.json"
+
+# Strava's quotas are per app, so all crawls share one scheduler
+QUOTA = QuotaScheduler()
+
+# Segment polylines simplified for each map zoom level
+POLYLINES = PolylineCache()
+
+# Crawls and leaderboard scraping run in the background, one job per location
+JOBS = JobRunner()
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    "segments_http_request_seconds", "Time taken to handle requests", ["endpoint"]
+)
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_time(response):
+    if "request_start" in g:
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - g.request_start, endpoint=request.endpoint or "unknown"
+        )
+    return response
+
+
+def profile_requested():
+    """Whether the current request asked to be profiled"""
+    if not app.config["PROFILE_REQUESTS"]:
+        return False
+    return bool(request.args.get("profile") or request.headers.get("X-Profile"))
+
+
+@app.before_request
+def start_profiler():
+    if profile_requested():
+        g.profiler = SamplingProfiler(threads=[threading.get_ident()]).start()
+
+
+@app.after_request
+def write_profile(response):
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.stop()
+        filename = profiler.write(profile_filename(f"request-{request.endpoint or 'unknown'}"))
+        LOGGER.info(f"Wrote profile of {request.path} to {filename}")
+        response.headers["X-Profile"] = filename
+    return response
+
+
+@app.teardown_request
+def stop_profiler(exception=None):
+    # Requests which raised skip write_profile
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.stop()
+
 
 def get_data_path(location="oxford", filetype="segments"):
     return f"data/{location}/{filetype}.json"
 
 
+def load_segments(segments_path):
+    """Segments for display, shared with other workers through the columns
+    snapshot (python -m src.columnar <location>) if it's up to date"""
+    snapshot = columns_filename(segments_path)
+    version, _ = data_version(segments_path)
+    data = None
+    if os.path.exists(snapshot) and os.stat(snapshot).st_mtime_ns >= max(
+        (mtime for _, mtime, _ in version), default=0
+    ):
+        data = load_columns(snapshot)
+    return SegmentsData(segments_path, store=open_store(segments_path, bounds=segment_bounds), data=data)
+
+
+def load_regions(regions_path):
+    return RegionsData(regions_path, store=open_store(regions_path))
+
+
+# Each location's data, loaded once and shared by requests and jobs
+DATASETS = DatasetRegistry(
+    lambda location, filetype: get_data_path(location, filetype),
+    load_segments,
+    load_regions,
+)
+# Saves are written a couple of seconds later, so write any left on exit
+atexit.register(DATASETS.flush)
+
+
 def get_default_bounds(location):
     """Get first bounds from db for region"""
     bounds = None
-    regions = RegionsData(get_data_path(location, filetype="regions"))
-    if regions.data:
-        bounds = regions.data[0]["bounds"]
+    with DATASETS.open(location) as dataset:
+        regions = dataset.regions
+        with regions.lock.read():
+            if regions.data:
+                # A copy, as the caller may move it
+                bounds = [list(corner) for corner in regions.data[0]["bounds"]]
     if not bounds:
         raise Exception(f"No bounds found for {location}")
     return bounds
@@ -67,22 +184,121 @@ def index():
     if not location:
         location = "oxford"
 
-    segments = SegmentsData(get_data_path(location=location))
-    return render_template(
-        "index.html",
-        authorize_url=authorize_url,
-        segments=segments.display_segments(),
-        location=location,
-    )
+    _, last_modified = data_version(get_data_path(location=location))
+    with DATASETS.open(location) as dataset:
+        version = dataset.version
+        etag = make_etag(location, version, authorize_url)
+
+        if request.if_none_match.contains(etag):
+            response = make_response("", 304)
+        else:
+            page = CACHE.get(
+                ("index", location, authorize_url),
+                version,
+                lambda: render_template(
+                    "index.html",
+                    authorize_url=authorize_url,
+                    segments=dataset.segments.display_segments(),
+                    location=location,
+                ),
+            )
+            response = make_response(page)
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # The page depends on the session, so only the browser may cache it
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response.make_conditional(request)
+
+
+
+
+# Query parameters of /api/<location>/segments, and the fields they filter on
+SEGMENT_FILTERS = {
+    "distance": "distance",
+    "grade": "avg_grade",
+    "pace": "fastest_pace",
+}
+MAX_PER_PAGE = 500
+
+
+def parse_bbox(text):
+    """Bounds from "lat,lng,lat,lng" (bottom left then top right)"""
+    values = [float(value) for value in text.split(",")]
+    if len(values) != 4:
+        raise ValueError(f"Expected 4 coordinates in bbox, got {len(values)}")
+    return [(values[0], values[1]), (values[2], values[3])]
+
 
+def json_safe(segment):
+    """Segment with NaN (e.g. the pace of an unretrieved time) as null"""
+    return {
+        key: None if isinstance(value, float) and value != value else value
+        for key, value in segment.items()
+    }
 
 
+@app.route("/api/<string:location>/segments", methods=["GET"])
+def api_segments(location):
+    """Segments intersecting a viewport, as JSON
+    e.g.
+    /api/oxford/segments?bbox=51.74,-1.28,51.77,-1.22&min_distance=1000&max_pace=3.5&page=2
+
+    Filters are min_/max_ distance (m), grade (%) and pace (min/km). Results
+    are in pages of per_page segments, fastest pace first. With zoom, the
+    map zoom level, polylines are simplified to the detail visible at it.
+    """
+    try:
+        bbox = request.args.get("bbox")
+        bounds = parse_bbox(bbox) if bbox else None
+        filters = {}
+        for name, field in SEGMENT_FILTERS.items():
+            low = request.args.get(f"min_{name}", type=float)
+            high = request.args.get(f"max_{name}", type=float)
+            if low is not None or high is not None:
+                filters[field] = (low, high)
+        zoom = request.args.get("zoom", type=int)
+        page = int(request.args.get("page", 1))
+        per_page = min(int(request.args.get("per_page", 100)), MAX_PER_PAGE)
+        if page < 1 or per_page < 1:
+            raise ValueError("page and per_page must be positive")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    _, last_modified = data_version(get_data_path(location=location))
+    with DATASETS.open(location) as dataset:
+        etag = make_etag("api", location, dataset.version, request.query_string.decode())
+        if request.if_none_match.contains(etag):
+            response = make_response("", 304)
+        else:
+            total, page_segments = dataset.segments.query(
+                bounds, filters, offset=(page - 1) * per_page, limit=per_page
+            )
+            if zoom is not None:
+                page_segments = POLYLINES.simplify_segments(page_segments, zoom)
+            response = jsonify(
+                {
+                    "total": total,
+                    "page": page,
+                    "per_page": per_page,
+                    "segments": [json_safe(segment) for segment in page_segments],
+                }
+            )
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
 
 @app.route("/retrieve/<string:location>", methods=["GET"])
 def retrieve(location="oxford"):
-    """Home page
+    """Start crawling a location, and retrieving fastest times, in the background
     e.g.
     /retrieve/oxford?offset=0.02
+
+    Responds with the job, whose progress can be followed at /jobs/<id>.
+    With ?profile=1 the job is profiled, as well as the request.
     """
     client, authorize_url = get_client_or_authorize_url()
 
@@ -95,7 +311,7 @@ def retrieve(location="oxford"):
     else:
         bounds = get_default_bounds(location)
 
-    offset = float(request.args.get('offset'))
+    offset = float(request.args.get('offset', 0))
     if offset:
         for bound in bounds:
             bound[0] += randrange(-1, 2, 1)*offset
@@ -103,27 +319,94 @@ def retrieve(location="oxford"):
 
     LOGGER.info("Base coords: %s", bounds)
 
-    segments = SegmentsData(get_data_path(location), client)
-    regions = RegionsData(get_data_path(location, filetype="regions"))
-    crawler = SegmentCrawler(client, segments, regions)
-
-    if authorize_url is None:
-        crawler.retrieve_segments_recursively(bounds)
-    segments.save()
-    regions.save()
+    # Crawling needs the API, but leaderboards can be scraped without it
+    crawl = authorize_url is None
+    kind = "retrieve" if crawl else "refresh"
 
-    retrieve_fastest_times(segments)
-    segments.save()
+    def func(job):
+        # Waiting for quota stops once the job is cancelled
+        run_retrieve(job, ScheduledClient(client, QUOTA, check=job.report), location, bounds, crawl)
 
-    return render_template(
-        "index.html",
-        authorize_url=authorize_url,
-        segments=segments.display_segments(),
-        location=location,
-    )
+    if profile_requested():
+        func = profiled(func, f"job-{kind}-{location}")
+    return submit_job(location, kind, func)
 
 
+def run_retrieve(job, client, location, bounds, crawl=True):
+    """Crawl a location for new segments, then retrieve their fastest times
 
+    The dataset is shared with requests, so the job's client is only given
+    to its own crawler, and its saves are flushed rather than the data closed.
+    """
+    with DATASETS.open(location) as dataset:
+        segments = dataset.segments
+        # New segments' details are fetched with this job's client
+        details = DetailPipeline(client, DetailCache(DETAILS_CACHE_PATH))
+        try:
+            if crawl:
+                regions = dataset.regions
+                crawler = SegmentCrawler(
+                    client,
+                    segments,
+                    regions,
+                    progress=job.report,
+                    splitter=MedianSplitter(segments),
+                    details=details,
+                )
+                # Resumes an earlier crawl of this location which was interrupted
+                state = CrawlState.load(get_data_path(location, filetype="crawl_state"))
+                try:
+                    crawler.retrieve_segments_frontier(bounds, state)
+                except QuotaExhausted as e:
+                    LOGGER.warning(f"Crawl of {location} paused: {e}")
+                finally:
+                    crawler.log_stats()
+                    regions.save()
+                segments.save()
+
+            retrieve_fastest_times(segments, progress=job.report, details=details)
+        finally:
+            details.close()
+            segments.save()
+            dataset.flush()
+
+
+def submit_job(location, kind, func):
+    """Run func in the background, unless location already has a job running"""
+    try:
+        job = JOBS.submit(location, kind, func)
+    except JobConflict as e:
+        return jsonify(e.job.to_dict()), 409
+    response = jsonify(job.to_dict())
+    response.status_code = 202
+    response.headers["Location"] = url_for("job_progress", job_id=job.id)
+    return response
+
+
+@app.route("/jobs/<string:job_id>", methods=["GET"])
+def job_progress(job_id):
+    """Status and progress of a background job"""
+    job = JOBS.get(job_id)
+    if job is None:
+        return jsonify({"error": f"No job {job_id}"}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route("/jobs/<string:job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    """Stop a background job at its next progress report"""
+    job = JOBS.cancel(job_id)
+    if job is None:
+        return jsonify({"error": f"No job {job_id}"}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Crawl and request metrics in the Prometheus text format"""
+    response = make_response(REGISTRY.render())
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
 
 
 # @app.route("/retrieve/<string:location>", methods=["GET"])
@@ -0,0 +1,70 @@
+""" Benchmark SegmentsData.display_segments against the original implementation
+
+python -m benchmarks.bench_display --segments 10000
+"""
+import argparse
+import json
+import os
+import re
+import tempfile
+from datetime import datetime, timedelta
+import matplotlib as mpl
+import matplotlib.cm as cm
+from src.segment_crawler import SegmentsData
+from benchmarks.support import best_time, synthetic_segments
+
+
+def legacy_display_segments(data):
+    """display_segments as originally written, for comparison"""
+    for segment in data:
+        segment["url"] = (
+            f"https://www.strava.com/segments/{segment['id']}" if "id" in segment else "#"
+        )
+        if "fastest_time" in segment:
+            if re.match(r"^\d+:\d+$", segment["fastest_time"]):
+                t = datetime.strptime(segment["fastest_time"], "%M:%S")
+            elif re.match(r"^\d+:\d+:\d+$", segment["fastest_time"]):
+                t = datetime.strptime(segment["fastest_time"], "%H:%M:%S")
+            elif re.match(r"^\d+s$", segment["fastest_time"]):
+                t = datetime.strptime(segment["fastest_time"][:-1], "%S")
+            else:
+                raise Exception("Unknown time format: %s" % segment["fastest_time"])
+            delta = timedelta(minutes=t.minute, seconds=t.second)
+            segment["fastest_pace"] = round(
+                (delta.total_seconds() / 60.0) / (segment["distance"] / 1000.0), 1
+            )
+        else:
+            segment["fastest_pace"] = float("NaN")
+        segment["climb"] = round(segment["climb"], 2)
+        norm = mpl.colors.Normalize(vmin=2.5, vmax=4.5)
+        m = cm.ScalarMappable(norm=norm, cmap=cm.viridis_r)
+        segment["colour"] = mpl.colors.to_hex(m.to_rgba(segment["fastest_pace"]))
+    data.sort(key=lambda x: x["fastest_pace"], reverse=True)
+    return data
+
+
+def main(count, repeat):
+    data = synthetic_segments(count)
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "segments.json")
+        with open(filename, "w") as f:
+            json.dump(data, f)
+        segments = SegmentsData(filename)
+
+        legacy = best_time(lambda: legacy_display_segments([dict(seg) for seg in data]), repeat)
+        cold = best_time(lambda: segments._compute_display("fastest_pace"), repeat)
+        segments.display_segments()
+        cached = best_time(segments.display_segments, repeat)
+
+    print(f"{count} segments, best of {repeat}")
+    print(f"  original:           {legacy * 1000:9.1f} ms")
+    print(f"  vectorised:         {cold * 1000:9.1f} ms ({legacy / cold:.0f}x)")
+    print(f"  vectorised, cached: {cached * 1000:9.1f} ms ({legacy / cached:.0f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark display_segments")
+    parser.add_argument("--segments", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    main(args.segments, args.repeat)
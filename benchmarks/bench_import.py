@@ -0,0 +1,48 @@
+""" Benchmark cold import time of the app's entry points
+
+Each module is imported in a fresh interpreter, so nothing is cached:
+python -m benchmarks.bench_import --repeat 5
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+MODULES = ["src.segment_crawler", "app"]
+
+# Modules that should only be imported when they are actually used
+HEAVY_MODULES = ["matplotlib", "numpy", "bs4"]
+
+
+def import_time(module):
+    """Seconds taken to import module in a new interpreter, and heavy modules loaded"""
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "elapsed = time.perf_counter() - start\n"
+        f"heavy = [m for m in {HEAVY_MODULES!r} if m in sys.modules]\n"
+        "print(elapsed, ','.join(heavy))\n"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], check=True, stdout=subprocess.PIPE
+    ).stdout.decode().split()
+    return float(output[0]), output[1:]
+
+
+def main(repeat):
+    for module in MODULES:
+        results = [import_time(module) for _ in range(repeat)]
+        times = [elapsed for elapsed, _ in results]
+        heavy = results[0][1][0] if results[0][1] else "none"
+        print(
+            f"{module}: median {statistics.median(times) * 1000:.0f} ms, "
+            f"min {min(times) * 1000:.0f} ms, heavy modules loaded: {heavy}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark import times")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    main(args.repeat)
@@ -0,0 +1,64 @@
+""" Benchmark parsing the leader from a segment page
+
+Compares a full BeautifulSoup parse of the page with the streaming parser,
+which stops at the end of the leaderboard's first row:
+python -m benchmarks.bench_leaderboard --repeat 20
+"""
+import argparse
+import os
+import time
+import tracemalloc
+from src.leaderboard import LeaderboardParser, parse_leader
+
+EXAMPLE_PAGE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "tests",
+    "data",
+    "example_strava.html",
+)
+
+
+def stream_leader(page, chunk_size=16384):
+    """Parse as get_html_from_url would, returning the leader and bytes read"""
+    parser = LeaderboardParser()
+    read = 0
+    while not parser.done and read < len(page):
+        parser.feed(page[read:read + chunk_size])
+        read += chunk_size
+    return parser.leader, min(read, len(page))
+
+
+def measure(func, repeat):
+    """Best CPU time and peak traced memory of func"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.process_time()
+        func()
+        best = min(best, time.process_time() - start)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def main(repeat):
+    with open(EXAMPLE_PAGE, "r") as f:
+        page = f.read()
+
+    leader, read = stream_leader(page)
+    assert leader == parse_leader(page)
+
+    full_time, full_memory = measure(lambda: parse_leader(page), repeat)
+    stream_time, stream_memory = measure(lambda: stream_leader(page), repeat)
+
+    print(f"Page: {len(page)} characters, streaming stops after {read}")
+    print(f"  full parse: {full_time * 1000:7.2f} ms CPU, {full_memory / 1024:7.0f} KiB peak")
+    print(f"  streaming:  {stream_time * 1000:7.2f} ms CPU, {stream_memory / 1024:7.0f} KiB peak")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark leaderboard parsing")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    main(args.repeat)
@@ -0,0 +1,62 @@
+""" Benchmark memory use of segment records as dicts and as columns
+
+python -m benchmarks.bench_memory --segments 100000
+"""
+import argparse
+import gc
+import json
+import os
+import tempfile
+import tracemalloc
+from benchmarks.support import best_time, synthetic_segments
+from src.columnar import SegmentColumns, load_columns
+
+
+def traced(build):
+    """Result of build, and the memory it allocated"""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def main(count):
+    segments = synthetic_segments(count, polylines=True)
+    text = json.dumps(segments)
+    print(f"{count} segments, {len(text) / 2 ** 20:.1f} MiB as JSON")
+
+    records, records_size = traced(lambda: json.loads(text))
+    columns, columns_size = traced(lambda: SegmentColumns.from_records(records))
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "segments.json.columns")
+        columns.save(filename)
+        mapped, mapped_size = traced(lambda: load_columns(filename))
+
+        print(f"  list of dicts:   {records_size / 2 ** 20:7.1f} MiB")
+        print(
+            f"  columns:         {columns_size / 2 ** 20:7.1f} MiB "
+            f"({columns.nbytes() / 2 ** 20:.1f} MiB of arrays)"
+        )
+        print(
+            f"  memory-mapped:   {mapped_size / 2 ** 20:7.1f} MiB private, "
+            f"{os.path.getsize(filename) / 2 ** 20:.1f} MiB shared file"
+        )
+
+        dict_time = best_time(
+            lambda: [seg for seg in records if seg["distance"] > 1000]
+        )
+        column_time = best_time(lambda: (mapped.column("distance") > 1000).nonzero())
+        print(
+            f"  filter distance > 1000: dicts {dict_time * 1000:.1f} ms, "
+            f"columns {column_time * 1000:.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark segment memory use")
+    parser.add_argument("--segments", type=int, default=100000)
+    args = parser.parse_args()
+    main(args.segments)
@@ -0,0 +1,51 @@
+""" Benchmark polyline payload size and decode time by map zoom level
+
+Decoding with src.polyline.decode stands in for the browser's
+Polyline.encoded.js, which uses the same algorithm.
+
+python -m benchmarks.bench_polyline --location oxford
+"""
+import argparse
+import json
+import os
+import time
+from benchmarks.support import best_time
+from src.polyline import MAX_ZOOM, PolylineCache, decode, decode_many
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+
+def main(location, repeat):
+    with open(os.path.join(DATA_DIR, location, "segments.json"), "r") as f:
+        segments = [seg for seg in json.load(f) if seg.get("polyline")]
+    polylines = [seg["polyline"] for seg in segments]
+
+    python_time = best_time(lambda: [decode(polyline) for polyline in polylines], repeat)
+    numpy_time = best_time(lambda: decode_many(polylines), repeat)
+    print(f"{len(segments)} polylines from {location}")
+    print(f"  decode: {python_time * 1000:.1f} ms, NumPy batch {numpy_time * 1000:.1f} ms")
+
+    cache = PolylineCache()
+    start = time.perf_counter()
+    cache.simplify_segments(segments, 0)
+    print(f"  simplifying for all zoom levels: {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    for zoom in (10, 12, 14, 16, MAX_ZOOM):
+        simplified = [seg["polyline"] for seg in cache.simplify_segments(segments, zoom)]
+        size = len(json.dumps(simplified))
+        points = sum(len(decode(polyline)) for polyline in simplified)
+        decode_time = best_time(
+            lambda: [decode(polyline) for polyline in simplified], repeat
+        )
+        print(
+            f"  zoom {zoom:2d}: {size / 1024:6.1f} KiB, {points:6d} points, "
+            f"decode {decode_time * 1000:5.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark polyline simplification")
+    parser.add_argument("--location", type=str, default="oxford")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    main(args.location, args.repeat)
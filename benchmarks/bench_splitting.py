@@ -0,0 +1,80 @@
+""" Benchmark region splitting strategies by explore_segments calls
+
+Crawls the Oxford bounds with a fake client which returns, like Strava, at
+most 10 of the known Oxford segments starting in the requested box (the most
+popular first). Each strategy is run cold, with no segments known, and warm,
+re-crawling with the Oxford segments already known.
+
+python -m benchmarks.bench_splitting --max-zoom 5
+"""
+import argparse
+import json
+import os
+import tempfile
+from src.details import DetailPipeline
+from src.regions import RegionsData
+from src.segment_crawler import SegmentCrawler, SegmentsData
+from src.splitting import MedianSplitter
+from benchmarks.support import FakeClient
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+STRATEGIES = {
+    "quadtree": lambda segments: None,
+    "median": MedianSplitter,
+}
+
+
+def crawl(strategy, segments, bounds, known, max_zoom, directory):
+    client = FakeClient(segments)
+    segments_file = os.path.join(directory, f"segments_{strategy}.json")
+    regions_file = os.path.join(directory, f"regions_{strategy}.json")
+    with open(segments_file, "w") as f:
+        json.dump(known, f)
+    with open(regions_file, "w") as f:
+        json.dump([], f)
+
+    segments_db = SegmentsData(
+        segments_file, client, details=DetailPipeline(client, workers=1)
+    )
+    regions_db = RegionsData(regions_file)
+    crawler = SegmentCrawler(
+        client,
+        segments_db,
+        regions_db,
+        max_zoom=max_zoom,
+        workers=1,
+        splitter=STRATEGIES[strategy](segments_db),
+    )
+    explored = crawler.retrieve_segments_frontier(bounds)
+    segments_db.details.close()
+    return client.explore_calls, len(client.found), explored
+
+
+def main(max_zoom):
+    with open(os.path.join(DATA_DIR, "oxford", "segments.json"), "r") as f:
+        segments = [
+            seg for seg in json.load(f) if seg.get("start_latlng") and seg.get("end_latlng")
+        ]
+    with open(os.path.join(DATA_DIR, "oxford", "regions.json"), "r") as f:
+        bounds = json.load(f)[0]["bounds"]
+
+    print(f"{len(segments)} Oxford segments, max zoom {max_zoom}")
+    with tempfile.TemporaryDirectory() as directory:
+        for start, known in [("cold", []), ("warm", segments)]:
+            for strategy in STRATEGIES:
+                calls, found, explored = crawl(
+                    strategy, segments, bounds, known, max_zoom, directory
+                )
+                print(
+                    f"  {start} {strategy:>8}: {calls:5d} calls, {found:4d} segments found, "
+                    f"{calls / max(found, 1):.2f} calls per segment, "
+                    f"{'fully' if explored else 'not fully'} explored"
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark region splitting")
+    parser.add_argument("--max-zoom", type=int, default=5)
+    args = parser.parse_args()
+    main(args.max_zoom)
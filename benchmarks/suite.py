@@ -0,0 +1,324 @@
+""" Benchmark suite for the crawler, storage and display paths
+
+Runs every benchmark on synthetic data of each size and writes the results
+as JSON, to compare between commits:
+
+python -m benchmarks.suite --sizes 1000,10000,100000 --output before.json
+python -m benchmarks.suite --sizes 1000,10000,100000 --output after.json
+python -m benchmarks.suite --compare before.json after.json
+
+Comparing exits with status 1 if any benchmark got slower by more than
+--threshold. Some benchmarks are skipped above their max_size unless
+--all-sizes is given, as they take minutes at 1M segments.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from benchmarks.support import AREA, FakeClient, synthetic_regions, synthetic_segments
+from src.details import DetailPipeline
+from src.leaderboard import LeaderboardParser, parse_leader
+from src.regions import RegionsData
+from src.segment_crawler import SegmentCrawler, SegmentsData
+from src.storage import JournalStore
+
+EXAMPLE_PAGE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "tests",
+    "data",
+    "example_strava.html",
+)
+
+BENCHMARKS = []
+
+
+def benchmark(name, max_size=None, sized=True):
+    """Register func(size, directory, options) as a benchmark
+
+    func returns a (setup, run) pair: setup() is untimed and its result is
+    passed to the timed run(), which may return a dict of extra metrics.
+    """
+
+    def register(func):
+        BENCHMARKS.append(
+            {"name": name, "func": func, "max_size": max_size, "sized": sized}
+        )
+        return func
+
+    return register
+
+
+def write_json(filename, data):
+    with open(filename, "w") as f:
+        json.dump(data, f)
+    return filename
+
+
+@benchmark("segments.save_segments", max_size=100000)
+def bench_save_segments(size, directory, options):
+    """Fetch details of, and add, size new segments through the pipeline"""
+    client = FakeClient(synthetic_segments(size))
+    ids = list(client.by_id)
+
+    def setup():
+        filename = write_json(os.path.join(directory, "segments.json"), [])
+        return SegmentsData(filename, client, details=DetailPipeline(client))
+
+    def run(segments):
+        segments.save_segment_ids(ids)
+        segments.details.close()
+
+    return setup, run
+
+
+@benchmark("segments.save")
+def bench_save(size, directory, options):
+    """Write every segment as a JSON snapshot"""
+    filename = write_json(os.path.join(directory, "segments.json"), synthetic_segments(size))
+    segments = SegmentsData(filename)
+    return (lambda: segments), (lambda segments: segments.save())
+
+
+@benchmark("segments.save_journal")
+def bench_save_journal(size, directory, options):
+    """Append 100 changed segments to the journal"""
+    filename = write_json(os.path.join(directory, "segments.json"), synthetic_segments(size))
+
+    def setup():
+        for path in (filename + ".journal", filename + ".journal.compacting"):
+            if os.path.exists(path):
+                os.remove(path)
+        segments = SegmentsData(filename, store=JournalStore(filename))
+        for segment in segments.data[:100]:
+            segment["fastest_time"] = "1:00"
+            segments.touch(segment)
+        return segments
+
+    def run(segments):
+        segments.save()
+        segments.store.close(segments.data)
+
+    return setup, run
+
+
+@benchmark("segments.load")
+def bench_load(size, directory, options):
+    """Load segments from a JSON snapshot"""
+    filename = write_json(os.path.join(directory, "segments.json"), synthetic_segments(size))
+    return (lambda: None), (lambda _: SegmentsData(filename))
+
+
+@benchmark("segments.display_segments")
+def bench_display(size, directory, options):
+    """Compute pace, colour and order of every segment, uncached"""
+    filename = write_json(os.path.join(directory, "segments.json"), synthetic_segments(size))
+    segments = SegmentsData(filename)
+    return (lambda: segments), (lambda segments: segments._compute_display("fastest_pace"))
+
+
+@benchmark("regions.load")
+def bench_regions_load(size, directory, options):
+    """Load and index regions"""
+    filename = write_json(os.path.join(directory, "regions.json"), synthetic_regions(size))
+    return (lambda: None), (lambda _: RegionsData(filename))
+
+
+@benchmark("regions.get_region")
+def bench_get_region(size, directory, options):
+    """Look up 10000 regions by bounds"""
+    regions_list = synthetic_regions(size)
+    filename = write_json(os.path.join(directory, "regions.json"), regions_list)
+    regions = RegionsData(filename)
+    rng = random.Random(0)
+    lookups = [rng.choice(regions_list)["bounds"] for _ in range(10000)]
+
+    def run(regions):
+        for bounds in lookups:
+            regions.get_region(bounds)
+
+    return (lambda: regions), run
+
+
+@benchmark("crawl.split_box", max_size=100000)
+def bench_crawl(size, directory, options):
+    """Recursive quadtree crawl of size segments with a fake client"""
+    area = AREA
+    if options.density:
+        # Scale the area so there are density segments per square degree
+        (lat_min, lng_min), _ = AREA
+        side = math.sqrt(size / options.density)
+        area = [(lat_min, lng_min), (lat_min + side, lng_min + side)]
+    all_segments = synthetic_segments(size, area=area, clusters=options.clusters)
+    # Deep enough to split the densest cluster into boxes of under 10
+    max_zoom = max(5, int(math.log(max(size, 1), 4)) + 4)
+
+    def setup():
+        client = FakeClient(all_segments)
+        segments = SegmentsData(
+            write_json(os.path.join(directory, "segments.json"), []),
+            client,
+            details=DetailPipeline(client),
+        )
+        regions = RegionsData(write_json(os.path.join(directory, "regions.json"), []))
+        # Saving is measured separately, so don't write files at every step
+        segments.save = regions.save = lambda: None
+        crawler = SegmentCrawler(client, segments, regions, max_zoom=max_zoom)
+        return client, crawler
+
+    def run(setup_result):
+        client, crawler = setup_result
+        crawler.retrieve_segments_recursively([list(corner) for corner in area])
+        crawler.segments_db.details.close()
+        return {"explore_calls": client.explore_calls, "segments_found": len(client.found)}
+
+    return setup, run
+
+
+@benchmark("leaderboard.stream", sized=False)
+def bench_leaderboard_stream(size, directory, options):
+    """Parse the leader from a segment page, stopping after the first row"""
+    with open(EXAMPLE_PAGE, "r") as f:
+        page = f.read()
+
+    def run(_):
+        parser = LeaderboardParser()
+        parser.feed(page)
+        return parser.leader
+
+    return (lambda: None), run
+
+
+@benchmark("leaderboard.full", sized=False)
+def bench_leaderboard_full(size, directory, options):
+    """Parse the leader from a whole segment page with BeautifulSoup"""
+    with open(EXAMPLE_PAGE, "r") as f:
+        page = f.read()
+    return (lambda: None), (lambda _: parse_leader(page))
+
+
+def run_benchmark(entry, size, repeat, options):
+    with tempfile.TemporaryDirectory() as directory:
+        setup, run = entry["func"](size, directory, options)
+        best = float("inf")
+        extra = None
+        for _ in range(repeat):
+            state = setup()
+            start = time.perf_counter()
+            result = run(state)
+            best = min(best, time.perf_counter() - start)
+            if isinstance(result, dict):
+                extra = result
+    return {"name": entry["name"], "size": size, "seconds": best, "repeat": repeat, "extra": extra}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(sizes, repeat, options):
+    results = []
+    for entry in BENCHMARKS:
+        if options.only and not any(name in entry["name"] for name in options.only):
+            continue
+        for size in sizes if entry["sized"] else [None]:
+            if entry["max_size"] and size > entry["max_size"] and not options.all_sizes:
+                print(f"{entry['name']:28s} {size:>9}  skipped (over {entry['max_size']})")
+                continue
+            result = run_benchmark(entry, size, repeat, options)
+            extra = " ".join(f"{k}={v}" for k, v in (result["extra"] or {}).items())
+            print(
+                f"{entry['name']:28s} {size if size else '':>9}  "
+                f"{result['seconds'] * 1000:10.2f} ms  {extra}"
+            )
+            results.append(result)
+    return {
+        "commit": git_commit(),
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "sizes": sizes,
+        "results": results,
+    }
+
+
+def compare(base, new, threshold):
+    """Print how each benchmark changed, returning those slower than threshold"""
+    base_times = {(r["name"], r["size"]): r["seconds"] for r in base["results"]}
+    regressions = []
+    print(f"{'benchmark':28s} {'size':>9}  {'before':>10}  {'after':>10}  change")
+    for result in new["results"]:
+        key = (result["name"], result["size"])
+        if key not in base_times:
+            continue
+        before, after = base_times[key], result["seconds"]
+        change = after / before - 1 if before else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  SLOWER"
+            regressions.append(key)
+        elif change < -threshold:
+            flag = "  faster"
+        print(
+            f"{key[0]:28s} {key[1] if key[1] else '':>9}  {before * 1000:8.2f}ms  "
+            f"{after * 1000:8.2f}ms  {change:+7.1%}{flag}"
+        )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the benchmark suite")
+    parser.add_argument("--sizes", type=str, default="1000,10000,100000",
+                        help="Comma separated numbers of segments/regions")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", type=str, help="Write results to this JSON file")
+    parser.add_argument("--only", type=str, action="append",
+                        help="Only run benchmarks whose name contains this")
+    parser.add_argument("--all-sizes", action="store_true",
+                        help="Run benchmarks at sizes above their max_size")
+    parser.add_argument("--clusters", type=int, default=20,
+                        help="Number of dense clusters of segments for the crawl")
+    parser.add_argument("--density", type=float, default=None,
+                        help="Segments per square degree for the crawl (default: fixed area)")
+    parser.add_argument("--compare", type=str, nargs=2, metavar=("BASE", "NEW"),
+                        help="Compare two result files instead of running")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Relative slowdown counted as a regression")
+    options = parser.parse_args(argv)
+
+    if options.compare:
+        with open(options.compare[0], "r") as f:
+            base = json.load(f)
+        with open(options.compare[1], "r") as f:
+            new = json.load(f)
+        regressions = compare(base, new, options.threshold)
+        return 1 if regressions else 0
+
+    # The crawler logs every step, which would swamp the timings
+    logging.disable(logging.INFO)
+    sizes = [int(size) for size in options.sizes.split(",")]
+    report = run_suite(sizes, options.repeat, options)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {options.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+""" Synthetic data, fake clients and timing shared by the benchmarks """
+import random
+import time
+from types import SimpleNamespace
+from src.polyline import encode
+from src.segment_crawler import split_box
+
+# Synthetic segments are spread over this box, roughly Oxford
+AREA = [(51.7, -1.35), (51.8, -1.15)]
+
+
+def best_time(func, repeat=3):
+    """Shortest wall clock time of repeat calls of func"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def synthetic_segments(count, seed=0, area=AREA, clusters=20, polylines=False):
+    """Segments with a realistic spread of distances, fastest times and places
+
+    Most segments start in a few dense clusters, as in towns, with the rest
+    scattered. With polylines each gets a route of 20-80 points.
+    """
+    rng = random.Random(seed)
+    (lat_min, lng_min), (lat_max, lng_max) = area
+    centres = [
+        (rng.uniform(lat_min, lat_max), rng.uniform(lng_min, lng_max))
+        for _ in range(clusters)
+    ]
+
+    def place():
+        if rng.random() < 0.7:
+            lat, lng = rng.choice(centres)
+            lat += rng.gauss(0, (lat_max - lat_min) / 50)
+            lng += rng.gauss(0, (lng_max - lng_min) / 50)
+        else:
+            lat, lng = rng.uniform(lat_min, lat_max), rng.uniform(lng_min, lng_max)
+        return [min(max(lat, lat_min), lat_max), min(max(lng, lng_min), lng_max)]
+
+    segments = []
+    for id in range(count):
+        distance = rng.uniform(100, 5000)
+        seconds = int(distance / 1000 * rng.uniform(150, 330))
+        if seconds < 60:
+            fastest_time = f"{seconds}s"
+        else:
+            fastest_time = f"{seconds // 60}:{seconds % 60:02d}"
+        start = place()
+        segment = {
+            "id": id,
+            "name": f"Segment {id}",
+            "distance": distance,
+            "avg_grade": rng.uniform(-5, 5),
+            "climb": rng.uniform(0, 50),
+            "effort_count": rng.randint(0, 10000),
+            "start_latlng": start,
+            "end_latlng": [start[0] + rng.uniform(-0.01, 0.01), start[1] + rng.uniform(-0.01, 0.01)],
+        }
+        if polylines:
+            lat, lng = start
+            points = []
+            for _ in range(rng.randint(20, 80)):
+                lat += rng.uniform(-0.0003, 0.0003)
+                lng += rng.uniform(-0.0003, 0.0003)
+                points.append((lat, lng))
+            segment["polyline"] = encode(points)
+        if rng.random() > 0.1:
+            segment["fastest_athlete"] = f"Athlete {rng.randint(0, 500)}"
+            segment["fastest_time"] = fastest_time
+        segments.append(segment)
+    return segments
+
+
+def synthetic_regions(count, seed=0, area=AREA):
+    """Regions from splitting area as a crawl would, about count of them"""
+    rng = random.Random(seed)
+    regions = [{"bounds": [list(corner) for corner in area], "explored": False}]
+    leaves = [area]
+    while len(regions) < count:
+        bounds = leaves.pop(rng.randrange(len(leaves)))
+        for box in split_box(bounds):
+            regions.append(
+                {"bounds": [list(corner) for corner in box], "explored": rng.random() < 0.7}
+            )
+            leaves.append(box)
+    return regions[:count]
+
+
+class FakeClient:
+    """explore_segments and get_segment over a fixed list of segments
+
+    Like Strava, explore_segments returns at most limit segments starting in
+    the box, the most popular first.
+    """
+
+    def __init__(self, segments, limit=10):
+        import numpy as np
+
+        # Sorted by latitude, so a box only has to look at a band of segments
+        order = sorted(range(len(segments)), key=lambda i: segments[i]["start_latlng"][0])
+        self.segments = [segments[i] for i in order]
+        self._order = np.array(order, dtype=np.int64)
+        self.by_id = {seg["id"]: seg for seg in segments}
+        self._lat = np.array([seg["start_latlng"][0] for seg in self.segments])
+        self._lng = np.array([seg["start_latlng"][1] for seg in self.segments])
+        self._popularity = np.array([-seg.get("effort_count", 0) for seg in self.segments])
+        self.limit = limit
+        self.explore_calls = 0
+        self.found = set()
+
+    def explore_segments(self, bounds, activity_type=None):
+        import numpy as np
+
+        self.explore_calls += 1
+        (lat_min, lng_min), (lat_max, lng_max) = bounds
+        low, high = np.searchsorted(self._lat, [lat_min, lat_max])
+        band = np.arange(low, high)
+        band = band[(self._lng[band] >= lng_min) & (self._lng[band] < lng_max)]
+        # Most popular first, ties in the original order
+        band = band[np.lexsort((self._order[band], self._popularity[band]))][: self.limit]
+        results = [SimpleNamespace(id=self.segments[i]["id"]) for i in band]
+        self.found.update(seg.id for seg in results)
+        return results
+
+    def get_segment(self, id):
+        seg = self.by_id[id]
+        return SimpleNamespace(
+            id=id,
+            name=seg["name"],
+            distance=seg["distance"],
+            average_grade=seg["avg_grade"],
+            total_elevation_gain=seg["climb"],
+            effort_count=seg["effort_count"],
+            start_latlng=seg["start_latlng"],
+            end_latlng=seg["end_latlng"],
+            map=SimpleNamespace(polyline=seg.get("polyline")),
+        )
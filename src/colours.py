@@ -0,0 +1,60 @@
+""" Colour scale for segment paces
+
+The table is matplotlib's viridis_r colormap (256 entries) as hex strings, so
+colours can be looked up without importing matplotlib.
+"""
+
+PACE_RANGE = (2.5, 4.5)
+
+MISSING_COLOUR = "#000000"
+
+VIRIDIS_R = [
+    "#fde725", "#fbe723", "#f8e621", "#f6e620", "#f4e61e", "#f1e51d", "#efe51c", "#ece51b",
+    "#eae51a", "#e7e419", "#e5e419", "#e2e418", "#dfe318", "#dde318", "#dae319", "#d8e219",
+    "#d5e21a", "#d2e21b", "#d0e11c", "#cde11d", "#cae11f", "#c8e020", "#c5e021", "#c2df23",
+    "#c0df25", "#bddf26", "#bade28", "#b8de29", "#b5de2b", "#b2dd2d", "#b0dd2f", "#addc30",
+    "#aadc32", "#a8db34", "#a5db36", "#a2da37", "#a0da39", "#9dd93b", "#9bd93c", "#98d83e",
+    "#95d840", "#93d741", "#90d743", "#8ed645", "#8bd646", "#89d548", "#86d549", "#84d44b",
+    "#81d34d", "#7fd34e", "#7cd250", "#7ad151", "#77d153", "#75d054", "#73d056", "#70cf57",
+    "#6ece58", "#6ccd5a", "#69cd5b", "#67cc5c", "#65cb5e", "#63cb5f", "#60ca60", "#5ec962",
+    "#5cc863", "#5ac864", "#58c765", "#56c667", "#54c568", "#52c569", "#50c46a", "#4ec36b",
+    "#4cc26c", "#4ac16d", "#48c16e", "#46c06f", "#44bf70", "#42be71", "#40bd72", "#3fbc73",
+    "#3dbc74", "#3bbb75", "#3aba76", "#38b977", "#37b878", "#35b779", "#34b679", "#32b67a",
+    "#31b57b", "#2fb47c", "#2eb37c", "#2db27d", "#2cb17e", "#2ab07f", "#29af7f", "#28ae80",
+    "#27ad81", "#26ad81", "#25ac82", "#25ab82", "#24aa83", "#23a983", "#22a884", "#22a785",
+    "#21a685", "#21a585", "#20a486", "#20a386", "#1fa287", "#1fa187", "#1fa188", "#1fa088",
+    "#1f9f88", "#1f9e89", "#1e9d89", "#1e9c89", "#1e9b8a", "#1f9a8a", "#1f998a", "#1f988b",
+    "#1f978b", "#1f968b", "#1f958b", "#1f948c", "#20938c", "#20928c", "#20928c", "#21918c",
+    "#21908d", "#218f8d", "#218e8d", "#228d8d", "#228c8d", "#228b8d", "#238a8d", "#23898e",
+    "#23888e", "#24878e", "#24868e", "#25858e", "#25848e", "#25838e", "#26828e", "#26828e",
+    "#26818e", "#27808e", "#277f8e", "#277e8e", "#287d8e", "#287c8e", "#297b8e", "#297a8e",
+    "#29798e", "#2a788e", "#2a778e", "#2a768e", "#2b758e", "#2b748e", "#2c738e", "#2c728e",
+    "#2c718e", "#2d718e", "#2d708e", "#2e6f8e", "#2e6e8e", "#2e6d8e", "#2f6c8e", "#2f6b8e",
+    "#306a8e", "#30698e", "#31688e", "#31678e", "#31668e", "#32658e", "#32648e", "#33638d",
+    "#33628d", "#34618d", "#34608d", "#355f8d", "#355e8d", "#365d8d", "#365c8d", "#375b8d",
+    "#375a8c", "#38598c", "#38588c", "#39568c", "#39558c", "#3a548c", "#3a538b", "#3b528b",
+    "#3b518b", "#3c508b", "#3c4f8a", "#3d4e8a", "#3d4d8a", "#3e4c8a", "#3e4a89", "#3e4989",
+    "#3f4889", "#3f4788", "#404688", "#404588", "#414487", "#414287", "#424186", "#424086",
+    "#423f85", "#433e85", "#433d84", "#443b84", "#443a83", "#443983", "#453882", "#453781",
+    "#453581", "#463480", "#46337f", "#46327e", "#46307e", "#472f7d", "#472e7c", "#472d7b",
+    "#472c7a", "#472a7a", "#482979", "#482878", "#482677", "#482576", "#482475", "#482374",
+    "#482173", "#482071", "#481f70", "#481d6f", "#481c6e", "#481b6d", "#481a6c", "#48186a",
+    "#481769", "#481668", "#481467", "#471365", "#471164", "#471063", "#470e61", "#470d60",
+    "#460b5e", "#460a5d", "#46085c", "#46075a", "#450559", "#450457", "#440256", "#440154",
+]
+
+
+def pace_colours(pace, vmin=PACE_RANGE[0], vmax=PACE_RANGE[1]):
+    """Hex colours for an array of paces, on the viridis_r scale between vmin and vmax
+
+    Matches matplotlib: the range is split into equal bins, values outside it
+    take the end colours, and NaN (no fastest time) is black.
+    """
+    import numpy as np
+
+    index = np.floor((pace - vmin) / (vmax - vmin) * len(VIRIDIS_R))
+    index = np.clip(np.nan_to_num(index), 0, len(VIRIDIS_R) - 1).astype(int)
+    return [
+        MISSING_COLOUR if missing else VIRIDIS_R[i]
+        for i, missing in zip(index.tolist(), np.isnan(pace).tolist())
+    ]
@@ -0,0 +1,340 @@
+""" Compact columnar storage of segment records
+
+SegmentColumns holds segments as NumPy arrays, one per field, with names and
+polylines packed into a single UTF-8 buffer addressed by offsets. Indexing it
+gives a SegmentRecord, a dict-like view of one segment, so code written for
+lists of dicts keeps working.
+
+Columns can be saved to a single file and memory-mapped read-only, so that
+several web workers share one copy of the data through the page cache:
+python -m src.columnar oxford
+"""
+import json
+import os
+import sys
+import logging
+from collections.abc import MutableMapping, Sequence
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+LOGGER.addHandler(handler)
+
+INT_FIELDS = ("id", "effort_count", "fastest_seconds")
+FLOAT_FIELDS = ("distance", "avg_grade", "climb")
+LATLNG_FIELDS = ("start_latlng", "end_latlng")
+STRING_FIELDS = ("name", "polyline", "fastest_athlete", "fastest_time")
+FIELDS = INT_FIELDS + FLOAT_FIELDS + LATLNG_FIELDS + STRING_FIELDS
+# Any other fields of a record, as JSON
+EXTRA = "_extra"
+
+# State of a field in a record
+MISSING, NULL, PRESENT = 0, 1, 2
+
+MAGIC = b"SEGCOLS1"
+ALIGNMENT = 64
+
+_DELETED = object()
+
+
+def _is_latlng(value):
+    return isinstance(value, (list, tuple)) and len(value) == 2
+
+
+class SegmentRecord(MutableMapping):
+    """Dict-like view of one segment in SegmentColumns
+
+    Changes are kept alongside the columns, so they work on read-only,
+    memory-mapped columns too.
+    """
+
+    __slots__ = ("_columns", "_index")
+
+    def __init__(self, columns, index):
+        self._columns = columns
+        self._index = index
+
+    def __getitem__(self, key):
+        value = self._columns._get(self._index, key)
+        if value is _DELETED:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._columns._set(self._index, key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._columns._set(self._index, key, _DELETED)
+
+    def __iter__(self):
+        return iter(self._columns._keys(self._index))
+
+    def __len__(self):
+        return len(self._columns._keys(self._index))
+
+    def __repr__(self):
+        return f"SegmentRecord({dict(self)!r})"
+
+
+class SegmentColumns(Sequence):
+    """Segment records stored as columns
+
+    columns maps array names to arrays, as made by from_records: for each
+    field <field>.state (MISSING, NULL or PRESENT) and either <field> (numeric
+    fields, latlngs as (n, 2)) or <field>.offsets and <field>.data (strings).
+    """
+
+    def __init__(self, count, columns):
+        self._count = count
+        self._columns = columns
+        self._changes = {}
+        self._changed_fields = set()
+        self._appended = []
+
+    @classmethod
+    def from_records(cls, records):
+        import numpy as np
+
+        records = list(records)
+        count = len(records)
+        columns = {}
+
+        def states(field, valid):
+            state = np.zeros(count, dtype=np.uint8)
+            for i, record in enumerate(records):
+                if field in record:
+                    value = record[field]
+                    state[i] = NULL if value is None or not valid(value) else PRESENT
+            return state
+
+        for field in INT_FIELDS + FLOAT_FIELDS:
+            dtype = np.int64 if field in INT_FIELDS else np.float64
+            state = states(field, lambda value: isinstance(value, (int, float)))
+            values = np.zeros(count, dtype=dtype)
+            for i in np.flatnonzero(state == PRESENT):
+                values[i] = records[i][field]
+            columns[field] = values
+            columns[f"{field}.state"] = state
+
+        for field in LATLNG_FIELDS:
+            state = states(field, _is_latlng)
+            values = np.zeros((count, 2), dtype=np.float64)
+            for i in np.flatnonzero(state == PRESENT):
+                values[i] = records[i][field]
+            columns[field] = values
+            columns[f"{field}.state"] = state
+
+        for field in STRING_FIELDS:
+            state = states(field, lambda value: isinstance(value, str))
+            strings = [
+                records[i][field] if state[i] == PRESENT else "" for i in range(count)
+            ]
+            cls._pack(columns, field, strings, state)
+
+        extras = [
+            {key: value for key, value in record.items() if key not in FIELDS}
+            for record in records
+        ]
+        state = np.array([PRESENT if extra else MISSING for extra in extras], dtype=np.uint8)
+        cls._pack(
+            columns, EXTRA, [json.dumps(extra) if extra else "" for extra in extras], state
+        )
+        return cls(count, columns)
+
+    @staticmethod
+    def _pack(columns, field, strings, state):
+        import numpy as np
+
+        encoded = [string.encode("utf8") for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(data) for data in encoded], out=offsets[1:])
+        columns[f"{field}.offsets"] = offsets
+        columns[f"{field}.data"] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        columns[f"{field}.state"] = state
+
+    def __len__(self):
+        return self._count + len(self._appended)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("segment index out of range")
+        if index >= self._count:
+            return self._appended[index - self._count]
+        return SegmentRecord(self, index)
+
+    def append(self, record):
+        """Add a record, kept as a dict until the columns are rebuilt"""
+        self._appended.append(record)
+
+    def to_records(self):
+        """All records as plain dicts, e.g. for JSON"""
+        return [dict(record) for record in self]
+
+    def column(self, field):
+        """Values of a numeric field (NaN where missing) for every record
+
+        Latlng fields give an (n, 2) array.
+        """
+        import numpy as np
+
+        if field not in INT_FIELDS + FLOAT_FIELDS + LATLNG_FIELDS:
+            raise KeyError(f"{field} is not a numeric field")
+        values = self._columns[field].astype(np.float64)
+        values[self._columns[f"{field}.state"] != PRESENT] = np.nan
+        if field in self._changed_fields or self._appended:
+            values = np.concatenate(
+                [values, np.full((len(self._appended),) + values.shape[1:], np.nan)]
+            )
+            changed = [
+                index for index, changes in self._changes.items() if field in changes
+            ]
+            for index in changed + list(range(self._count, len(self))):
+                value = self[index].get(field)
+                valid = _is_latlng(value) if field in LATLNG_FIELDS else (
+                    isinstance(value, (int, float))
+                )
+                values[index] = value if valid else np.nan
+        return values
+
+    def nbytes(self):
+        """Bytes used by the column arrays"""
+        return sum(array.nbytes for array in self._columns.values())
+
+    def save(self, filename):
+        """Write the columns to filename, to be loaded with load_columns"""
+        columns = self
+        if self._changes or self._appended:
+            columns = SegmentColumns.from_records(self.to_records())
+
+        header = {"count": columns._count, "arrays": {}}
+        offset = 0
+        for name, array in columns._columns.items():
+            header["arrays"][name] = {
+                "dtype": array.dtype.str,
+                "shape": list(array.shape),
+                "offset": offset,
+            }
+            offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+        header_bytes = json.dumps(header).encode("utf8")
+        start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+        tmp_filename = f"{filename}.tmp"
+        with open(tmp_filename, "wb") as f:
+            f.write(MAGIC)
+            f.write(len(header_bytes).to_bytes(8, "little"))
+            f.write(header_bytes)
+            for name, array in columns._columns.items():
+                f.seek(start + header["arrays"][name]["offset"])
+                f.write(array.tobytes())
+        os.replace(tmp_filename, filename)
+
+    def _get(self, index, key):
+        changes = self._changes.get(index)
+        if changes is not None and key in changes:
+            return changes[key]
+        if key not in FIELDS:
+            extra = self._extra(index)
+            if key not in extra:
+                raise KeyError(key)
+            return extra[key]
+
+        state = self._columns[f"{key}.state"][index]
+        if state == MISSING:
+            raise KeyError(key)
+        if state == NULL:
+            return None
+        if key in STRING_FIELDS:
+            return self._string(key, index)
+        if key in LATLNG_FIELDS:
+            return self._columns[key][index].tolist()
+        return self._columns[key][index].item()
+
+    def _set(self, index, key, value):
+        self._changes.setdefault(index, {})[key] = value
+        self._changed_fields.add(key)
+
+    def _keys(self, index):
+        keys = [
+            field
+            for field in FIELDS
+            if self._columns[f"{field}.state"][index] != MISSING
+        ]
+        keys.extend(self._extra(index))
+        for key, value in self._changes.get(index, {}).items():
+            if value is _DELETED:
+                if key in keys:
+                    keys.remove(key)
+            elif key not in keys:
+                keys.append(key)
+        return keys
+
+    def _string(self, field, index):
+        offsets = self._columns[f"{field}.offsets"]
+        data = self._columns[f"{field}.data"][offsets[index]:offsets[index + 1]]
+        return bytes(data).decode("utf8")
+
+    def _extra(self, index):
+        if self._columns[f"{EXTRA}.state"][index] == MISSING:
+            return {}
+        return json.loads(self._string(EXTRA, index))
+
+
+def load_columns(filename, mmap=True):
+    """Load columns saved with SegmentColumns.save
+
+    With mmap the arrays are read-only views of the file, so processes
+    loading the same file share its memory.
+    """
+    import numpy as np
+
+    with open(filename, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{filename} is not a segment columns file")
+        header_length = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_length).decode("utf8"))
+    start = -(-(len(MAGIC) + 8 + header_length) // ALIGNMENT) * ALIGNMENT
+
+    # A file with no array data can't be mapped
+    if mmap and os.path.getsize(filename) > start:
+        buffer = np.memmap(filename, dtype=np.uint8, mode="r")
+    else:
+        buffer = np.fromfile(filename, dtype=np.uint8)
+
+    columns = {}
+    for name, spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        nbytes = int(np.prod(spec["shape"])) * dtype.itemsize
+        offset = start + spec["offset"]
+        columns[name] = (
+            np.asarray(buffer[offset:offset + nbytes]).view(dtype).reshape(spec["shape"])
+        )
+    return SegmentColumns(header["count"], columns)
+
+
+def columns_filename(filename):
+    """Columns snapshot saved alongside a segments file"""
+    return filename + ".columns"
+
+
+if __name__ == "__main__":
+    from src.segment_crawler import SegmentsData
+    from src.storage import open_store
+
+    location = sys.argv[1] if len(sys.argv) > 1 else "oxford"
+    filename = f"data/{location}/segments.json"
+    segments = SegmentsData(filename, store=open_store(filename))
+    columns = SegmentColumns.from_records(segments.data)
+    columns.save(columns_filename(filename))
+    LOGGER.info(
+        f"Saved {len(columns)} segments ({columns.nbytes()} bytes) "
+        f"to {columns_filename(filename)}"
+    )
@@ -0,0 +1,82 @@
+""" Progress of a segment crawl, saved so an interrupted crawl can resume """
+import json
+import os
+
+
+class CrawlState:
+    """The quadtree of regions being crawled and what remains to be done
+
+    Nodes are numbered in the order they are added; each has a box, zoom
+    level and parent. frontier holds the nodes still to be explored, results
+    the segment ids found in explored nodes whose details haven't all been
+    saved yet, and explored the status of nodes which are settled.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.boxes = []
+        self.zooms = []
+        self.parents = []
+        self.explored = {}
+        self.frontier = []
+        self.results = {}
+
+    @classmethod
+    def load(cls, filename):
+        """State saved in filename, or a new state if there is none"""
+        state = cls(filename)
+        if filename and os.path.exists(filename):
+            with open(filename, "r") as f:
+                saved = json.load(f)
+            state.boxes = saved["boxes"]
+            state.zooms = saved["zooms"]
+            state.parents = saved["parents"]
+            state.explored = {int(node): value for node, value in saved["explored"].items()}
+            state.frontier = saved["frontier"]
+            state.results = {int(node): ids for node, ids in saved["results"].items()}
+        return state
+
+    @property
+    def started(self):
+        return bool(self.boxes)
+
+    def add_node(self, box, zoom_level, parent=None):
+        self.boxes.append(box)
+        self.zooms.append(zoom_level)
+        self.parents.append(parent)
+        self.frontier.append(len(self.boxes) - 1)
+        return len(self.boxes) - 1
+
+    def children(self):
+        children = [[] for _ in self.boxes]
+        for node, parent in enumerate(self.parents):
+            if parent is not None:
+                children[parent].append(node)
+        return children
+
+    def pending_ids(self):
+        """Segment ids found but not saved yet"""
+        return [id for node in self.frontier for id in self.results.get(node, [])]
+
+    def save(self):
+        if not self.filename:
+            return
+        tmp_filename = f"{self.filename}.tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump(
+                {
+                    "boxes": self.boxes,
+                    "zooms": self.zooms,
+                    "parents": self.parents,
+                    "explored": self.explored,
+                    "frontier": self.frontier,
+                    "results": self.results,
+                },
+                f,
+            )
+        os.replace(tmp_filename, self.filename)
+
+    def clear(self):
+        """Forget a finished crawl"""
+        if self.filename and os.path.exists(self.filename):
+            os.remove(self.filename)
@@ -0,0 +1,156 @@
+""" Fetching segment details from the Strava API
+
+Segment ids are queued, deduplicated and fetched by a bounded pool of
+workers. Fetched details are kept in a cache, optionally persisted to disk,
+so no segment is requested twice.
+"""
+import sys
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from src.metrics import API_CALLS, CACHE_REQUESTS, OPERATION_SECONDS
+from src.storage import JournalStore
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+LOGGER.addHandler(handler)
+
+
+def key_details(seg_details):
+    """Fields stored for a segment, from a stravalib Segment"""
+    return {
+        "id": seg_details.id,
+        "name": seg_details.name,
+        "distance": float(seg_details.distance),
+        "avg_grade": float(seg_details.average_grade),
+        "climb": float(seg_details.total_elevation_gain),
+        "effort_count": int(seg_details.effort_count),
+        "start_latlng": seg_details.start_latlng,
+        "end_latlng": seg_details.end_latlng,
+        "polyline": seg_details.map.polyline,
+    }
+
+
+def details_key(details):
+    return details["id"]
+
+
+class DetailCache:
+    """Segment details by id, persisted to filename (with a journal) if given"""
+
+    def __init__(self, filename=None):
+        self.store = JournalStore(filename) if filename else None
+        records = self.store.load(details_key) if self.store else []
+        self._details = {record["id"]: record for record in records}
+        self._changed = []
+        self._lock = threading.Lock()
+
+    def __contains__(self, id):
+        return id in self._details
+
+    def get(self, id):
+        return self._details.get(id)
+
+    def put(self, details):
+        with self._lock:
+            self._details[details["id"]] = details
+            self._changed.append(details)
+
+    def save(self):
+        with self._lock:
+            changed, self._changed = self._changed, []
+        if self.store is not None and changed:
+            self.store.save(list(self._details.values()), changed)
+
+    def close(self):
+        self.save()
+        if self.store is not None:
+            self.store.close(list(self._details.values()))
+
+
+class DetailPipeline:
+    """Deduplicated, concurrent fetching of segment details
+
+    submit() queues ids to be fetched in the background; fetch() waits for
+    the details of a list of ids. Ids already cached or in flight are never
+    requested again.
+    """
+
+    def __init__(self, client, cache=None, workers=4):
+        self.client = client
+        self.cache = cache if cache is not None else DetailCache()
+        self.workers = workers
+        self._executor = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, ids, refresh=False):
+        """Start fetching details for ids which aren't cached or already queued"""
+        with self._lock:
+            for id in ids:
+                if id in self._pending:
+                    continue
+                if not refresh and id in self.cache:
+                    CACHE_REQUESTS.inc(cache="details", result="hit")
+                    continue
+                CACHE_REQUESTS.inc(cache="details", result="miss")
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers)
+                self._pending[id] = self._executor.submit(self._fetch, id)
+
+    def fetch(self, ids, refresh=False):
+        """Details for each of ids, in the same order, fetching any not cached
+
+        With refresh, ids are fetched again even if cached.
+        """
+        ids = list(dict.fromkeys(ids))
+        self.submit(ids, refresh)
+        with self._lock:
+            futures = [(id, self._pending.get(id)) for id in ids]
+
+        details = []
+        for id, future in futures:
+            if future is not None:
+                try:
+                    future.result()
+                finally:
+                    with self._lock:
+                        if self._pending.get(id) is future:
+                            del self._pending[id]
+            details.append(dict(self.cache.get(id)))
+
+        self.cache.save()
+        return details
+
+    def flush(self):
+        """Drop fetches not yet started, wait for those in flight, ignoring
+        failures, and save the cache
+
+        Used when giving up part way, so details already paid for are kept
+        but no more are requested.
+        """
+        with self._lock:
+            for id, future in list(self._pending.items()):
+                if future.cancel():
+                    del self._pending[id]
+            futures = list(self._pending.values())
+        wait(futures)
+        self.cache.save()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self.cache.close()
+
+    def _fetch(self, id):
+        with OPERATION_SECONDS.time(operation="get_segment"):
+            segment = self.client.get_segment(id)
+        API_CALLS.inc(call="get_segment")
+        details = key_details(segment)
+        self.cache.put(details)
+        return details
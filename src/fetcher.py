@@ -0,0 +1,233 @@
+""" Fetching web pages over pooled keep-alive connections, with an on-disk cache
+
+Errors are raised as the urllib/builtin exceptions used elsewhere
+(urllib.error.HTTPError, ConnectionError, socket.timeout), so callers don't
+depend on the HTTP library underneath.
+"""
+import codecs
+import hashlib
+import json
+import os
+import socket
+import sys
+import time
+import logging
+import threading
+from urllib.error import HTTPError
+from src.metrics import API_CALLS, CACHE_REQUESTS, OPERATION_SECONDS
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+LOGGER.addHandler(handler)
+
+# Bytes of a page read after the parser is done, to keep the connection
+DRAIN_LIMIT = 512 * 1024
+
+
+class PageCache:
+    """Pages stored on disk as JSON, one file per URL"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, url):
+        try:
+            with open(self._filename(url), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, url, body, etag=None, last_modified=None):
+        entry = {
+            "url": url,
+            "body": body,
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched_at": time.time(),
+        }
+        filename = self._filename(url)
+        # Unique to the thread, as processes can share the cache directory
+        tmp_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_filename, filename)
+        return entry
+
+    def _filename(self, url):
+        return os.path.join(
+            self.directory, hashlib.sha1(url.encode("utf8")).hexdigest() + ".json"
+        )
+
+
+# Fetcher stats as results of page cache lookups
+CACHE_RESULTS = {"hits": "hit", "revalidated": "revalidated", "downloaded": "miss"}
+
+
+class Fetcher:
+    """HTTP GETs over a pool of persistent connections
+
+    With a cache_dir, pages younger than ttl seconds are served from disk.
+    Older pages are revalidated with If-None-Match/If-Modified-Since, so an
+    unchanged page costs a 304 rather than a download.
+
+    Once a streaming parser is done, the rest of the page is read, without
+    parsing, only while at most drain_limit bytes have been read in all, so
+    the connection can be reused and the page cached. Past drain_limit the
+    connection is closed instead; drain_limit=0 always closes it as soon as
+    the parser is done, and None always reads the whole page.
+    """
+
+    def __init__(self, cache_dir=None, ttl=86400, pool_size=10, timeout=30, drain_limit=DRAIN_LIMIT):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.cache = PageCache(cache_dir) if cache_dir else None
+        self.ttl = ttl
+        self.timeout = timeout
+        self.drain_limit = drain_limit
+        self.stats = {"hits": 0, "revalidated": 0, "downloaded": 0}
+        self._lock = threading.Lock()
+
+    def fetch(self, url, parser=None, chunk_size=16384):
+        """Get the page at url as text
+
+        A streaming parser is fed the page as it arrives and stops being fed
+        once it is done. The rest of the page is then read up to drain_limit.
+        """
+        cached = self.cache.get(url) if self.cache else None
+        if self._is_fresh(cached):
+            self._count("hits")
+            return self._feed_cached(cached, parser)
+
+        headers = {}
+        if cached is not None:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        start = time.perf_counter()
+        response = self._get(url, headers)
+        API_CALLS.inc(call="page")
+        with response:
+            if response.status_code == 304 and cached is not None:
+                self._count("revalidated")
+                OPERATION_SECONDS.observe(time.perf_counter() - start, operation="fetch_page")
+                cached = self.cache.put(
+                    url, cached["body"], cached.get("etag"), cached.get("last_modified")
+                )
+                return self._feed_cached(cached, parser)
+
+            if response.status_code >= 400:
+                raise HTTPError(
+                    url, response.status_code, response.reason, response.headers, None
+                )
+
+            self._count("downloaded")
+            body, complete = self._read(url, response, parser, chunk_size)
+        OPERATION_SECONDS.observe(time.perf_counter() - start, operation="fetch_page")
+
+        if self.cache is not None and complete:
+            self.cache.put(
+                url,
+                body,
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+            )
+        return body
+
+    def is_fresh(self, url):
+        """Check if url can be served from the cache without any request"""
+        return self.cache is not None and self._is_fresh(self.cache.get(url))
+
+    def _is_fresh(self, entry):
+        return entry is not None and time.time() - entry["fetched_at"] < self.ttl
+
+    def log_stats(self):
+        LOGGER.info(
+            "Fetched pages: {hits} cache hits, {revalidated} revalidated (304), "
+            "{downloaded} downloaded".format(**self.stats)
+        )
+
+    def _get(self, url, headers):
+        import requests
+
+        try:
+            return self.session.get(url, headers=headers, stream=True, timeout=self.timeout)
+        except requests.Timeout as e:
+            raise socket.timeout(str(e))
+        except requests.RequestException as e:
+            raise ConnectionError(str(e))
+
+    def _read(self, url, response, parser, chunk_size):
+        import requests
+
+        decoder = codecs.getincrementaldecoder("utf8")()
+        chunks = []
+        read = 0
+        try:
+            for data in response.iter_content(chunk_size):
+                chunks.append(decoder.decode(data))
+                read += len(data)
+                if parser is not None and not parser.done:
+                    try:
+                        parser.feed(chunks[-1])
+                    except Exception as e:
+                        LOGGER.warning(f"Streaming parse of {url} failed: {e}")
+                        parser = None
+                if (
+                    parser is not None
+                    and parser.done
+                    and self.drain_limit is not None
+                    and read > self.drain_limit
+                ):
+                    # Not worth reading the rest just to keep the connection
+                    return "".join(chunks), False
+            chunks.append(decoder.decode(b"", final=True))
+        except requests.RequestException as e:
+            raise ConnectionError(str(e))
+        return "".join(chunks), True
+
+    @staticmethod
+    def _feed_cached(entry, parser):
+        if parser is not None:
+            try:
+                parser.feed(entry["body"])
+            except Exception as e:
+                LOGGER.warning(f"Streaming parse of cached {entry['url']} failed: {e}")
+        return entry["body"]
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+        CACHE_REQUESTS.inc(cache="page", result=CACHE_RESULTS[stat])
+
+
+_FETCHER = None
+_FETCHER_LOCK = threading.Lock()
+
+
+def configure_fetcher(**kwargs):
+    """Replace the shared fetcher, e.g. to enable the on-disk cache"""
+    global _FETCHER
+    with _FETCHER_LOCK:
+        _FETCHER = Fetcher(**kwargs)
+    return _FETCHER
+
+
+def get_fetcher():
+    """Shared fetcher, so connections are pooled across callers"""
+    global _FETCHER
+    with _FETCHER_LOCK:
+        if _FETCHER is None:
+            _FETCHER = Fetcher()
+        return _FETCHER
@@ -0,0 +1,196 @@
+""" Running long tasks, such as crawls, in the background
+
+Each location has at most one job running at a time. Jobs report progress
+through a callback which also raises Cancelled once the job is cancelled, so
+work stops at the next progress report.
+
+A job can run in phases, such as crawling regions and then scraping pages,
+each reporting its own <phase>_total and <phase>_done counters.
+"""
+import sys
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+LOGGER.addHandler(handler)
+
+
+class Cancelled(Exception):
+    """Raised inside a job once it has been cancelled"""
+
+
+class JobConflict(Exception):
+    """A job is already running for the location"""
+
+    def __init__(self, job):
+        super().__init__(f"Job {job.id} is already running for {job.location}")
+        self.job = job
+
+
+class Job:
+    """A task for a location, with progress counters
+
+    Counters are increased through report(**increments). Reporting the
+    <phase>_total counter of another phase starts that phase, and the current
+    phase's total and done counters estimate the time it has remaining.
+    """
+
+    def __init__(self, location, kind):
+        self.id = uuid.uuid4().hex
+        self.location = location
+        self.kind = kind
+        self.status = "queued"
+        self.error = None
+        self.counters = {}
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.phase = None
+        self.phase_started_at = None
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        return self.status in ("queued", "running")
+
+    def report(self, **increments):
+        """Add to progress counters, raising Cancelled if the job was cancelled"""
+        with self._lock:
+            for name, increment in increments.items():
+                self.counters[name] = self.counters.get(name, 0) + increment
+                phase, _, counter = name.rpartition("_")
+                if phase and counter == "total" and phase != self.phase:
+                    self.phase = phase
+                    self.phase_started_at = time.time()
+        if self._cancel.is_set():
+            raise Cancelled(f"Job {self.id} cancelled")
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def eta(self):
+        """Estimated seconds remaining in the current phase, or None if it
+        can't be estimated yet"""
+        with self._lock:
+            phase = self.phase
+            total = self.counters.get(f"{phase}_total", 0)
+            done = self.counters.get(f"{phase}_done", 0)
+            started_at = self.phase_started_at
+        if self.status != "running" or phase is None or not done or not total:
+            return None
+        elapsed = time.time() - started_at
+        return max(elapsed / done * (total - done), 0.0)
+
+    def to_dict(self):
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            "id": self.id,
+            "location": self.location,
+            "kind": self.kind,
+            "status": self.status,
+            "error": self.error,
+            "phase": self.phase,
+            "progress": counters,
+            "eta_seconds": self.eta(),
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobRunner:
+    """Runs jobs on a pool of background threads, one per location at a time"""
+
+    def __init__(self, workers=2, history=100):
+        self.workers = workers
+        self.history = history
+        self._executor = None
+        self._jobs = {}
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def submit(self, location, kind, func):
+        """Run func(job) in the background and return the job
+
+        Raises JobConflict if the location already has a job queued or running.
+        """
+        with self._lock:
+            current = self._running.get(location)
+            if current is not None and current.active:
+                raise JobConflict(current)
+            job = Job(location, kind)
+            self._jobs[job.id] = job
+            self._running[location] = job
+            self._forget_old()
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            self._executor.submit(self._run, job, func)
+        LOGGER.info(f"Submitted {kind} job {job.id} for {location}")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def current(self, location):
+        """The latest job for location, which may have finished"""
+        with self._lock:
+            return self._running.get(location)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None and job.active:
+            job.cancel()
+            LOGGER.info(f"Cancelling job {job.id} for {job.location}")
+        return job
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            jobs = list(self._jobs.values())
+        if not wait:
+            for job in jobs:
+                job.cancel()
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def _run(self, job, func):
+        if job.cancelled:
+            self._finish(job, "cancelled")
+            return
+        job.started_at = time.time()
+        job.status = "running"
+        try:
+            func(job)
+        except Cancelled:
+            self._finish(job, "cancelled")
+        except Exception as e:
+            LOGGER.exception(f"Job {job.id} for {job.location} failed")
+            job.error = str(e)
+            self._finish(job, "failed")
+        else:
+            self._finish(job, "done")
+
+    def _finish(self, job, status):
+        job.finished_at = time.time()
+        job.status = status
+        LOGGER.info(f"Job {job.id} for {job.location}: {status}")
+
+    def _forget_old(self):
+        finished = [job for job in self._jobs.values() if not job.active]
+        for job in finished[: max(len(self._jobs) - self.history, 0)]:
+            del self._jobs[job.id]
@@ -0,0 +1,95 @@
+""" Parsing the fastest athlete and time from a segment's leaderboard page """
+from html.parser import HTMLParser
+
+
+def parse_leader(html):
+    """Get the fastest athlete and time from a complete segment page"""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "html.parser")
+    table = soup.find("table", {"class": "table-leaderboard"})
+    leader = table.find("tbody").find("tr")
+    rows = leader.find_all("td")
+
+    name = rows[1].text.strip()
+    time = rows[-1].text
+    return name, time
+
+
+class LeaderboardParser(HTMLParser):
+    """Incremental parser which stops once the leaderboard's first row is read
+
+    Feed it the page a chunk at a time; done becomes True as soon as the first
+    row of table.table-leaderboard has been closed, so the rest of the page
+    need not be downloaded. leader then gives the same (name, time) as
+    parse_leader.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.done = False
+        self._in_table = False
+        self._table_depth = 0
+        self._in_tbody = False
+        self._in_row = False
+        self._row_depth = 0
+        self._cells = []
+        self._open_cells = []
+
+    @property
+    def leader(self):
+        """(name, time) of the fastest athlete, or None if not parsed yet"""
+        if not self.done or len(self._cells) < 2:
+            return None
+        return "".join(self._cells[1]).strip(), "".join(self._cells[-1])
+
+    def feed(self, data):
+        if not self.done:
+            super().feed(data)
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == "table":
+            if self._in_table:
+                self._table_depth += 1
+            elif "table-leaderboard" in (dict(attrs).get("class") or "").split():
+                self._in_table = True
+        elif not self._in_table:
+            return
+        elif tag == "tbody" and not self._in_tbody:
+            self._in_tbody = True
+        elif tag == "tr" and self._in_tbody:
+            if self._in_row:
+                # Like html.parser trees, an unclosed row contains the next one
+                self._row_depth += 1
+            else:
+                self._in_row = True
+        elif tag == "td" and self._in_row:
+            self._cells.append([])
+            self._open_cells.append(self._cells[-1])
+
+    def handle_endtag(self, tag):
+        if self.done or not self._in_table:
+            return
+        if tag == "table" and self._table_depth:
+            self._table_depth -= 1
+        elif tag == "td" and self._open_cells:
+            self._open_cells.pop()
+        elif tag == "tr" and self._in_row:
+            if self._row_depth:
+                self._row_depth -= 1
+            else:
+                self._finish()
+        elif tag in ("tbody", "table") and self._in_row:
+            self._finish()
+        elif tag == "table":
+            self._in_table = False
+
+    def handle_data(self, data):
+        for cell in self._open_cells:
+            cell.append(data)
+
+    def _finish(self):
+        self.done = True
+        self._open_cells = []
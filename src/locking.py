@@ -0,0 +1,92 @@
+""" Locks for data shared between threads, or between processes """
+import threading
+from contextlib import contextmanager
+
+
+class LockHeld(Exception):
+    """A file lock is held by another process"""
+
+    def __init__(self, filename):
+        super().__init__(f"{filename} is locked by another process")
+        self.filename = filename
+
+
+@contextmanager
+def file_lock(filename, blocking=False):
+    """Hold an exclusive lock on filename across processes while the with block runs
+
+    Without blocking, raises LockHeld if another process has the lock. The
+    lock is released if the process dies, so is never left stale.
+    """
+    import fcntl
+
+    with open(filename, "a") as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            raise LockHeld(filename)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class RWLock:
+    """Any number of readers, or one writer
+
+    Waiting writers block new readers, so a stream of requests can't starve
+    a crawl. Both kinds of lock are reentrant, and the writer may also take
+    the read lock, but a reader can't upgrade to writing.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writes = 0
+        self._waiting_writers = 0
+        self._local = threading.local()
+
+    @contextmanager
+    def read(self):
+        held = getattr(self._local, "reads", 0)
+        with self._cond:
+            if not held and self._writer != threading.get_ident():
+                while self._writer is not None or self._waiting_writers:
+                    self._cond.wait()
+            self._readers += 1
+        self._local.reads = held + 1
+        try:
+            yield
+        finally:
+            self._local.reads = held
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writes += 1
+            else:
+                if getattr(self._local, "reads", 0):
+                    raise RuntimeError("Can't take the write lock while reading")
+                self._waiting_writers += 1
+                try:
+                    while self._writer is not None or self._readers:
+                        self._cond.wait()
+                finally:
+                    self._waiting_writers -= 1
+                self._writer = me
+                self._writes = 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writes -= 1
+                if not self._writes:
+                    self._writer = None
+                    self._cond.notify_all()
@@ -0,0 +1,333 @@
+""" Counters, gauges and histograms of crawl and request work
+
+Metrics are kept in memory for the life of the process, and can be rendered
+in the Prometheus text format (served at /metrics) or logged as a summary
+(at the end of run.py). Every update takes a lock, so metrics can be shared
+between threads. Other processes, e.g. run.py's batch workers, send a
+snapshot of their metrics to be merged.
+
+with OPERATION_SECONDS.time(operation="explore_segments"):
+    client.explore_segments(bounds)
+API_CALLS.inc(call="explore_segments")
+"""
+import sys
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+LOGGER.addHandler(handler)
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = tuple(1024 * 4 ** n for n in range(11))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """Values of a metric, by the values of its labels"""
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} has labels {self.labels}, got {tuple(labels)}")
+        return tuple((name, labels[name]) for name in self.labels)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def snapshot(self):
+        """Values by labels, which can be pickled, e.g. to another process"""
+        with self._lock:
+            return {key: self._copy(value) for key, value in self._values.items()}
+
+    def merge(self, values):
+        """Add a snapshot of the metric, e.g. from another process"""
+        with self._lock:
+            for key, value in values.items():
+                current = self._values.get(key)
+                self._values[key] = (
+                    self._copy(value) if current is None else self._combine(current, value)
+                )
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    @staticmethod
+    def _combine(current, value):
+        return current + value
+
+    def label_sets(self):
+        """Labels of each value recorded, as dicts"""
+        with self._lock:
+            return [dict(key) for key in sorted(self._values)]
+
+    def samples(self):
+        """(name suffix, labels, value) of each sample in the text format"""
+        with self._lock:
+            return [("", key, value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """A value which can go up and down; merging keeps the highest"""
+
+    type = "gauge"
+    _combine = staticmethod(max)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_max(self, value, **labels):
+        """Set the gauge to value if it's higher, e.g. to track a maximum"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = max(self._values.get(key, value), value)
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+
+class Histogram(Metric):
+    """Counts of observations in cumulative buckets, with their sum"""
+
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = {
+                    "buckets": [0] * len(self.buckets),
+                    "count": 0,
+                    "sum": 0.0,
+                    "max": value,
+                }
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values["buckets"][i] += 1
+                    break
+            values["count"] += 1
+            values["sum"] += value
+            values["max"] = max(values["max"], value)
+
+    @staticmethod
+    def _copy(values):
+        return dict(values, buckets=list(values["buckets"]))
+
+    @staticmethod
+    def _combine(current, values):
+        return {
+            "buckets": [a + b for a, b in zip(current["buckets"], values["buckets"])],
+            "count": current["count"] + values["count"],
+            "sum": current["sum"] + values["sum"],
+            "max": max(current["max"], values["max"]),
+        }
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds taken by the body of a with statement"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get(self, **labels):
+        """count, sum and max of observations, or None if there are none"""
+        with self._lock:
+            values = self._values.get(self._key(labels))
+            return None if values is None else dict(values, buckets=list(values["buckets"]))
+
+    def samples(self):
+        with self._lock:
+            items = sorted(
+                (key, dict(values, buckets=list(values["buckets"])))
+                for key, values in self._values.items()
+            )
+        samples = []
+        for key, values in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, values["buckets"]):
+                cumulative += count
+                samples.append(("_bucket", key + (("le", _format_value(bound)),), cumulative))
+            samples.append(("_sum", key, values["sum"]))
+            samples.append(("_count", key, values["count"]))
+        return samples
+
+
+class Registry:
+    """Metrics by name. Registering a name again returns the existing metric"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"{name} is already registered as a {metric.type}")
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram, name, help, labels, buckets)
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def reset(self):
+        for metric in self.metrics():
+            metric.reset()
+
+    def snapshot(self):
+        """Values of every metric by name, e.g. to send to another process"""
+        return {metric.name: metric.snapshot() for metric in self.metrics()}
+
+    def merge(self, snapshot):
+        """Add a snapshot's values to the metrics registered here"""
+        with self._lock:
+            metrics = dict(self._metrics)
+        for name, values in snapshot.items():
+            if name in metrics:
+                metrics[name].merge(values)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+OPERATION_SECONDS = REGISTRY.histogram(
+    "segments_operation_seconds",
+    "Time taken by API calls, page fetches, parsing and saves",
+    ["operation"],
+)
+API_CALLS = REGISTRY.counter(
+    "segments_api_calls_total", "Requests made to Strava, by API call or page", ["call"]
+)
+CACHE_REQUESTS = REGISTRY.counter(
+    "segments_cache_requests_total",
+    "Lookups in the page, segment details and display caches",
+    ["cache", "result"],
+)
+SAVE_BYTES = REGISTRY.histogram(
+    "segments_save_bytes", "Bytes written by each save", ["data"], buckets=BYTES_BUCKETS
+)
+CRAWL_MAX_ZOOM = REGISTRY.gauge(
+    "segments_crawl_max_zoom", "Deepest quadtree zoom level explored by a crawl"
+)
+
+
+def summary():
+    """Lines summarising the metrics, for logging at the end of a run"""
+    lines = []
+    for key in OPERATION_SECONDS.label_sets():
+        values = OPERATION_SECONDS.get(**key)
+        lines.append(
+            f"{key['operation']}: {values['count']} calls, {values['sum']:.2f}s total, "
+            f"mean {values['sum'] / values['count'] * 1000:.1f}ms, "
+            f"max {values['max'] * 1000:.1f}ms"
+        )
+    for key in SAVE_BYTES.label_sets():
+        values = SAVE_BYTES.get(**key)
+        lines.append(
+            f"Saving {key['data']}: {values['count']} saves, "
+            f"{values['sum'] / 2 ** 20:.1f} MiB written, max {values['max'] / 2 ** 20:.1f} MiB"
+        )
+    for key in API_CALLS.label_sets():
+        lines.append(f"{key['call']} requests: {API_CALLS.get(**key)}")
+    for cache, rate, total in cache_hit_rates():
+        lines.append(f"{cache} cache: {rate:.0%} hits of {total} lookups")
+    if CRAWL_MAX_ZOOM.get() is not None:
+        lines.append(f"Deepest zoom level crawled: {CRAWL_MAX_ZOOM.get()}")
+    return lines
+
+
+def cache_hit_rates():
+    """(cache, hit rate, lookups) for each cache looked up"""
+    totals = {}
+    hits = {}
+    for labels in CACHE_REQUESTS.label_sets():
+        value = CACHE_REQUESTS.get(**labels)
+        totals[labels["cache"]] = totals.get(labels["cache"], 0) + value
+        if labels["result"] == "hit":
+            hits[labels["cache"]] = hits.get(labels["cache"], 0) + value
+    return [(cache, hits.get(cache, 0) / total, total) for cache, total in sorted(totals.items())]
+
+
+def log_summary():
+    for line in summary():
+        LOGGER.info(line)
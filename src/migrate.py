@@ -0,0 +1,68 @@
+""" Script to move a location's data between JSON files and SQLite
+
+Import data/<location>/segments.json and regions.json into
+data/<location>/data.sqlite, after which the app reads from SQLite:
+python -m src.migrate oxford import
+
+Export the SQLite tables back to the JSON files:
+python -m src.migrate oxford export
+"""
+import argparse
+import os
+import sys
+import logging
+from src.regions import region_key
+from src.segment_crawler import segment_bounds, segment_key
+from src.spatial import record_bounds
+from src.storage import SQLITE_FILENAME, JournalStore, SnapshotStore, SqliteStore
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+LOGGER.addHandler(handler)
+
+# Each table's key function, and the bounds it is indexed by
+TABLES = {
+    "segments": (segment_key, segment_bounds),
+    "regions": (region_key, record_bounds),
+}
+
+
+def import_location(directory):
+    """Copy JSON files (including any journal) into the SQLite database"""
+    db_filename = os.path.join(directory, SQLITE_FILENAME)
+    for table, (key, bounds) in TABLES.items():
+        filename = os.path.join(directory, f"{table}.json")
+        if not os.path.exists(filename):
+            continue
+        data = JournalStore(filename).load(key)
+        store = SqliteStore(db_filename, table, key, bounds)
+        store.save(data)
+        LOGGER.info(f"Imported {store.count()} {table} into {db_filename}")
+
+
+def export_location(directory):
+    """Write the SQLite tables back out as JSON snapshot files"""
+    db_filename = os.path.join(directory, SQLITE_FILENAME)
+    for table, (key, _) in TABLES.items():
+        filename = os.path.join(directory, f"{table}.json")
+        data = SqliteStore(db_filename, table).load(key)
+        SnapshotStore(filename).save(data)
+        LOGGER.info(f"Exported {len(data)} {table} to {filename}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Move location data to/from SQLite")
+    parser.add_argument("location", type=str, help="Location")
+    parser.add_argument("action", choices=["import", "export"])
+    args = parser.parse_args()
+
+    directory = f"data/{args.location}"
+    if args.action == "import":
+        import_location(directory)
+    else:
+        export_location(directory)
@@ -0,0 +1,65 @@
+""" Caching of data loaded from disk, invalidated when the files change """
+import hashlib
+import os
+import threading
+from datetime import datetime, timezone
+from src.storage import SQLITE_FILENAME
+
+
+def data_files(filename):
+    """All files that can hold data for a file such as data/oxford/segments.json"""
+    directory = os.path.dirname(filename)
+    db_filename = os.path.join(directory, SQLITE_FILENAME)
+    return [
+        filename,
+        filename + ".journal",
+        filename + ".journal.compacting",
+        db_filename,
+        db_filename + "-wal",
+    ]
+
+
+def data_version(filename):
+    """Version of the data behind filename, and when it was last modified
+
+    The version changes whenever any of the files holding the data changes.
+    """
+    version = []
+    last_modified = 0
+    for path in data_files(filename):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        version.append((path, stat.st_mtime_ns, stat.st_size))
+        last_modified = max(last_modified, stat.st_mtime)
+    return tuple(version), datetime.fromtimestamp(int(last_modified), timezone.utc)
+
+
+def make_etag(*parts):
+    """Strong ETag from the parts that determine a response"""
+    return hashlib.sha1(repr(parts).encode("utf8")).hexdigest()
+
+
+class VersionedCache:
+    """Thread safe cache of values which are rebuilt when their version changes"""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, version, build):
+        """Cached value for key if it was built for version, otherwise build()"""
+        with self._lock:
+            cached = self._values.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        value = build()
+        with self._lock:
+            self._values[key] = (version, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
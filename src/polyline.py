@@ -0,0 +1,205 @@
+""" Google encoded polylines, as used for Strava segment maps
+
+https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+
+Polylines can be decoded into NumPy arrays and simplified for display at a
+map zoom level, where detail smaller than a pixel can't be seen anyway.
+"""
+import math
+import threading
+
+# Zoom levels simplified polylines are made for; beyond the last, the
+# original is used
+MIN_ZOOM = 8
+MAX_ZOOM = 17
+# Simplify to within this many pixels of the original route
+PIXEL_TOLERANCE = 0.5
+
+
+def decode(polyline, precision=5):
+    """List of (lat, lng) points in an encoded polyline"""
+    factor = 10 ** precision
+    points = []
+    index = lat = lng = 0
+    while index < len(polyline):
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                byte = ord(polyline[index]) - 63
+                index += 1
+                result |= (byte & 0x1F) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lng += deltas[1]
+        points.append((lat / factor, lng / factor))
+    return points
+
+
+def polyline_bounds(polyline):
+    """((min_lat, min_lng), (max_lat, max_lng)) of an encoded polyline, or None"""
+    points = decode(polyline) if polyline else []
+    if not points:
+        return None
+    lats = [lat for lat, _ in points]
+    lngs = [lng for _, lng in points]
+    return (min(lats), min(lngs)), (max(lats), max(lngs))
+
+
+def decode_array(polyline, precision=5):
+    """Points of an encoded polyline as an (n, 2) array of lat, lng"""
+    import numpy as np
+
+    chunks = np.frombuffer(polyline.encode("ascii"), dtype=np.uint8).astype(np.int64) - 63
+    if not len(chunks):
+        return np.zeros((0, 2))
+    # Each value is a run of 5 bit chunks, the last without the 0x20 flag
+    ends = np.flatnonzero(chunks < 0x20)
+    if not len(ends) or ends[-1] != len(chunks) - 1 or len(ends) % 2:
+        raise ValueError(f"Truncated polyline: {polyline!r}")
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shifts = 5 * (np.arange(len(chunks)) - np.repeat(starts, ends - starts + 1))
+    values = np.add.reduceat((chunks & 0x1F) << shifts, starts)
+    deltas = np.where(values & 1, ~(values >> 1), values >> 1)
+    return np.cumsum(deltas.reshape(-1, 2), axis=0) / 10 ** precision
+
+
+def decode_many(polylines, precision=5):
+    """decode_array for each of polylines"""
+    return [decode_array(polyline, precision) for polyline in polylines]
+
+
+def encode(points, precision=5):
+    """Encode a sequence or array of (lat, lng) points as a polyline"""
+    import numpy as np
+
+    values = np.round(np.asarray(points, dtype=float).reshape(-1, 2) * 10 ** precision)
+    chunks = []
+    previous = (0, 0)
+    for point in values.astype(np.int64).tolist():
+        for value, last in zip(point, previous):
+            value -= last
+            value = ~(value << 1) if value < 0 else value << 1
+            while value >= 0x20:
+                chunks.append(chr((0x20 | (value & 0x1F)) + 63))
+                value >>= 5
+            chunks.append(chr(value + 63))
+        previous = point
+    return "".join(chunks)
+
+
+def simplify(points, tolerance):
+    """Douglas-Peucker simplification of an (n, 2) array of points
+
+    Keeps the points needed for the line to stay within tolerance of every
+    original point, always including the first and last.
+    """
+    return points[significance(points, tolerance) > tolerance]
+
+
+def significance(points, min_tolerance=0.0):
+    """The largest Douglas-Peucker tolerance at which each point is kept
+
+    The first and last points are always kept (inf). Splitting stops at
+    min_tolerance, so points only needed below it get 0. A point is kept by
+    simplify(points, tolerance) if its significance exceeds tolerance, so one
+    pass gives the simplification for every tolerance above min_tolerance.
+    """
+    import numpy as np
+
+    kept = np.zeros(len(points))
+    if len(points):
+        kept[[0, -1]] = np.inf
+    # (first, last, significance of the split which made the range)
+    stack = [(0, len(points) - 1, np.inf)]
+    while stack:
+        first, last, parent = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first], points[last]
+        offsets = points[first + 1:last] - start
+        line = end - start
+        length = math.hypot(line[0], line[1])
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            # Distance from the chord through start and end
+            distances = np.abs(line[0] * offsets[:, 1] - line[1] * offsets[:, 0]) / length
+        furthest = int(np.argmax(distances))
+        if distances[furthest] > min_tolerance:
+            middle = first + 1 + furthest
+            # A point is only reached if every split above it was made
+            kept[middle] = min(distances[furthest], parent)
+            stack.append((first, middle, kept[middle]))
+            stack.append((middle, last, kept[middle]))
+    return kept
+
+
+def zoom_tolerance(zoom):
+    """Distance in (mercator scaled) degrees of PIXEL_TOLERANCE at a zoom level"""
+    return PIXEL_TOLERANCE * 360.0 / (256 * 2 ** zoom)
+
+
+def simplify_for_zooms(polyline, zooms=None):
+    """Simplified polylines, re-encoded, for each of zooms"""
+    import numpy as np
+
+    zooms = range(MIN_ZOOM, MAX_ZOOM + 1) if zooms is None else zooms
+    points = decode_array(polyline)
+    if not len(points):
+        return {zoom: polyline for zoom in zooms}
+    # Latitude degrees are stretched on a mercator map, so measure in map units
+    scale = np.array([1.0 / math.cos(math.radians(points[:, 0].mean())), 1.0])
+    projected = points * scale
+
+    zooms = sorted(zooms)
+    kept = significance(projected, zoom_tolerance(zooms[-1]))
+    return {zoom: encode(points[kept > zoom_tolerance(zoom)]) for zoom in zooms}
+
+
+class PolylineCache:
+    """Simplified polylines of segments for each zoom level, keyed by segment id
+
+    The simplifications for every zoom level are made together the first time
+    a segment is requested, and made again if its polyline changes.
+    """
+
+    def __init__(self, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self._simplified = {}
+        self._lock = threading.Lock()
+
+    def get(self, id, polyline, zoom):
+        """polyline simplified for zoom; at or beyond max_zoom, polyline itself"""
+        if not polyline or zoom >= self.max_zoom:
+            return polyline
+        zoom = max(int(zoom), self.min_zoom)
+        with self._lock:
+            cached = self._simplified.get(id)
+        if cached is None or cached[0] != polyline:
+            try:
+                levels = simplify_for_zooms(
+                    polyline, range(self.min_zoom, self.max_zoom)
+                )
+            except ValueError:
+                return polyline
+            cached = (polyline, levels)
+            with self._lock:
+                self._simplified[id] = cached
+        return cached[1][zoom]
+
+    def simplify_segments(self, segments, zoom):
+        """Copies of segments with their polylines simplified for zoom"""
+        return [
+            dict(segment, polyline=self.get(segment.get("id"), segment["polyline"], zoom))
+            if segment.get("polyline")
+            else segment
+            for segment in segments
+        ]
+
+    def __len__(self):
+        return len(self._simplified)
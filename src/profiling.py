@@ -0,0 +1,180 @@
+""" Sampling profiler writing flame graph stacks
+
+While running, a background thread samples the stacks of the profiled
+threads every interval seconds. The stacks are written in the folded format,
+one "outer;...;inner count" line per distinct stack, which flamegraph.pl and
+speedscope read. Nothing runs unless a profile is taken, so profiling costs
+nothing when it is off.
+
+with profile("crawl") as profiler:
+    crawler.retrieve_segments_recursively(bounds)
+print(profiler.filename)
+
+Profiles are written under PROFILE_DIR, .cache/profiles by default.
+"""
+import os
+import re
+import sys
+import time
+import logging
+import itertools
+import threading
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+LOGGER.addHandler(handler)
+
+DEFAULT_PROFILE_DIR = ".cache/profiles"
+# 200 samples a second; the sampling thread holds the GIL only while it
+# walks the stacks, so this adds a few percent to the profiled code
+DEFAULT_INTERVAL = 0.005
+
+# Numbers the profiles written by this process, so their filenames differ
+_PROFILE_NUMBERS = itertools.count(1)
+
+
+def profile_directory():
+    """Directory profiles are written to, set by PROFILE_DIR"""
+    return os.getenv("PROFILE_DIR", DEFAULT_PROFILE_DIR)
+
+
+def _frame_name(code):
+    filename = code.co_filename
+    cwd = os.getcwd()
+    if filename.startswith(cwd + os.sep):
+        filename = filename[len(cwd) + 1:]
+    else:
+        # Library code, e.g. .../site-packages/requests/sessions.py
+        filename = os.path.join(*filename.split(os.sep)[-2:])
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def folded_stack(frame, names=None):
+    """A frame's stack as frame names from the outermost, joined by ;
+
+    names caches the name of each code object.
+    """
+    names = {} if names is None else names
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        name = names.get(code)
+        if name is None:
+            name = names[code] = _frame_name(code)
+        stack.append(name)
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class SamplingProfiler:
+    """Counts of the stacks of threads, sampled every interval seconds
+
+    threads are the idents of the threads to sample, or None to sample every
+    thread but the profiler's own, each under its thread's name.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, threads=None):
+        self.interval = interval
+        self.threads = None if threads is None else set(threads)
+        self.stacks = {}
+        self.samples = 0
+        self.seconds = 0.0
+        self.filename = None
+        self._names = {}
+        self._thread = None
+        self._stop = threading.Event()
+        self._start = None
+
+    def start(self):
+        self._start = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.seconds = time.perf_counter() - self._start
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        """Record the current stack of each profiled thread"""
+        me = threading.get_ident()
+        thread_names = None
+        if self.threads is None:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me or (self.threads is not None and ident not in self.threads):
+                continue
+            stack = folded_stack(frame, self._names)
+            if thread_names is not None:
+                stack = f"{thread_names.get(ident, ident)};{stack}"
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def folded(self):
+        """Lines of stacks and their counts, most sampled first"""
+        return [
+            f"{stack} {count}"
+            for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1])
+        ]
+
+    def write(self, filename):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(filename, "w") as f:
+            for line in self.folded():
+                f.write(line + "\n")
+        self.filename = filename
+        return filename
+
+
+def profile_filename(name, directory=None):
+    """A new file for a profile of name, e.g. crawl-20240101-120000-1234-1.folded"""
+    name = re.sub(r"[^\w.-]+", "_", name).strip("_") or "profile"
+    timestamp = time.strftime("%Y%m%d-%H%M%S")
+    return os.path.join(
+        directory or profile_directory(),
+        f"{name}-{timestamp}-{os.getpid()}-{next(_PROFILE_NUMBERS)}.folded",
+    )
+
+
+@contextmanager
+def profile(name, directory=None, interval=DEFAULT_INTERVAL, threads=None):
+    """Profile the with block, writing the stacks to a new file in directory
+
+    Every thread is sampled unless threads gives the idents of those to sample.
+    """
+    profiler = SamplingProfiler(interval, threads)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        filename = profiler.write(profile_filename(name, directory))
+        LOGGER.info(
+            f"Wrote profile of {name} to {filename}, "
+            f"{profiler.samples} samples over {profiler.seconds:.1f}s"
+        )
+
+
+def profiled(func, name, directory=None):
+    """func, profiled on the thread which calls it"""
+
+    def wrapper(*args, **kwargs):
+        with profile(name, directory, threads=[threading.get_ident()]):
+            return func(*args, **kwargs)
+
+    return wrapper
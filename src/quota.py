@@ -0,0 +1,214 @@
+""" Pacing Strava API calls to stay within the rate limits
+
+Strava allows a number of requests per 15 minutes (windows starting on the
+quarter hour) and per day (starting at midnight UTC), and reports the usage
+so far in the X-RateLimit-Usage/X-RateLimit-Limit headers of every response.
+"""
+import sys
+import math
+import time
+import logging
+import threading
+import multiprocessing
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+LOGGER.addHandler(handler)
+
+SHORT_WINDOW = 15 * 60
+LONG_WINDOW = 24 * 60 * 60
+# How often a wait for quota checks whether to stop waiting
+CHECK_INTERVAL = 5.0
+
+
+class QuotaExhausted(Exception):
+    """The daily quota is used up, so no more requests can be made today"""
+
+    def __init__(self, seconds_until_reset):
+        super().__init__(f"Daily Strava quota used, resets in {seconds_until_reset:.0f}s")
+        self.seconds_until_reset = seconds_until_reset
+
+
+def parse_rate_headers(headers):
+    """(short usage, long usage, short limit, long limit) from response headers
+
+    Returns None if the headers aren't there.
+    """
+    try:
+        usage = [int(n) for n in headers["X-RateLimit-Usage"].split(",")]
+        limit = [int(n) for n in headers["X-RateLimit-Limit"].split(",")]
+    except (KeyError, ValueError, AttributeError):
+        return None
+    if len(usage) != 2 or len(limit) != 2:
+        return None
+    return usage[0], usage[1], limit[0], limit[1]
+
+
+class QuotaScheduler:
+    """Counts requests against the 15 minute and daily quotas
+
+    Call acquire() before each request: it returns straight away while the
+    current 15 minute window has quota left, and otherwise sleeps until the
+    next window. Once the daily quota is used it raises QuotaExhausted.
+    acquire(check) calls check before, and every CHECK_INTERVAL seconds
+    while waiting, so e.g. a cancelled job can stop by raising.
+
+    The scheduler is also a stravalib rate limiter (called with the headers
+    of each response), so the counts follow Strava's own, including requests
+    made by other clients with the same app.
+    """
+
+    def __init__(self, short_limit=100, long_limit=1000, headroom=1, clock=time.time, sleep=time.sleep):
+        self.short_limit = short_limit
+        self.long_limit = long_limit
+        self.headroom = headroom
+        self.clock = clock
+        self.sleep = sleep
+        self.requests = 0
+        self._short_usage = 0
+        self._long_usage = 0
+        self._windows = None
+        self._lock = threading.Lock()
+
+    def __call__(self, response_headers):
+        rates = parse_rate_headers(response_headers)
+        if rates is None:
+            return
+        short_usage, long_usage, short_limit, long_limit = rates
+        with self._lock:
+            self._roll()
+            # Requests still in flight aren't counted by Strava yet
+            self._short_usage = max(self._short_usage, short_usage)
+            self._long_usage = max(self._long_usage, long_usage)
+            self.short_limit = short_limit
+            self.long_limit = long_limit
+
+    def acquire(self, check=None):
+        """Block until a request can be made within the quotas"""
+        while True:
+            if check is not None:
+                check()
+            with self._lock:
+                now = self._roll()
+                if self._long_usage + self.headroom >= self.long_limit:
+                    raise QuotaExhausted(LONG_WINDOW - now % LONG_WINDOW)
+                if self._short_usage + self.headroom < self.short_limit:
+                    self._short_usage += 1
+                    self._long_usage += 1
+                    self.requests += 1
+                    return
+                wait = SHORT_WINDOW - now % SHORT_WINDOW
+            LOGGER.info(f"15 minute Strava quota used, waiting {wait:.0f}s")
+            self._wait(wait, check)
+
+    def _wait(self, seconds, check=None):
+        if check is None:
+            self.sleep(seconds)
+            return
+        while seconds > 0:
+            self.sleep(min(seconds, CHECK_INTERVAL))
+            seconds -= CHECK_INTERVAL
+            check()
+
+    def exhausted(self):
+        """Strava refused a request, so treat the current window as used up"""
+        with self._lock:
+            self._roll()
+            self._short_usage = max(self._short_usage, self.short_limit)
+
+    def _roll(self):
+        """Reset the counts when a new window starts, returning the time"""
+        now = self.clock()
+        windows = (now // SHORT_WINDOW, now // LONG_WINDOW)
+        if self._windows is not None:
+            if windows[1] != self._windows[1]:
+                self._long_usage = 0
+            if windows[0] != self._windows[0]:
+                self._short_usage = 0
+        self._windows = windows
+        return now
+
+
+def _shared(index):
+    """Attribute of a SharedQuotaScheduler kept in its shared array"""
+
+    def get(self):
+        return int(self._state[index])
+
+    def set(self, value):
+        self._state[index] = value
+
+    return property(get, set)
+
+
+class SharedQuotaScheduler(QuotaScheduler):
+    """QuotaScheduler whose counts are shared between processes
+
+    So a pool of processes together stay within the one app's quotas. Like
+    SharedRateLimiter, it must be created before the processes start and
+    passed to them as they do, e.g. in a pool's initargs.
+    """
+
+    _short_usage = _shared(0)
+    _long_usage = _shared(1)
+    short_limit = _shared(2)
+    long_limit = _shared(3)
+    requests = _shared(4)
+
+    def __init__(self, *args, **kwargs):
+        # Counts, limits, then the current windows (NaN before the first)
+        self._state = multiprocessing.Array("d", 7)
+        super().__init__(*args, **kwargs)
+        # Reentrant, and held by every process's threads in turn
+        self._lock = self._state.get_lock()
+
+    @property
+    def _windows(self):
+        if math.isnan(self._state[5]):
+            return None
+        return (self._state[5], self._state[6])
+
+    @_windows.setter
+    def _windows(self, windows):
+        self._state[5], self._state[6] = windows if windows is not None else (math.nan, math.nan)
+
+
+class ScheduledClient:
+    """stravalib Client whose API calls are paced by a QuotaScheduler
+
+    check is passed to the scheduler's acquire(). Other attributes are
+    passed through to the wrapped client.
+    """
+
+    PACED = ("explore_segments", "get_segment")
+
+    def __init__(self, client, scheduler=None, check=None):
+        self.client = client
+        self.scheduler = scheduler if scheduler is not None else QuotaScheduler()
+        self.check = check
+        protocol = getattr(client, "protocol", None)
+        if protocol is not None:
+            protocol.rate_limiter = self.scheduler
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name not in self.PACED:
+            return attr
+
+        def paced(*args, **kwargs):
+            from stravalib.exc import RateLimitExceeded
+
+            self.scheduler.acquire(self.check)
+            try:
+                return attr(*args, **kwargs)
+            except RateLimitExceeded:
+                LOGGER.warning(f"Strava rate limit hit calling {name}")
+                self.scheduler.exhausted()
+                self.scheduler.acquire(self.check)
+                return attr(*args, **kwargs)
+
+        return paced
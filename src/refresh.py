@@ -0,0 +1,76 @@
+""" Choosing which segments to refresh first, with a limited number of requests
+
+A leaderboard only changes when someone does the segment, so the chance it
+has changed since it was last checked grows with how often the segment is
+done and how long ago it was checked. effort_count stands in for how often,
+boosted for segments in busy areas, where more people are out.
+
+Segments are refreshed in tiers: those never retrieved first, then those
+retrieved before checked_at was recorded (ranked as if equally old), then
+the rest.
+"""
+import math
+import time
+
+# Segments starting in the same cell of this many degrees (about 1km) are
+# counted as in the same area
+CELL_SIZE = 0.01
+
+# Tiers of refresh_priority, most urgent first
+NEVER_RETRIEVED, NEVER_CHECKED, CHECKED = 2, 1, 0
+
+
+def _cell(segment):
+    start = segment.get("start_latlng")
+    if not start or len(start) != 2:
+        return None
+    return (math.floor(start[0] / CELL_SIZE), math.floor(start[1] / CELL_SIZE))
+
+
+def area_counts(segments):
+    """Number of segments starting in each cell"""
+    counts = {}
+    for segment in segments:
+        cell = _cell(segment)
+        if cell is not None:
+            counts[cell] = counts.get(cell, 0) + 1
+    return counts
+
+
+def refresh_priority(segment, now, neighbours=1):
+    """(tier, score) of how likely the segment's leaderboard has changed
+
+    Higher is more urgent. The score is proportional to the expected number
+    of efforts since the segment was checked, or per unit of time if when
+    isn't known. neighbours is the number of segments in its area.
+    """
+    if "fastest_athlete" not in segment:
+        return (NEVER_RETRIEVED, 0.0)
+    efforts = (segment.get("effort_count") or 0) + 1
+    rate = efforts * math.log2(1 + neighbours)
+    checked_at = segment.get("checked_at")
+    if checked_at is None:
+        return (NEVER_CHECKED, rate)
+    return (CHECKED, rate * max(now - checked_at, 0.0))
+
+
+def schedule_refresh(segments, budget=None, now=None):
+    """Segments in the order to refresh them, at most budget of them
+
+    Segments never retrieved come first, in their stored order, then the
+    rest by refresh_priority. Segments checked at now aren't included.
+    """
+    now = time.time() if now is None else now
+    counts = area_counts(segments)
+    priorities = [
+        refresh_priority(segment, now, counts.get(_cell(segment), 1))
+        for segment in segments
+    ]
+    order = sorted(
+        (i for i, priority in enumerate(priorities) if priority != (CHECKED, 0.0)),
+        key=lambda i: priorities[i],
+        reverse=True,
+    )
+    if budget is not None:
+        order = order[:budget]
+    return [segments[i] for i in order]
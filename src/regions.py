@@ -1,7 +1,11 @@
 """ For managing regions of segments """
-import json
 import sys
 import logging
+import threading
+from src.locking import RWLock
+from src.metrics import OPERATION_SECONDS, SAVE_BYTES
+from src.spatial import QuadTree, bounds_key
+from src.storage import SnapshotStore
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.DEBUG)
@@ -12,50 +16,113 @@ handler.setFormatter(formatter)
 LOGGER.addHandler(handler)
 
 
+def region_key(region):
+    """Key identifying a region record in storage"""
+    return bounds_key(region["bounds"])
+
+
 class RegionsData:
-    """Object to describe a region containing segments"""
+    """Object to describe a region containing segments
+
+    Like SegmentsData, changes take lock for writing and saves for reading.
+    """
 
-    def __init__(self, filename):
+    def __init__(self, filename, store=None):
+        self.lock = RWLock()
+        self._save_lock = threading.Lock()
         self.filename = filename
-        with open(self.filename, "r") as db_file:
-            self.data = json.load(db_file)
+        self.store = store if store is not None else SnapshotStore(filename)
+        self.data = self.store.load(region_key)
+        self._changed = {}
+
+    @property
+    def data(self):
+        """All regions, as stored in the DB"""
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        # Regions are looked up by a normalised bounds key, and explored
+        # regions are kept in a quadtree so coverage can be checked spatially
+        with self.lock.write():
+            self._data = data
+            self._regions = {}
+            self._explored = QuadTree()
+            for region in data:
+                if "bounds" in region:
+                    self._index_region(region)
+            # Replacing the list means everything must be written on the next save
+            self._changed = None
 
     def set_explored(self, bounds, is_explored):
         """Set region as explored"""
         LOGGER.info("Set region explored (%s): %s", is_explored, str(bounds))
-        self.get_region(bounds)["explored"] = True
+        with self.lock.write():
+            region = self.get_region(bounds)
+            if not region["explored"]:
+                self._explored.insert(region["bounds"], region)
+            region["explored"] = True
+            self._touch(region)
 
     def is_explored(self, bounds):
-        """Check if region is explored"""
-        return self.get_region(bounds)["explored"]
+        """Check if region is explored, or fully covered by explored regions"""
+        return self.get_region(bounds)["explored"] or self.is_covered(bounds)
+
+    def is_covered(self, bounds):
+        """Check if the union of explored regions covers bounds"""
+        return self._explored.covers(bounds)
 
     def init_region(self, bounds):
         """Initialise object for region"""
         region = {"bounds": bounds, "explored": False}
-        self.data.append(region)
+        with self.lock.write():
+            self.data.append(region)
+            self._index_region(region)
+            self._touch(region)
         return region
 
     def get_region(self, bounds):
         """Retrieve region from DB"""
-        region = next(
-            (
-                region
-                for region in self.data
-                if "bounds" in region and region["bounds"] == bounds
-            ),
-            None,
-        )
+        region = self._regions.get(bounds_key(bounds))
 
         if region is None:
-            region = self.init_region(bounds)
+            with self.lock.write():
+                # Another thread may have added it while waiting for the lock
+                region = self._regions.get(bounds_key(bounds))
+                if region is None:
+                    region = self.init_region(bounds)
 
         return region
 
+    def region_path(self, bounds):
+        """Quadtree path of the cell containing bounds"""
+        return self._explored.path(bounds)
+
+    def _touch(self, region):
+        if self._changed is not None:
+            self._changed[id(region)] = region
+
+    def _index_region(self, region):
+        self._regions.setdefault(bounds_key(region["bounds"]), region)
+        if region.get("explored"):
+            self._explored.insert(region["bounds"], region)
+
     def save(self):
         """Save all regions to DB"""
-        with open(self.filename, "w") as db_file:
-            json.dump(self.data, db_file, indent=4, sort_keys=True)
-            LOGGER.info(f"Saved {len(self.data)} regions to {self.filename}")
+        with self.lock.read():
+            with self._save_lock:
+                changed, self._changed = self._changed, {}
+            changed = None if changed is None else list(changed.values())
+            with OPERATION_SECONDS.time(operation="save_regions"):
+                written = self.store.save(self.data, changed)
+        if written is not None:
+            SAVE_BYTES.observe(written, data="regions")
+        LOGGER.info(f"Saved {len(self.data)} regions to {self.filename}")
+
+    def close(self):
+        """Save and flush storage, e.g. compacting any journal"""
+        self.save()
+        self.store.close(self.data)
 
     def display(self):
         """Get regions to display"""
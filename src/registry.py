@@ -0,0 +1,238 @@
+""" Segments and regions of each location, loaded once and shared by threads
+
+The web app handles requests on many threads, and jobs crawl in the
+background. Rather than each loading its own copy of a location's data,
+and overwriting each other's saves, they share one Dataset per location:
+
+with DATASETS.open("oxford") as dataset:
+    segments = dataset.segments.display_segments()
+
+Saves are coalesced: a save only marks what changed, and everything saved
+within flush_delay seconds is written together by a CoalescingStore.
+"""
+import sys
+import logging
+import threading
+from contextlib import contextmanager
+from src.metrics import SAVE_BYTES
+from src.page_cache import data_version
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+LOGGER.addHandler(handler)
+
+
+class CoalescingStore:
+    """Store wrapper merging the saves made within delay seconds into one write
+
+    The write happens on a timer thread, holding lock (the data's RWLock)
+    for reading so the records can't change while they are serialised.
+    Storage backends write atomically, so readers of the files never see a
+    partial save. on_write is called after each write, including those the
+    store finishes later, such as a JournalStore's background compaction.
+    """
+
+    def __init__(self, store, lock, delay=2.0, name="data", on_write=None):
+        self.store = store
+        self.filename = store.filename
+        self.lock = lock
+        self.delay = delay
+        self.name = name
+        self.on_write = on_write
+        if on_write is not None and hasattr(store, "on_compacted"):
+            store.on_compacted = on_write
+        self.saves = 0
+        self.writes = 0
+        self._data = None
+        self._changed = {}
+        self._timer = None
+        self._mutex = threading.Lock()
+        # Only one write at a time, so they reach the store in order
+        self._write_lock = threading.Lock()
+
+    def load(self, key):
+        return self.store.load(key)
+
+    def query_bbox(self, bounds):
+        # Only used before the data is loaded, so nothing is waiting to be written
+        return self.store.query_bbox(bounds)
+
+    def save(self, data, changed=None):
+        with self._mutex:
+            self.saves += 1
+            if changed is None or self._changed is None:
+                # Everything is written, which covers any changes
+                self._changed = None
+            else:
+                for record in changed:
+                    self._changed[id(record)] = record
+            self._data = data
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        # Nothing has been written yet
+        return None
+
+    @property
+    def pending(self):
+        """Whether saves, or the store's own background writes, are unwritten"""
+        with self._mutex:
+            if self._data is not None:
+                return True
+        return getattr(self.store, "compacting", False)
+
+    def flush(self):
+        """Write anything saved since the last write"""
+        with self._write_lock:
+            with self._mutex:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                data, self._data = self._data, None
+                changed, self._changed = self._changed, {}
+            if data is None:
+                return
+            with self.lock.read():
+                written = self.store.save(
+                    data, None if changed is None else list(changed.values())
+                )
+            self.writes += 1
+            if written is not None:
+                SAVE_BYTES.observe(written, data=self.name)
+            if self.on_write is not None:
+                self.on_write()
+
+    def close(self, data):
+        self.flush()
+        with self.lock.read():
+            self.store.close(data)
+
+
+class Dataset:
+    """A location's segments, and its regions once they are first used"""
+
+    def __init__(self, location, path, load_segments, load_regions, flush_delay):
+        self.location = location
+        self._path = path
+        self._load_regions = load_regions
+        self._flush_delay = flush_delay
+        self._regions = None
+        self._lock = threading.Lock()
+        self.users = 0
+
+        segments_path = path(location, "segments")
+        self.loaded_version = data_version(segments_path)[0]
+        self.file_version = self.loaded_version
+        self.segments = load_segments(segments_path)
+        self._coalesce(self.segments, "segments")
+
+    @property
+    def regions(self):
+        with self._lock:
+            if self._regions is None:
+                self._regions = self._load_regions(self._path(self.location, "regions"))
+                self._coalesce(self._regions, "regions")
+            return self._regions
+
+    @property
+    def version(self):
+        """Changes whenever the segments do, including across restarts"""
+        return (self.loaded_version, self.segments.version)
+
+    @property
+    def pending(self):
+        """Whether any saves haven't been written yet"""
+        stores = [self.segments.store]
+        if self._regions is not None:
+            stores.append(self._regions.store)
+        return any(store.pending for store in stores)
+
+    def changed_on_disk(self):
+        """Whether the segment files were changed by something else, e.g. run.py"""
+        return data_version(self._path(self.location, "segments"))[0] != self.file_version
+
+    def flush(self):
+        self.segments.store.flush()
+        if self._regions is not None:
+            self._regions.store.flush()
+
+    def _coalesce(self, data, name):
+        def on_write():
+            if name == "segments":
+                self.file_version = data_version(data.filename)[0]
+
+        data.store = CoalescingStore(
+            data.store,
+            data.lock,
+            delay=self._flush_delay,
+            name=name,
+            on_write=on_write,
+        )
+
+
+class DatasetRegistry:
+    """One Dataset per location, shared by every thread in the process
+
+    load_segments and load_regions load SegmentsData and RegionsData from a
+    path, which path(location, filetype) gives. A dataset is reloaded if its
+    files are changed by another process, once no thread is using it.
+    """
+
+    def __init__(self, path, load_segments, load_regions, flush_delay=2.0):
+        self.path = path
+        self.load_segments = load_segments
+        self.load_regions = load_regions
+        self.flush_delay = flush_delay
+        self._datasets = {}
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def open(self, location):
+        """The location's dataset, kept loaded while the with block runs"""
+        dataset = self._acquire(location)
+        try:
+            yield dataset
+        finally:
+            with self._lock:
+                dataset.users -= 1
+
+    def _acquire(self, location):
+        with self._lock:
+            loading = self._loading.setdefault(location, threading.Lock())
+        # Only one thread loads a location, the others wait for it
+        with loading:
+            with self._lock:
+                dataset = self._datasets.get(location)
+                if dataset is not None:
+                    if dataset.users or dataset.pending or not dataset.changed_on_disk():
+                        dataset.users += 1
+                        return dataset
+                    LOGGER.info(f"Reloading {location}, changed on disk")
+                    del self._datasets[location]
+
+            dataset = Dataset(
+                location, self.path, self.load_segments, self.load_regions, self.flush_delay
+            )
+            with self._lock:
+                self._datasets[location] = dataset
+                dataset.users += 1
+            return dataset
+
+    def flush(self):
+        """Write every dataset's outstanding saves"""
+        with self._lock:
+            datasets = list(self._datasets.values())
+        for dataset in datasets:
+            dataset.flush()
+
+    def clear(self):
+        """Write outstanding saves and forget every dataset"""
+        self.flush()
+        with self._lock:
+            self._datasets.clear()
@@ -1,21 +1,319 @@
 #!/usr/bin/env /home/parkinsonjl/code/strava-segments/.venv2/bin/python
 """ Script to retrieve fastest times for segments
 
-Use --r option to force reparsing all segments, otherwise 
+Use --r option to force reparsing all segments, otherwise
 just retrieve times for those segments which don't currently have them
 ./run.py oxford --r
+
+Use --workers to fetch several segment pages at once, politely rate limited
+to --rate requests per second:
+./run.py oxford --r --workers 8 --rate 4
+
+Pages are cached in --cache-dir; pages younger than --cache-ttl seconds are
+not fetched again, and older ones are revalidated with the server. Once a
+page's leaderboard has been parsed, the rest is only read if the page is
+under --drain-limit bytes, to reuse the connection; 0 always closes it.
+
+Use --budget to refresh at most that many segments, those whose leaderboards
+are most likely to have changed first, and --stats to also refresh their
+effort counts from the API (needs STRAVA_ACCESS_TOKEN):
+./run.py oxford --budget 500 --stats
+
+Use --profile to write a sampling profile of the run, as flame graph stacks,
+to --profile-dir (default $PROFILE_DIR or .cache/profiles):
+./run.py oxford --profile
+
+Use --all to refresh every location under data/, spread over --processes
+processes which share the --rate budget, and with --stats the Strava API
+quotas. Locations being refreshed by another run are skipped:
+./run.py --all --processes 4 --workers 4 --rate 8
+
+A summary of request counts, latencies and cache hit rates is logged at the end.
 """
 import argparse
-from src.segment_crawler import SegmentsData, retrieve_fastest_times
+import os
+import sys
+import time
+import queue
+import logging
+import multiprocessing
+from contextlib import ExitStack
+from stravalib.client import Client
+from src.fetcher import DRAIN_LIMIT, configure_fetcher
+from src.locking import LockHeld, file_lock
+from src.metrics import REGISTRY, log_summary
+from src.profiling import profile
+from src.quota import QuotaScheduler, ScheduledClient, SharedQuotaScheduler
+from src.segment_crawler import SegmentsData, retrieve_fastest_times, segment_bounds
+from src.storage import open_store
+from src.throttle import HostRateLimiter, SharedRateLimiter
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+LOGGER.addHandler(handler)
+
+LOCK_FILENAME = "run.lock"
+
+# Set in each batch worker process by init_worker
+_RATE_LIMITER = None
+_PROGRESS = None
+_QUOTA = None
+_WORKER_PIDS = None
+
+
+def find_locations(data_dir):
+    """Locations with segments under data_dir"""
+    return sorted(
+        name
+        for name in os.listdir(data_dir)
+        if os.path.exists(os.path.join(data_dir, name, "segments.json"))
+    )
+
+
+def make_client(quota=None):
+    """Strava API client, paced by quota (a QuotaScheduler) to stay within the rate limits"""
+    token = os.getenv("STRAVA_ACCESS_TOKEN")
+    if not token:
+        raise ValueError("STRAVA_ACCESS_TOKEN must be set to refresh segment stats")
+    return ScheduledClient(Client(access_token=token), quota or QuotaScheduler())
+
+
+def refresh_location(location, args, rate_limiter, progress=None, quota=None):
+    """Retrieve fastest times for a location, returning a report of the run
+
+    Holds the location's lock file while running, so only one run at a time
+    updates a location. progress, if given, is called with the location and
+    counts of work done. quota paces API calls with --stats, e.g. a
+    SharedQuotaScheduler shared with other processes. With args.profile, the
+    run is profiled.
+    """
+    data_dir = args.data_dir
+    fetcher = configure_fetcher(cache_dir=args.cache_dir, ttl=args.cache_ttl,
+                                pool_size=max(args.workers, 1), drain_limit=args.drain_limit)
+    counts = {"pages_total": 0, "pages_done": 0}
+
+    def report(**increments):
+        for name, amount in increments.items():
+            counts[name] = counts.get(name, 0) + amount
+        if progress is not None:
+            progress(location, increments)
+
+    start = time.time()
+    result = {"location": location, "status": "done"}
+    profiler = None
+    try:
+        with ExitStack() as stack:
+            if args.profile:
+                profiler = stack.enter_context(profile(f"run-{location}", args.profile_dir))
+            stack.enter_context(file_lock(os.path.join(data_dir, location, LOCK_FILENAME)))
+            filename = os.path.join(data_dir, location, "segments.json")
+            client = make_client(quota) if args.stats else None
+            segments = SegmentsData(filename=filename, client=client, store=open_store(filename, bounds=segment_bounds))
+            try:
+                retrieve_fastest_times(segments, args.reparse, workers=args.workers,
+                                       rate_limiter=rate_limiter, progress=report,
+                                       budget=args.budget, refresh_stats=args.stats)
+            finally:
+                segments.close()
+    except LockHeld:
+        result["status"] = "locked"
+    except Exception as e:
+        LOGGER.exception(f"Refreshing {location} failed")
+        result["status"] = f"failed: {e}"
+    result.update(counts, seconds=time.time() - start, pages=dict(fetcher.stats))
+    if profiler is not None:
+        result["profile"] = profiler.filename
+    fetcher.log_stats()
+    return result
+
+
+def init_worker(rate_limiter, progress_queue, quota=None, worker_pids=None):
+    global _RATE_LIMITER, _PROGRESS, _QUOTA, _WORKER_PIDS
+    _RATE_LIMITER = rate_limiter
+    _PROGRESS = progress_queue
+    _QUOTA = quota
+    _WORKER_PIDS = worker_pids
 
-if __name__ == "__main__":
 
+def refresh_in_worker(location, args, index=None):
+    """refresh_location in a pool worker, adding a snapshot of its metrics
+
+    Progress goes through the queue, ending with (location, None). As the
+    queue keeps each process's messages in order, once that arrives every
+    message about the location has been read. The worker's pid is stored at
+    index of the shared worker pids, so run_batch can tell if it dies.
+    """
+    if _WORKER_PIDS is not None and index is not None:
+        # Shared memory rather than the queue, which could lose it if we die
+        _WORKER_PIDS[index] = os.getpid()
+
+    def progress(location, increments):
+        _PROGRESS.put((location, increments))
+
+    # Each location's result carries only its own metrics
+    REGISTRY.reset()
+    try:
+        result = refresh_location(location, args, _RATE_LIMITER, progress, _QUOTA)
+        result["metrics"] = REGISTRY.snapshot()
+        return result
+    finally:
+        _PROGRESS.put((location, None))
+
+
+def merge_progress(progress, location, increments):
+    counts = progress.setdefault(location, {"pages_total": 0, "pages_done": 0})
+    for name, amount in increments.items():
+        counts[name] = counts.get(name, 0) + amount
+
+
+def check_workers(locations, worker_pids, results, finished):
+    """Fail the locations whose worker process died, e.g. killed for using
+    too much memory, as the pool never completes their tasks"""
+    alive = {process.pid for process in multiprocessing.active_children()}
+    for location, pid in zip(locations, worker_pids[:]):
+        if pid and location not in finished and pid not in alive:
+            LOGGER.error(f"Worker refreshing {location} exited")
+            results.setdefault(location, {"location": location, "status": "failed: worker exited"})
+            finished.add(location)
+
+
+def log_progress(progress, finished, locations):
+    total = sum(counts["pages_total"] for counts in progress.values())
+    done = sum(counts["pages_done"] for counts in progress.values())
+    LOGGER.info(
+        f"{finished}/{len(locations)} locations finished, "
+        f"{done}/{total} segments refreshed"
+    )
+
+
+def collect_results(pending, results, finished):
+    """Add the results of pending pool tasks which are ready, merging their metrics"""
+    for location, pending_result in pending.items():
+        if location not in results and pending_result.ready():
+            try:
+                results[location] = pending_result.get()
+                REGISTRY.merge(results[location].pop("metrics", {}))
+            except Exception as e:
+                results[location] = {"location": location, "status": f"failed: {e}"}
+                # It may have failed before sending any progress
+                finished.add(location)
+
+
+def run_batch(locations, args, report_interval=10.0):
+    """Refresh locations in a pool of processes, returning their reports
+
+    Progress of every location is merged into one log line every
+    report_interval seconds, and each location's metrics into this
+    process's. The progress queue is read until every location's last
+    message, so no worker is left unable to exit with messages unsent. A
+    location whose worker process dies is reported as failed.
+    """
+    rate_limiter = SharedRateLimiter(args.rate)
+    # The API quotas are per app, so every process counts against the same ones
+    quota = SharedQuotaScheduler() if args.stats else None
+    progress_queue = multiprocessing.Queue()
+    progress = {}
+    # The pid of the worker process refreshing each location, once started
+    worker_pids = multiprocessing.Array("i", len(locations))
+    pool = multiprocessing.Pool(
+        min(args.processes, len(locations)) or 1,
+        initializer=init_worker,
+        initargs=(rate_limiter, progress_queue, quota, worker_pids),
+    )
+    pending = {}
+    try:
+        pending = {
+            location: pool.apply_async(refresh_in_worker, (location, args, index))
+            for index, location in enumerate(locations)
+        }
+        results = {}
+        finished = set()
+        last_report = time.time()
+        while len(results) < len(locations) or len(finished) < len(locations):
+            try:
+                location, increments = progress_queue.get(timeout=0.5)
+                if increments is None:
+                    finished.add(location)
+                else:
+                    merge_progress(progress, location, increments)
+            except queue.Empty:
+                pass
+            collect_results(pending, results, finished)
+            check_workers(locations, worker_pids, results, finished)
+            if time.time() - last_report >= report_interval:
+                log_progress(progress, len(results), locations)
+                last_report = time.time()
+    finally:
+        if all(pending_result.ready() for pending_result in pending.values()):
+            pool.close()
+        else:
+            # The pool waits for tasks lost with a dead worker, so stop it
+            pool.terminate()
+        pool.join()
+    return [results[location] for location in locations]
+
+
+def log_report(results):
+    """Log a line per location, and the totals"""
+    for result in results:
+        pages = result.get("pages", {})
+        LOGGER.info(
+            f"{result['location']}: {result['status']}, "
+            f"{result.get('pages_done', 0)}/{result.get('pages_total', 0)} segments in "
+            f"{result.get('seconds', 0):.0f}s ({pages.get('downloaded', 0)} pages "
+            f"downloaded, {pages.get('hits', 0)} cached)"
+        )
+    done = [result for result in results if result["status"] == "done"]
+    LOGGER.info(
+        f"{len(done)}/{len(results)} locations refreshed, "
+        f"{sum(result.get('pages_done', 0) for result in results)} segments"
+    )
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description='Process some integers.')
     parser.add_argument('location', type=str, nargs="?", default="oxford", help='Location')
     parser.add_argument('--r', default=False, dest='reparse', action='store_true',
                         help='To reparse all segments')
-    args = parser.parse_args()
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of segment pages to fetch concurrently')
+    parser.add_argument('--rate', type=float, default=4.0,
+                        help='Maximum requests per second to strava.com')
+    parser.add_argument('--cache-dir', type=str, default='.cache/pages',
+                        help='Directory to cache segment pages in')
+    parser.add_argument('--cache-ttl', type=float, default=24 * 60 * 60,
+                        help='Seconds before a cached page is revalidated')
+    parser.add_argument('--drain-limit', type=int, default=DRAIN_LIMIT,
+                        help='Bytes of a page to read after its leaderboard, to reuse the connection')
+    parser.add_argument('--budget', type=int, default=None,
+                        help='Refresh at most this many segments of each location, '
+                             'most likely changed first')
+    parser.add_argument('--stats', default=False, action='store_true',
+                        help='Also refresh effort counts through the API')
+    parser.add_argument('--data-dir', type=str, default='data',
+                        help='Directory holding a directory of data for each location')
+    parser.add_argument('--profile', default=False, action='store_true',
+                        help='Write a sampling profile of each location refreshed')
+    parser.add_argument('--profile-dir', type=str, default=None,
+                        help='Directory to write profiles to (default $PROFILE_DIR)')
+    parser.add_argument('--all', default=False, action='store_true',
+                        help='Refresh every location in the data directory')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                        help='Number of locations to refresh at once with --all')
+    args = parser.parse_args(argv)
+
+    if args.all:
+        results = run_batch(find_locations(args.data_dir), args)
+    else:
+        results = [refresh_location(args.location, args, HostRateLimiter(args.rate))]
+    log_summary()
+    log_report(results)
+    return 0 if all(result["status"] == "done" for result in results) else 1
 
-    segments = SegmentsData(filename=f"data/{args.location}/segments.json")
-    retrieve_fastest_times(segments, args.reparse)
-    segments.save()
+
+if __name__ == "__main__":
+    sys.exit(main())
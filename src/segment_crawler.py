@@ -1,13 +1,33 @@
-import json
 import sys
-from urllib.request import urlopen
-from bs4 import BeautifulSoup
-from datetime import datetime, timedelta
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
 import logging
 import re
-import matplotlib as mpl
-import matplotlib.cm as cm
-from stravalib.model import Segment
+from collections.abc import Sequence
+from contextlib import contextmanager
+from src.colours import pace_colours
+from src.columnar import SegmentColumns
+from src.crawl_state import CrawlState
+from src.details import DetailPipeline
+from src.fetcher import get_fetcher
+from src.leaderboard import LeaderboardParser, parse_leader
+from src.locking import RWLock
+from src.metrics import (
+    API_CALLS,
+    CACHE_REQUESTS,
+    CRAWL_MAX_ZOOM,
+    OPERATION_SECONDS,
+    SAVE_BYTES,
+)
+from src.polyline import polyline_bounds
+from src.refresh import schedule_refresh
+from src.spatial import QuadTree, record_bounds
+from src.storage import SnapshotStore
+from src.throttle import with_retries
+
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.DEBUG)
@@ -18,105 +38,464 @@ handler.setFormatter(formatter)
 LOGGER.addHandler(handler)
 
 
+def segment_key(segment):
+    """Key identifying a segment record in storage"""
+    return segment.get("id")
+
+
+STRAVA_URL = "https://www.strava.com"
+
+
+def parse_time(text):
+    """Convert a leaderboard time such as 4:05, 1:02:03 or 45s into seconds"""
+    if re.match(r"^\d+:\d+$", text):
+        minutes, seconds = text.split(":")
+        return int(minutes) * 60 + int(seconds)
+    elif re.match(r"^\d+:\d+:\d+$", text):
+        hours, minutes, seconds = text.split(":")
+        return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+    elif re.match(r"^\d+s$", text):
+        return int(text[:-1])
+    raise Exception("Unknown time format: %s" % text)
+
+
+def fastest_seconds(segment):
+    """Fastest time of a segment in seconds, or NaN if it hasn't been retrieved"""
+    if "fastest_seconds" in segment:
+        return segment["fastest_seconds"]
+    if "fastest_time" in segment:
+        return parse_time(segment["fastest_time"])
+    return float("nan")
+
+
+def segment_bounds(segment):
+    """Bounding box of a segment's route, or of its start and end without one"""
+    if segment.get("polyline"):
+        try:
+            return polyline_bounds(segment["polyline"])
+        except IndexError:
+            LOGGER.warning(f"Invalid polyline for segment {segment.get('id')}")
+    return record_bounds(segment)
+
+
+def in_range(value, low=None, high=None):
+    """Check low <= value <= high, where None means unbounded"""
+    if value is None or value != value:
+        return low is None and high is None
+    return (low is None or value >= low) and (high is None or value <= high)
+
+
 class SegmentsData:
+    """Segment records, and saving them to a store
+
+    data is normally a list of dicts, but can be given instead, e.g. as
+    SegmentColumns loaded from a memory-mapped snapshot. Stores with a
+    spatial index (SqliteStore) are only loaded in full once every segment
+    is needed; until then query() with bounds reads just those segments.
+
+    Changes take lock for writing and display, queries and saves take it for
+    reading, so one SegmentsData can be shared between threads. Records
+    should be modified through update(), not directly, when shared.
+    """
 
-    def __init__(self, filename, client=None):
+    def __init__(self, filename, client=None, store=None, details=None, data=None):
+        self.lock = RWLock()
+        self._save_lock = threading.Lock()
         self.client = client
         self.filename = filename
-        with open(self.filename, "r") as f:
-            self.data = json.load(f)
+        self.store = store if store is not None else SnapshotStore(filename)
+        self.details = details if details is not None else DetailPipeline(client)
+        self._load_lock = threading.Lock()
+        self._data = None
+        self._version = 0
+        self._display = None
+        self._spatial = None
+        if data is None and not hasattr(self.store, "query_bbox"):
+            data = self.store.load(segment_key)
+        if data is not None:
+            self.data = data
+        self._changed = {}
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._load()
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        index = index_segments(data)
+        with self.lock.write():
+            self._data = data
+            self._by_id = index
+            # Replacing the list means everything must be written on the next save
+            self._changed = None
+            self._version = getattr(self, "_version", 0) + 1
+            self._display = None
+            self._spatial = None
+
+    @property
+    def loaded(self):
+        """Whether every segment has been read from the store"""
+        return self._data is not None
+
+    def _load(self):
+        # Loading doesn't change the segments, so neither the version nor
+        # what the next save writes change
+        with self._load_lock:
+            if self._data is None:
+                data = self.store.load(segment_key)
+                self._by_id = index_segments(data)
+                self._data = data
+
+    @property
+    def _index(self):
+        if self._data is None:
+            self._load()
+        return self._by_id
+
+    @property
+    def version(self):
+        """Number which changes whenever the segments do"""
+        return self._version
 
     def get_segment(self, id):
-        return next((seg for seg in self.data if "id" in seg and seg["id"] == id), None)
+        return self._index.get(id)
 
     def segment_exists(self, id) -> bool:
-        return self.get_segment(id) is not None
+        return id in self._index
 
     def add_segment(self, segment):
-        self.data.append(segment)
+        with self.lock.write():
+            self.data.append(segment)
+            if "id" in segment:
+                self._index.setdefault(segment["id"], segment)
+            self.touch(segment)
+
+    def upsert_segments(self, segments):
+        """Add new segments, or update the stored record for ids already present"""
+        with self.lock.write():
+            for segment in segments:
+                existing = self._index.get(segment.get("id"))
+                if existing is None:
+                    self.add_segment(segment)
+                else:
+                    self.update(existing, **segment)
+
+    def update(self, segment, **fields):
+        """Set fields of a stored segment"""
+        with self.lock.write():
+            segment.update(fields)
+            self.touch(segment)
+
+    def touch(self, segment):
+        """Mark a segment as modified, so it is written on the next save"""
+        with self.lock.write():
+            self._version += 1
+            if self._changed is not None:
+                self._changed[id(segment)] = segment
+
+    def records(self):
+        """data as a list of dicts"""
+        if isinstance(self.data, SegmentColumns):
+            return self.data.to_records()
+        return self.data
 
     def save(self):
-        with open(self.filename, "w") as f:
-            json.dump(self.data, f, indent=4, sort_keys=True)
-            LOGGER.info(f"Saved {len(self.data)} segments to {self.filename}")
-
-    def save_segments(self, retrieved_segments):
-        for segment in retrieved_segments:
-            if self.segment_exists(segment.id):
-                continue
-            seg_details = self.client.get_segment(segment.id)  # type: Segment
-            key_details = {
-                "id": seg_details.id,
-                "name": seg_details.name,
-                "distance": float(seg_details.distance),
-                "avg_grade": float(seg_details.average_grade),
-                "climb": float(seg_details.total_elevation_gain),
-                "effort_count": int(seg_details.effort_count),
-                "start_latlng": seg_details.start_latlng,
-                "end_latlng": seg_details.end_latlng,
-                "polyline": seg_details.map.polyline,
-            }
-
-            self.add_segment(key_details)
+        if not self.loaded:
+            # Nothing can have changed
+            return
+        with self.lock.read():
+            # Saves can run concurrently with each other, but not with changes
+            with self._save_lock:
+                changed, self._changed = self._changed, {}
+            changed = None if changed is None else list(changed.values())
+            if changed is not None and isinstance(self._data, SegmentColumns):
+                changed = [dict(segment) for segment in changed]
+            with OPERATION_SECONDS.time(operation="save_segments"):
+                written = self.store.save(self.records(), changed)
+        # Stores which defer writing, e.g. a CoalescingStore, report None
+        if written is not None:
+            SAVE_BYTES.observe(written, data="segments")
+        LOGGER.info(f"Saved {len(self.data)} segments to {self.filename}")
+
+    def close(self):
+        """Save and flush storage, e.g. compacting any journal"""
+        self.save()
+        if self.loaded:
+            self.store.close(self.records())
+        self.details.close()
+
+    def prefetch(self, retrieved_segments):
+        """Start fetching details of new segments in the background"""
+        self.prefetch_ids([seg.id for seg in retrieved_segments])
+
+    def prefetch_ids(self, ids, details=None):
+        details = details if details is not None else self.details
+        details.submit(id for id in ids if not self.segment_exists(id))
+
+    def save_segments(self, retrieved_segments, details=None):
+        self.save_segment_ids([seg.id for seg in retrieved_segments], details)
+
+    def save_segment_ids(self, ids, details=None):
+        """Fetch details of, and add, the segments in ids which aren't stored
+
+        details is the DetailPipeline to fetch with, by default self.details.
+        """
+        details = details if details is not None else self.details
+        new_ids = [id for id in ids if not self.segment_exists(id)]
+        for segment in details.fetch(new_ids):
+            self.add_segment(segment)
 
     def fill_polyline(self):
         to_fill = [
             seg for seg in self.data if "polyline" not in seg or seg["polyline"] is None
         ]
-        n = 0
         LOGGER.info(f"Polyline to fill: {len(to_fill)}")
-        for segment in to_fill:
-            seg_details = self.client.get_segment(segment["id"])  # type: Segment
-            segment["polyline"] = seg_details.map.polyline
-            n += 1
+        ids = [seg["id"] for seg in to_fill]
+        details = {d["id"]: d for d in self.details.fetch(ids)}
+        # Cached details may predate polylines being stored, so fetch those again
+        missing = [id for id in ids if details[id]["polyline"] is None]
+        details.update((d["id"], d) for d in self.details.fetch(missing, refresh=True))
+
+        for n, segment in enumerate(to_fill, 1):
+            self.update(segment, polyline=details[segment["id"]]["polyline"])
             LOGGER.info(f"Process {n}/{len(to_fill)}")
-            self.save()
+        self.save()
 
     def display_segments(self, sort_by="fastest_pace"):
+        """Segments with url, pace and colour added, sorted by sort_by (descending)
+
+        Derived fields are computed for all segments at once and cached until
+        the data changes. The stored records are not modified. For
+        SegmentColumns, a read-only DisplayedColumns sequence is returned.
+        """
+        with self.lock.read():
+            key = (self._version, sort_by)
+            display = self._display
+            if display is None or display[0] != key:
+                CACHE_REQUESTS.inc(cache="display", result="miss")
+                with OPERATION_SECONDS.time(operation="display_segments"):
+                    display = self._display = (key, self._compute_display(sort_by))
+            else:
+                CACHE_REQUESTS.inc(cache="display", result="hit")
+            if isinstance(display[1], DisplayedColumns):
+                # Read only, so shared rather than copied
+                return display[1]
+            return list(display[1])
+
+    def query(self, bounds=None, filters=None, offset=0, limit=None):
+        """Displayed segments intersecting bounds, filtered and paged
+
+        filters maps a displayed field, e.g. distance, avg_grade or
+        fastest_pace, to a (min, max) range where either end may be None.
+        Returns the number of matching segments and the page of them from
+        offset, in the order of display_segments.
+        """
+        if bounds is not None and not self.loaded:
+            # Only the segments in bounds are read, through the store's index
+            displayed = display_records(self.store.query_bbox(bounds))
+            positions = range(len(displayed))
+        else:
+            with self.lock.read():
+                displayed, index = self._spatial_index()
+            if bounds is None:
+                positions = range(len(displayed))
+            else:
+                positions = sorted(index.query(bounds))
+
+        matching = []
+        for i in positions:
+            # Displayed columns build the segment on each access, so only once
+            segment = displayed[i]
+            if all(
+                in_range(segment.get(field), *limits)
+                for field, limits in (filters or {}).items()
+            ):
+                matching.append(segment)
+        end = None if limit is None else offset + limit
+        return len(matching), [dict(segment) for segment in matching[offset:end]]
+
+    def _spatial_index(self):
+        """Displayed segments and a QuadTree of their positions by route bounds
+
+        Built on first use and kept until the data changes.
+        """
+        spatial = self._spatial
+        if spatial is None or spatial[0] != self._version:
+            version = self._version
+            displayed = self.display_segments()
+            index = QuadTree()
+            for position, segment in enumerate(displayed):
+                bounds = segment_bounds(segment)
+                if bounds is not None:
+                    index.insert(bounds, position)
+            spatial = self._spatial = (version, displayed, index)
+        return spatial[1], spatial[2]
+
+    def _compute_display(self, sort_by):
+        if isinstance(self.data, SegmentColumns):
+            return self._compute_display_columns(sort_by)
+        return display_records(self.data, sort_by)
+
+    def _compute_display_columns(self, sort_by):
+        """display for SegmentColumns, computed from the column arrays
+
+        Only the derived pace, colour and order are kept, and records are
+        displayed when accessed, so the columns are never copied.
+        """
+        import numpy as np
+
+        seconds = self.data.column("fastest_seconds")
+        # Older records only have the time as text
+        for i in np.flatnonzero(np.isnan(seconds)):
+            seconds[i] = fastest_seconds(self.data[i])
+        distance = self.data.column("distance")
+        pace = np.round((seconds / 60.0) / (distance / 1000.0), 1)
+        colours = pace_colours(pace)
+
+        if sort_by == "fastest_pace":
+            values = pace
+        else:
+            try:
+                values = self.data.column(sort_by)
+            except KeyError:
+                values = np.array(
+                    [seg.get(sort_by, float("nan")) for seg in self.data], dtype=float
+                )
+            if sort_by == "climb":
+                values = np.round(values, 2)
+        order = np.argsort(-values, kind="stable")
+        return DisplayedColumns(self.data, order, pace, colours)
 
-        for segment in self.data:
 
-            segment["url"] = (
-                f"https://www.strava.com/segments/{segment['id']}"
-                if "id" in segment
-                else "#"
-            )
+def index_segments(data):
+    """id -> record index of segments, so lookups are O(1)
 
-            if "fastest_time" in segment:
-                if re.match(r"^\d+:\d+$", segment["fastest_time"]):
-                    t = datetime.strptime(segment["fastest_time"], "%M:%S")
-                elif re.match(r"^\d+:\d+:\d+$", segment["fastest_time"]):
-                    t = datetime.strptime(segment["fastest_time"], "%H:%M:%S")
-                elif re.match(r"^\d+s$", segment["fastest_time"]):
-                    t = datetime.strptime(segment["fastest_time"][:-1], "%S")
-                else:
-                    raise Exception("Unknown time format: %s" % segment["fastest_time"])
-                delta = timedelta(minutes=t.minute, seconds=t.second)
-                segment["fastest_pace"] = round(
-                    (delta.total_seconds() / 60.0) / (segment["distance"] / 1000.0), 1
-                )
-            else:
-                segment["fastest_pace"] = float('NaN')
+    Only the first record for each id is indexed, matching a linear scan.
+    """
+    index = {}
+    for seg in data:
+        if "id" in seg:
+            index.setdefault(seg["id"], seg)
+    return index
 
-            segment["climb"] = round(segment["climb"], 2)
 
-            norm = mpl.colors.Normalize(vmin=2.5, vmax=4.5)
-            cmap = cm.viridis_r
-            # cmap = cm.coolwarm
-            m = cm.ScalarMappable(norm=norm, cmap=cmap)
-            rgb = m.to_rgba(segment["fastest_pace"])
-            segment["colour"] = mpl.colors.to_hex(rgb)
+def display_records(segments, sort_by="fastest_pace"):
+    """segments with url, pace and colour added, sorted by sort_by (descending)"""
+    import numpy as np
 
-        self.data.sort(key=lambda x: x["fastest_pace"], reverse=True)
-        return self.data
+    seconds = np.array([fastest_seconds(seg) for seg in segments], dtype=float)
+    distance = np.array([seg["distance"] for seg in segments], dtype=float)
+    pace = np.round((seconds / 60.0) / (distance / 1000.0), 1)
+    colours = pace_colours(pace)
+
+    displayed = [
+        display_record(segment, segment_pace, colour)
+        for segment, segment_pace, colour in zip(segments, pace.tolist(), colours)
+    ]
+
+    if sort_by == "fastest_pace":
+        values = pace
+    else:
+        values = np.array(
+            [seg.get(sort_by, float("nan")) for seg in displayed], dtype=float
+        )
+    # Descending, with missing values last
+    order = np.argsort(-values, kind="stable")
+    return [displayed[i] for i in order]
+
+
+def display_record(segment, pace, colour):
+    """A segment with url, pace and colour added, as displayed"""
+    return dict(
+        segment,
+        url=(
+            f"https://www.strava.com/segments/{segment['id']}"
+            if "id" in segment
+            else "#"
+        ),
+        fastest_pace=pace,
+        climb=round(segment["climb"], 2),
+        colour=colour,
+    )
+
+
+class DisplayedColumns(Sequence):
+    """Displayed segments of SegmentColumns, in order
+
+    Each displayed segment is built from the columns when accessed, so the
+    display cache holds only the pace, colour and order arrays rather than
+    a copy of every record.
+    """
+
+    def __init__(self, columns, order, pace, colours):
+        self._columns = columns
+        self._order = order
+        self._pace = pace
+        self._colours = colours
+
+    def __len__(self):
+        return len(self._order)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+        index = int(self._order[position])
+        return display_record(
+            self._columns[index], float(self._pace[index]), self._colours[index]
+        )
 
 
 class SegmentCrawler:
-    def __init__(self, client, segments_db, regions_db, max_zoom=5):
+    def __init__(
+        self,
+        client,
+        segments_db,
+        regions_db,
+        max_zoom=5,
+        workers=4,
+        progress=None,
+        splitter=None,
+        details=None,
+    ):
         self.client = client
         self.segments_db = segments_db
+        # Fetches details of new segments, by default the segments_db's own
+        self.details = details if details is not None else segments_db.details
         self.regions_db = regions_db
         self.max_zoom = max_zoom
+        self.workers = workers
+        # Called with counts of work done, e.g. a Job's report
+        self.progress = progress
+        # Splits a region with too many segments, e.g. a MedianSplitter
+        self.splitter = splitter if splitter is not None else split_box
+        self.stats = {"explore_calls": 0, "segments_added": 0}
+
+    def _report(self, **increments):
+        if self.progress is not None:
+            self.progress(**increments)
+
+    def calls_per_segment(self):
+        """explore_segments calls made for each new segment found"""
+        if not self.stats["segments_added"]:
+            return float("nan")
+        return self.stats["explore_calls"] / self.stats["segments_added"]
+
+    def log_stats(self):
+        LOGGER.info(
+            f"{self.stats['explore_calls']} explore calls found "
+            f"{self.stats['segments_added']} new segments "
+            f"({self.calls_per_segment():.2f} calls per segment)"
+        )
+
+    def _explore(self, bounds, zoom_level):
+        """explore_segments for running segments in bounds, recording metrics"""
+        with OPERATION_SECONDS.time(operation="explore_segments"):
+            segments = self.client.explore_segments(bounds, activity_type="running")
+        API_CALLS.inc(call="explore_segments")
+        CRAWL_MAX_ZOOM.set_max(zoom_level)
+        return segments
 
     def retrieve_segments_recursively(self, bounds, zoom_level=0):
         if zoom_level > self.max_zoom:
@@ -126,13 +505,14 @@ class SegmentCrawler:
         if self.regions_db.is_explored(bounds):
             return True
 
-        retrieved_segments = self.client.explore_segments(
-            bounds, activity_type="running"
-        )
+        retrieved_segments = self._explore(bounds, zoom_level)
+        self.stats["explore_calls"] += 1
         LOGGER.info(
             f"Retrieved {len(retrieved_segments)} segments on level {zoom_level}"
         )
-        self.segments_db.save_segments(retrieved_segments)
+        added = len(self.segments_db.data)
+        self.segments_db.save_segments(retrieved_segments, self.details)
+        self.stats["segments_added"] += len(self.segments_db.data) - added
         self.segments_db.save()
 
         if len(retrieved_segments) < 10:
@@ -140,7 +520,7 @@ class SegmentCrawler:
             return True
         else:
             # more segments to retrieve
-            new_boxes = split_box(bounds)
+            new_boxes = self.splitter(bounds)
             is_explored = True
             for box in new_boxes:
                 is_explored = is_explored and self.retrieve_segments_recursively(
@@ -153,6 +533,137 @@ class SegmentCrawler:
 
         return False
 
+    def retrieve_segments_frontier(self, bounds, state=None):
+        """Breadth first equivalent of retrieve_segments_recursively
+
+        Each level of the quadtree is explored with up to self.workers
+        concurrent explore_segments calls. Results are processed in order on
+        the calling thread, then explored status is resolved bottom up.
+
+        Regions found and settled are reported to self.progress as
+        regions_total and regions_done, and it can stop the crawl by raising.
+        Progress is kept in state (a CrawlState). If the crawl is interrupted,
+        e.g. by QuotaExhausted or cancelling, the state is saved before the
+        error is raised, and passing the loaded state again resumes from
+        where it stopped; bounds are then ignored. The state is cleared once
+        the crawl is done.
+        """
+        state = state if state is not None else CrawlState()
+        if state.started:
+            LOGGER.info(
+                f"Resuming crawl with {len(state.frontier)} regions and "
+                f"{len(state.pending_ids())} segments to retrieve"
+            )
+        else:
+            state.add_node(bounds, 0)
+
+        try:
+            self._report(regions_total=len(state.frontier))
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                while state.frontier:
+                    self._crawl_level(state, executor)
+        except BaseException:
+            self.details.flush()
+            self.segments_db.save()
+            self.regions_db.save()
+            state.save()
+            raise
+
+        # Children always come after their parent, so resolve in reverse
+        children = state.children()
+        for node in reversed(range(len(state.boxes))):
+            if node not in state.explored:
+                state.explored[node] = all(
+                    state.explored[child] for child in children[node]
+                )
+                if state.explored[node]:
+                    self.regions_db.set_explored(state.boxes[node], True)
+
+        state.clear()
+        return state.explored[0]
+
+    def _crawl_level(self, state, executor):
+        """Explore the nodes currently in the frontier, adding their children
+
+        state is kept consistent throughout, so it can be saved at any point.
+        """
+        level = list(state.frontier)
+        self._explore_level(state, executor, self._level_to_explore(state, level))
+
+        level = [node for node in level if node in state.results]
+        # Fetch details for the whole level at once
+        for node in level:
+            self.segments_db.prefetch_ids(state.results[node], self.details)
+        for node in level:
+            self._settle_node(state, node)
+
+        self.segments_db.save()
+
+    def _level_to_explore(self, state, level):
+        """Nodes of level to explore, settling those too deep or explored before"""
+        to_explore = []
+        for node in level:
+            if node in state.results:
+                # Explored before the crawl was interrupted
+                continue
+            if state.zooms[node] > self.max_zoom:
+                state.explored[node] = False
+                state.frontier.remove(node)
+                self._report(regions_done=1)
+            elif self.regions_db.is_explored(state.boxes[node]):
+                state.explored[node] = True
+                state.frontier.remove(node)
+                self._report(regions_done=1)
+            else:
+                to_explore.append(node)
+        return to_explore
+
+    def _explore_level(self, state, executor, nodes):
+        """Explore nodes concurrently, keeping each result in state.results
+
+        Every result is kept before the first error, if any, is raised.
+        """
+        futures = [
+            (
+                node,
+                executor.submit(self._explore, state.boxes[node], state.zooms[node]),
+            )
+            for node in nodes
+        ]
+        error = None
+        for node, future in futures:
+            try:
+                state.results[node] = [seg.id for seg in future.result()]
+                self.stats["explore_calls"] += 1
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+    def _settle_node(self, state, node):
+        """Save the segments found in node, splitting it if there may be more"""
+        ids = state.results[node]
+        LOGGER.info(
+            f"Retrieved {len(ids)} segments on level {state.zooms[node]}"
+        )
+        added = len(self.segments_db.data)
+        self.segments_db.save_segment_ids(ids, self.details)
+        added = len(self.segments_db.data) - added
+        self.stats["segments_added"] += added
+
+        state.frontier.remove(node)
+        del state.results[node]
+        if len(ids) < 10:
+            self.regions_db.set_explored(state.boxes[node], True)
+            state.explored[node] = True
+        else:
+            # more segments to retrieve
+            new_boxes = self.splitter(state.boxes[node])
+            for box in new_boxes:
+                state.add_node(box, state.zooms[node] + 1, node)
+            self._report(regions_total=len(new_boxes))
+        self._report(regions_done=1, regions_explored=1, segments_added=added)
+
 
 def split_box(bounds):
     mid_point = (
@@ -172,39 +683,134 @@ def split_box(bounds):
     return new_boxes
 
 
-def get_html_from_url(url):
-    with urlopen(url) as response:
-        html = response.read().decode("utf8")
-    return html
+def get_html_from_url(url, parser=None):
+    """Download a page. A streaming parser is fed the page as it arrives"""
+    return get_fetcher().fetch(url, parser)
 
 
-def retrieve_fastest_times(segments: SegmentsData, force_retrieve=False, save_interval=10):
-    if force_retrieve:
-        segments_to_fill = segments.data
-    else:
-        segments_to_fill = [seg for seg in segments.data if "fastest_athlete" not in seg]
-    count = 0
+def is_transient_error(error):
+    """Network errors worth retrying; client errors such as 404 are not"""
+    if isinstance(error, HTTPError):
+        return error.code == 429 or error.code >= 500
+    return True
 
-    for segment in segments_to_fill:
 
-        url = "https://www.strava.com/segments/" + str(segment["id"])
-        html = get_html_from_url(url)
+def fetch_leader(segment_id, rate_limiter=None, retries=3, backoff=1.0):
+    """Download and parse the leaderboard for a segment, retrying network errors"""
+    url = f"{STRAVA_URL}/segments/{segment_id}"
 
-        soup = BeautifulSoup(html, "html.parser")
-        table = soup.find("table", {"class": "table-leaderboard"})
-        leader = table.find("tbody").find("tr")
-        rows = leader.find_all("td")
+    def fetch():
+        if rate_limiter is not None and not get_fetcher().is_fresh(url):
+            rate_limiter.wait(url)
+        parser = LeaderboardParser()
+        return parser, get_html_from_url(url, parser)
 
-        name = rows[1].text.strip()
-        time = rows[-1].text
+    parser, html = with_retries(
+        fetch,
+        retries=retries,
+        backoff=backoff,
+        exceptions=(URLError, ConnectionError, socket.timeout),
+        should_retry=is_transient_error,
+    )
+    if parser.leader is not None:
+        return parser.leader
+    # Fall back to parsing the whole page
+    with OPERATION_SECONDS.time(operation="parse_leaderboard"):
+        return parse_leader(html)
+
+
+def retrieve_fastest_times(
+    segments: SegmentsData,
+    force_retrieve=False,
+    save_interval=10,
+    workers=1,
+    rate_limiter=None,
+    progress=None,
+    budget=None,
+    refresh_stats=False,
+    details=None,
+    clock=time.time,
+):
+    """Retrieve fastest athlete and time for segments
+
+    With workers > 1 pages are fetched concurrently, but results are still
+    applied in order so saves happen at the same points as a sequential run.
+    progress, if given, is called with pages_total and pages_done counts and
+    can stop the retrieval by raising.
+
+    With a budget, up to budget segments are refreshed, those most likely to
+    have changed first (see src.refresh), including any never checked. Each
+    segment's checked_at is set to when it was refreshed, by clock. With
+    refresh_stats, details such as effort_count are also fetched again
+    through details (by default segments.details), so each segment costs an
+    API call too.
+    """
+    details = details if details is not None else segments.details
+    segments_to_fill = select_segments_to_fill(
+        segments, force_retrieve, budget, now=clock()
+    )
+    count = 0
+    if progress is not None:
+        progress(pages_total=len(segments_to_fill))
+    if refresh_stats:
+        details.submit([seg["id"] for seg in segments_to_fill], refresh=True)
+
+    with fetched_leaders(segments_to_fill, workers, rate_limiter) as leaders:
+        for segment, (name, fastest_time) in zip(segments_to_fill, leaders):
+            fields = dict(
+                fastest_athlete=name,
+                fastest_time=fastest_time,
+                fastest_seconds=parse_time(fastest_time),
+                checked_at=int(clock()),
+            )
+            if refresh_stats:
+                fields["effort_count"] = details.fetch([segment["id"]])[0][
+                    "effort_count"
+                ]
+            segments.update(segment, **fields)
+
+            count += 1
+            LOGGER.info(
+                f"{segment['name']}: {name}, {fastest_time} ({count}/{len(segments_to_fill)})"
+            )
 
-        segment["fastest_athlete"] = name
-        segment["fastest_time"] = time
+            if count % save_interval == 0:
+                segments.save()
+            if progress is not None:
+                progress(pages_done=1)
 
-        count += 1
-        LOGGER.info(
-            f"{segment['name']}: {name}, {time} ({count}/{len(segments_to_fill)})"
-        )
 
-        if count % save_interval == 0:
-            segments.save()
+def select_segments_to_fill(segments, force_retrieve=False, budget=None, now=None):
+    """Segments retrieve_fastest_times should fetch leaders for, in order"""
+    if budget is not None:
+        return schedule_refresh(segments.data, budget, now=now)
+    if force_retrieve:
+        return list(segments.data)
+    return [seg for seg in segments.data if "fastest_athlete" not in seg]
+
+
+@contextmanager
+def fetched_leaders(segments_to_fill, workers=1, rate_limiter=None):
+    """Iterator of the leader of each segment, in order
+
+    With workers > 1 pages are fetched ahead concurrently; those not yet
+    used are cancelled when the with block exits.
+    """
+
+    def fetch(segment):
+        with OPERATION_SECONDS.time(operation="fetch_leader"):
+            return fetch_leader(segment["id"], rate_limiter)
+
+    if workers <= 1:
+        yield map(fetch, segments_to_fill)
+        return
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = []
+    try:
+        futures = [executor.submit(fetch, seg) for seg in segments_to_fill]
+        yield (future.result() for future in futures)
+    finally:
+        # Don't fetch pages which will never be used
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
@@ -0,0 +1,219 @@
+""" Spatial indexing of lat/lng boxes
+
+Boxes use the same format as the rest of the app: [(lat, lng), (lat, lng)],
+i.e. bottom left then top right corner.
+"""
+
+WORLD = ((-90.0, -180.0), (90.0, 180.0))
+
+# Tolerance used when deciding whether a box is covered by other boxes
+COVER_TOLERANCE = 1e-9
+
+
+def normalise_bounds(bounds):
+    """Return bounds as ((min_lat, min_lng), (max_lat, max_lng)) floats"""
+    (lat_a, lng_a), (lat_b, lng_b) = bounds
+    return (
+        (float(min(lat_a, lat_b)), float(min(lng_a, lng_b))),
+        (float(max(lat_a, lat_b)), float(max(lng_a, lng_b))),
+    )
+
+
+def bounds_key(bounds, precision=9):
+    """Hashable key for bounds, ignoring list/tuple differences and float noise"""
+    (lat_min, lng_min), (lat_max, lng_max) = normalise_bounds(bounds)
+    return (
+        round(lat_min, precision),
+        round(lng_min, precision),
+        round(lat_max, precision),
+        round(lng_max, precision),
+    )
+
+
+def record_bounds(record):
+    """Normalised bounding box of a region or segment record, if it has one"""
+    if record.get("bounds"):
+        return normalise_bounds(record["bounds"])
+    start, end = record.get("start_latlng"), record.get("end_latlng")
+    if isinstance(start, (list, tuple)) and isinstance(end, (list, tuple)):
+        if len(start) == 2 and len(end) == 2:
+            return normalise_bounds([start, end])
+    return None
+
+
+def intersects(box_a, box_b):
+    """Check if two normalised boxes overlap (touching edges count)"""
+    return (
+        box_a[0][0] <= box_b[1][0]
+        and box_b[0][0] <= box_a[1][0]
+        and box_a[0][1] <= box_b[1][1]
+        and box_b[0][1] <= box_a[1][1]
+    )
+
+
+def contains(outer, inner):
+    """Check if normalised box inner lies entirely within outer"""
+    return (
+        outer[0][0] <= inner[0][0]
+        and outer[0][1] <= inner[0][1]
+        and inner[1][0] <= outer[1][0]
+        and inner[1][1] <= outer[1][1]
+    )
+
+
+def quadrants(box):
+    """Split a normalised box into quadrants, in the same order as split_box"""
+    (lat_min, lng_min), (lat_max, lng_max) = box
+    lat_mid = (lat_min + lat_max) / 2
+    lng_mid = (lng_min + lng_max) / 2
+    return [
+        # bottom left
+        ((lat_min, lng_min), (lat_mid, lng_mid)),
+        # top left
+        ((lat_min, lng_mid), (lat_mid, lng_max)),
+        # top right
+        ((lat_mid, lng_mid), (lat_max, lng_max)),
+        # bottom right
+        ((lat_mid, lng_min), (lat_max, lng_mid)),
+    ]
+
+
+def union_covers(box, boxes, tolerance=COVER_TOLERANCE):
+    """Check if the union of normalised boxes covers box entirely
+
+    Sweeps over the horizontal slabs between box edges; within each slab the
+    boxes spanning it must cover the full longitude range.
+    """
+    (lat_min, lng_min), (lat_max, lng_max) = box
+    edges = {lat_min, lat_max}
+    for other in boxes:
+        for lat in (other[0][0], other[1][0]):
+            if lat_min < lat < lat_max:
+                edges.add(lat)
+    edges = sorted(edges)
+
+    for low, high in zip(edges, edges[1:]):
+        if high - low <= tolerance:
+            continue
+        mid = (low + high) / 2
+        spans = sorted(
+            (other[0][1], other[1][1])
+            for other in boxes
+            if other[0][0] <= mid <= other[1][0]
+        )
+        reach = lng_min
+        for start, end in spans:
+            if start > reach + tolerance:
+                break
+            reach = max(reach, end)
+            if reach >= lng_max - tolerance:
+                break
+        if reach < lng_max - tolerance:
+            return False
+
+    return bool(boxes)
+
+
+class _Node:
+    __slots__ = ("box", "items", "children")
+
+    def __init__(self, box):
+        self.box = box
+        self.items = []
+        self.children = None
+
+
+class QuadTree:
+    """Region quadtree over lat/lng boxes
+
+    Each box is stored in the deepest cell that fully contains it. Cells are
+    addressed by their path from the root, one digit (0-3) per level, using the
+    quadrant order of split_box.
+    """
+
+    def __init__(self, root=WORLD, max_depth=24):
+        self._root = _Node(normalise_bounds(root))
+        self.max_depth = max_depth
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def path(self, bounds):
+        """Path of the deepest cell that fully contains bounds"""
+        box = normalise_bounds(bounds)
+        cell = self._root.box
+        path = ""
+        while len(path) < self.max_depth:
+            cells = quadrants(cell)
+            quadrant = next(
+                (i for i, sub in enumerate(cells) if contains(sub, box)), None
+            )
+            if quadrant is None:
+                break
+            cell = cells[quadrant]
+            path += str(quadrant)
+        return path
+
+    def insert(self, bounds, item):
+        """Add item covering bounds, returning the path of its cell"""
+        box = normalise_bounds(bounds)
+        node, path = self._locate(box, create=True)
+        node.items.append((box, item))
+        self._size += 1
+        return path
+
+    def remove(self, bounds, item):
+        """Remove item previously inserted with bounds"""
+        box = normalise_bounds(bounds)
+        node, _ = self._locate(box, create=False)
+        for i, (_, other) in enumerate(node.items):
+            if other is item:
+                del node.items[i]
+                self._size -= 1
+                return True
+        return False
+
+    def query(self, bounds):
+        """Items whose boxes intersect bounds"""
+        return [item for _, item in self._query_boxes(normalise_bounds(bounds))]
+
+    def covers(self, bounds, tolerance=COVER_TOLERANCE):
+        """Check if bounds is entirely covered by the union of stored boxes"""
+        box = normalise_bounds(bounds)
+        boxes = [other for other, _ in self._query_boxes(box)]
+        return union_covers(box, boxes, tolerance)
+
+    def _locate(self, box, create):
+        node = self._root
+        path = ""
+        while len(path) < self.max_depth:
+            cells = (
+                [child.box for child in node.children]
+                if node.children
+                else quadrants(node.box)
+            )
+            quadrant = next(
+                (i for i, cell in enumerate(cells) if contains(cell, box)), None
+            )
+            if quadrant is None:
+                break
+            if node.children is None:
+                if not create:
+                    break
+                node.children = [_Node(cell) for cell in cells]
+            node = node.children[quadrant]
+            path += str(quadrant)
+        return node, path
+
+    def _query_boxes(self, box):
+        found = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            found.extend(entry for entry in node.items if intersects(entry[0], box))
+            if node.children:
+                stack.extend(
+                    child for child in node.children if intersects(child.box, box)
+                )
+        return found
@@ -0,0 +1,101 @@
+""" Strategies for splitting a region the crawler found too many segments in
+
+explore_segments returns at most 10 segments, so a region with 10 results
+has to be split and each part explored. A splitter takes bounds and returns
+boxes which exactly cover them, in the same [(lat, lng), (lat, lng)] format
+as split_box.
+"""
+import math
+from src.spatial import normalise_bounds, quadrants
+
+
+class MedianSplitter:
+    """k-d style splits at the median of known segment start points
+
+    The part of the box with the most known segments is halved, across its
+    longer side, until each part is predicted to hold fewer than target
+    segments, or max_parts is reached. A dense city centre is then split into
+    many parts at once rather than one level at a time, and empty fields are
+    left as large boxes. Where fewer than min_points segments are known, the
+    box is split into quadrants as before: the 10 results which caused the
+    split say little about where the rest of the segments are.
+
+    With the Oxford segments already known, re-crawling Oxford takes 73
+    explore calls rather than 213 (benchmarks/bench_splitting.py).
+    """
+
+    def __init__(self, segments_db, target=8, max_parts=8, min_points=20):
+        self.segments_db = segments_db
+        self.target = target
+        self.max_parts = max_parts
+        self.min_points = min_points
+        self._points = None
+        self._points_count = None
+
+    def __call__(self, bounds):
+        box = normalise_bounds(bounds)
+        points = self.points(box)
+        if len(points) < self.min_points:
+            return [list(quadrant) for quadrant in quadrants(box)]
+
+        parts = [(box, points)]
+        while len(parts) < self.max_parts:
+            largest = max(range(len(parts)), key=lambda i: len(parts[i][1]))
+            if len(parts) > 1 and len(parts[largest][1]) < self.target:
+                break
+            parts[largest:largest + 1] = halve(*parts[largest])
+
+        return [[lower, upper] for (lower, upper), _ in parts]
+
+    def points(self, box):
+        """Start points of known segments within box, as an (n, 2) array"""
+        import numpy as np
+
+        data = self.segments_db.data
+        # Segments are only added while crawling, so the count is enough to
+        # tell if the array is out of date
+        if self._points_count != len(data):
+            self._points = np.array(
+                [
+                    seg["start_latlng"]
+                    for seg in data
+                    if isinstance(seg.get("start_latlng"), (list, tuple))
+                    and len(seg["start_latlng"]) == 2
+                ],
+                dtype=float,
+            ).reshape(-1, 2)
+            self._points_count = len(data)
+
+        (lat_min, lng_min), (lat_max, lng_max) = box
+        lat, lng = self._points[:, 0], self._points[:, 1]
+        inside = (lat >= lat_min) & (lat < lat_max) & (lng >= lng_min) & (lng < lng_max)
+        return self._points[inside]
+
+
+def halve(box, points):
+    """Split box in two across its longer side, at the median of points
+
+    Returns [(box, points), (box, points)] for each half.
+    """
+    (lat_min, lng_min), (lat_max, lng_max) = box
+    # Compare sides in distance rather than degrees
+    lng_scale = math.cos(math.radians((lat_min + lat_max) / 2))
+    axis = 0 if lat_max - lat_min >= (lng_max - lng_min) * lng_scale else 1
+    low, high = box[0][axis], box[1][axis]
+
+    values = sorted(points[:, axis])
+    split = (low + high) / 2
+    if len(values) >= 2:
+        median = (values[len(values) // 2 - 1] + values[len(values) // 2]) / 2
+        # All points on one line can't be separated, so fall back to halving
+        if low < median < high:
+            split = median
+
+    lower_upper = list(box[1])
+    lower_upper[axis] = split
+    upper_lower = list(box[0])
+    upper_lower[axis] = split
+    lower = (box[0], tuple(lower_upper))
+    upper = (tuple(upper_lower), box[1])
+    below = points[:, axis] < split
+    return [(lower, points[below]), (upper, points[~below])]
@@ -0,0 +1,332 @@
+""" Storage backends for segments and regions
+
+Each backend loads and saves a list of records (dicts). Records are identified
+by a key function supplied by the data class, e.g. segment id or region bounds.
+"""
+import json
+import os
+import sys
+import logging
+import sqlite3
+import threading
+from src.spatial import intersects, normalise_bounds, record_bounds
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+LOGGER.addHandler(handler)
+
+
+SQLITE_FILENAME = "data.sqlite"
+
+
+def open_store(filename, key=None, bounds=record_bounds):
+    """Store for a data file such as data/oxford/segments.json
+
+    Uses the location's SQLite database if one has been imported, otherwise
+    the JSON snapshot with a journal. key identifies records, so the store
+    can save before anything is loaded, and bounds gives the box SQLite
+    indexes each record by.
+    """
+    db_filename = os.path.join(os.path.dirname(filename), SQLITE_FILENAME)
+    if os.path.exists(db_filename):
+        table = os.path.splitext(os.path.basename(filename))[0]
+        return SqliteStore(db_filename, table, key, bounds)
+    return JournalStore(filename)
+
+
+def dump_snapshot(data):
+    """Serialise records in the snapshot file format"""
+    return json.dumps(data, indent=4, sort_keys=True)
+
+
+class SnapshotStore:
+    """All records in one JSON file, rewritten in full on every save"""
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def load(self, key):
+        with open(self.filename, "r") as f:
+            return json.load(f)
+
+    def save(self, data, changed=None):
+        """Save records. changed lists the records modified since the last
+        save, or is None if every record should be written
+
+        Returns the number of bytes written.
+        """
+        snapshot = dump_snapshot(data)
+        # Written aside then renamed, so readers never see a partial file
+        tmp_filename = f"{self.filename}.{threading.get_ident()}.tmp"
+        with open(tmp_filename, "w") as f:
+            f.write(snapshot)
+        os.replace(tmp_filename, self.filename)
+        return len(snapshot)
+
+    def close(self, data):
+        """Flush anything outstanding before shutdown"""
+
+
+class JournalStore(SnapshotStore):
+    """Snapshot file plus an append-only JSON Lines journal of changed records
+
+    Saves only append changed records to the journal, and fsync every
+    fsync_interval records. Once the journal holds compact_threshold records
+    it is compacted into the snapshot on a background thread, and then
+    on_compacted, if set, is called. Loading reads the snapshot then replays
+    the journal, so a plain snapshot file written by SnapshotStore loads
+    unchanged.
+    """
+
+    def __init__(self, filename, fsync_interval=100, compact_threshold=5000):
+        super().__init__(filename)
+        self.journal_filename = filename + ".journal"
+        self.compacting_filename = filename + ".journal.compacting"
+        self.fsync_interval = fsync_interval
+        self.compact_threshold = compact_threshold
+        self._journal = None
+        self._journal_records = 0
+        self._unsynced = 0
+        self._compaction = None
+        self.on_compacted = None
+
+    def load(self, key):
+        data = []
+        if os.path.exists(self.filename):
+            data = super().load(key)
+
+        index = {key(record): record for record in data}
+        self._journal_records = 0
+        for filename in (self.compacting_filename, self.journal_filename):
+            for record in self._read_journal(filename):
+                self._journal_records += 1
+                existing = index.get(key(record))
+                if existing is None:
+                    data.append(record)
+                    index[key(record)] = record
+                elif existing is not record:
+                    existing.clear()
+                    existing.update(record)
+        return data
+
+    def save(self, data, changed=None):
+        if changed is None:
+            return self.compact(data, background=False)
+
+        if not changed:
+            return 0
+
+        if self._journal is None:
+            self._journal = open(self.journal_filename, "a")
+        entries = "".join(json.dumps(record, sort_keys=True) + "\n" for record in changed)
+        self._journal.write(entries)
+        self._journal.flush()
+        self._journal_records += len(changed)
+        self._unsynced += len(changed)
+
+        if self._unsynced >= self.fsync_interval:
+            self._sync()
+
+        if self._journal_records >= self.compact_threshold:
+            return len(entries) + self.compact(data, background=True)
+        return len(entries)
+
+    def close(self, data):
+        self.compact(data, background=False)
+
+    @property
+    def compacting(self):
+        """Whether a background compaction is still writing"""
+        return self._compaction is not None and self._compaction.is_alive()
+
+    def compact(self, data, background=True):
+        """Write all records to the snapshot and start a fresh journal
+
+        Returns the size of the snapshot written.
+        """
+        self._wait_for_compaction()
+        snapshot = dump_snapshot(data)
+        self._rotate_journal()
+
+        if background:
+            self._compaction = threading.Thread(
+                target=self._write_snapshot, args=(snapshot,), daemon=True
+            )
+            self._compaction.start()
+        else:
+            self._write_snapshot(snapshot)
+        return len(snapshot)
+
+    def _write_snapshot(self, snapshot):
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w") as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
+        if os.path.exists(self.compacting_filename):
+            os.remove(self.compacting_filename)
+        LOGGER.info(f"Compacted journal into {self.filename}")
+        if self.on_compacted is not None:
+            self.on_compacted()
+
+    def _rotate_journal(self):
+        """Move the journal aside so it is kept until the snapshot is written"""
+        if self._journal is not None:
+            self._sync()
+            self._journal.close()
+            self._journal = None
+        self._journal_records = 0
+
+        if not os.path.exists(self.journal_filename):
+            return
+        if os.path.exists(self.compacting_filename):
+            # Left over from an interrupted compaction, so keep both
+            with open(self.journal_filename, "r") as journal, open(
+                self.compacting_filename, "a"
+            ) as compacting:
+                compacting.write(journal.read())
+                compacting.flush()
+                os.fsync(compacting.fileno())
+            os.remove(self.journal_filename)
+        else:
+            os.replace(self.journal_filename, self.compacting_filename)
+
+    def _wait_for_compaction(self):
+        if self._compaction is not None:
+            self._compaction.join()
+            self._compaction = None
+
+    def _sync(self):
+        if self._journal is not None and self._unsynced:
+            os.fsync(self._journal.fileno())
+        self._unsynced = 0
+
+    @staticmethod
+    def _read_journal(filename):
+        if not os.path.exists(filename):
+            return
+        with open(filename, "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # A torn final write from a crash; everything before it is intact
+                    LOGGER.warning(f"Ignoring corrupt journal entry in {filename}")
+
+
+class SqliteStore:
+    """Records in a table of a local SQLite database, with an R*Tree index
+
+    Each record is stored as JSON against its key, and its bounding box,
+    given by bounds (by default region bounds or segment start/end points),
+    goes in an R*Tree so boxes can be queried without loading everything.
+    SegmentsData answers viewport queries from it until the segments are
+    needed in full. Saves upsert the changed records in a single
+    transaction. Connections are per thread, so a store can be shared by the
+    threaded web app. The key function is given here, or by the first load.
+    """
+
+    def __init__(self, db_filename, table, key=None, bounds=record_bounds):
+        self.filename = db_filename
+        self.table = table
+        self.bounds = bounds
+        self._record_key = key
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                "id INTEGER PRIMARY KEY, key TEXT UNIQUE NOT NULL, body TEXT NOT NULL)"
+            )
+            conn.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_rtree "
+                "USING rtree(id, min_lat, max_lat, min_lng, max_lng)"
+            )
+
+    def load(self, key):
+        self._record_key = key
+        rows = self._connection().execute(f"SELECT body FROM {self.table} ORDER BY id")
+        return [json.loads(body) for body, in rows]
+
+    def save(self, data, changed=None):
+        if self._record_key is None:
+            raise ValueError(f"{self.table} needs a key function to save, given to the store or load")
+        with self._connection() as conn:
+            if changed is None:
+                conn.execute(f"DELETE FROM {self.table}")
+                conn.execute(f"DELETE FROM {self.table}_rtree")
+                return self._upsert(conn, data, replace=False)
+            return self._upsert(conn, changed, replace=True)
+
+    def close(self, data):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def query_bbox(self, bounds):
+        """Records whose bounding boxes intersect bounds, in the order loaded"""
+        box = normalise_bounds(bounds)
+        (min_lat, min_lng), (max_lat, max_lng) = box
+        rows = self._connection().execute(
+            f"SELECT r.body FROM {self.table} r JOIN {self.table}_rtree t ON r.id = t.id "
+            "WHERE t.max_lat >= ? AND t.min_lat <= ? AND t.max_lng >= ? AND t.min_lng <= ? "
+            "ORDER BY r.id",
+            (min_lat, max_lat, min_lng, max_lng),
+        )
+        matching = []
+        for body, in rows:
+            record = json.loads(body)
+            # The R*Tree rounds boxes outwards to 32 bit floats, so check exactly
+            record_box = self.bounds(record)
+            if record_box is not None and intersects(box, normalise_bounds(record_box)):
+                matching.append(record)
+        return matching
+
+    def count(self):
+        return self._connection().execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def _upsert(self, conn, records, replace):
+        """Insert or update records, returning the size of their bodies"""
+        written = 0
+        for record in records:
+            key = json.dumps(self._record_key(record))
+            body = json.dumps(record, sort_keys=True)
+            written += len(body)
+            if replace:
+                conn.execute(f"UPDATE {self.table} SET body = ? WHERE key = ?", (body, key))
+            conn.execute(
+                f"INSERT OR IGNORE INTO {self.table} (key, body) VALUES (?, ?)", (key, body)
+            )
+            box = self.bounds(record)
+            if box is None:
+                # e.g. a segment whose polyline was cleared
+                conn.execute(
+                    f"DELETE FROM {self.table}_rtree "
+                    f"WHERE id = (SELECT id FROM {self.table} WHERE key = ?)",
+                    (key,),
+                )
+                continue
+            box = normalise_bounds(box)
+            (min_lat, min_lng), (max_lat, max_lng) = box
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table}_rtree "
+                f"SELECT id, ?, ?, ?, ? FROM {self.table} WHERE key = ?",
+                (min_lat, max_lat, min_lng, max_lng, key),
+            )
+        return written
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
@@ -0,0 +1,78 @@
+""" Politeness and retry helpers for web requests """
+import sys
+import time
+import logging
+import threading
+import multiprocessing
+from urllib.parse import urlparse
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+LOGGER.addHandler(handler)
+
+
+class HostRateLimiter:
+    """Limit the rate of requests made to each host, across threads"""
+
+    def __init__(self, requests_per_second=4.0):
+        self.min_interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self._next_slot = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        """Block until a request to the host of url is allowed, returning the
+        (monotonic) time of its slot"""
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.min_interval
+        if slot > now:
+            time.sleep(slot - now)
+        return slot
+
+
+class SharedRateLimiter:
+    """Limit the rate of requests across processes, e.g. a pool's workers
+
+    All hosts share the budget. It must be created before the processes
+    start and passed to them as they do, e.g. in a pool's initargs.
+    """
+
+    def __init__(self, requests_per_second=4.0):
+        self.min_interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        # Wall clock time of the next free slot, as the monotonic clock isn't
+        # guaranteed to be shared between processes
+        self._next_slot = multiprocessing.Value("d", 0.0)
+
+    def wait(self, url):
+        """Block until a request is allowed, returning the time of its slot"""
+        with self._next_slot.get_lock():
+            now = time.time()
+            slot = max(now, self._next_slot.value)
+            self._next_slot.value = slot + self.min_interval
+        if slot > now:
+            time.sleep(slot - now)
+        return slot
+
+
+def with_retries(func, retries=3, backoff=1.0, exceptions=(Exception,), should_retry=None):
+    """Call func, retrying with exponential backoff if it raises one of exceptions
+
+    should_retry can further restrict which of those exceptions are retried.
+    """
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except exceptions as e:
+            if attempt >= retries or (should_retry and not should_retry(e)):
+                raise
+            delay = backoff * 2 ** attempt
+            attempt += 1
+            LOGGER.warning(f"{e}, retrying in {delay}s ({attempt}/{retries})")
+            time.sleep(delay)
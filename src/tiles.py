@@ -0,0 +1,233 @@
+""" Export of segments as static slippy map tiles
+
+Each tile z/x/y.json holds the segments whose routes intersect it, with
+pace and colour computed and polylines simplified for zoom z, so a static
+page only loads the tiles in view. Tiles are also written gzip (and, if the
+brotli package is installed, brotli) compressed, as z/x/y.json.gz and
+z/x/y.json.br, for servers which serve precompressed files (e.g. nginx's
+gzip_static). manifest.json lists the tiles written.
+
+python -m src.tiles oxford --min-zoom 11 --max-zoom 15
+"""
+import argparse
+import gzip
+import io
+import json
+import math
+import os
+import shutil
+import sys
+import time
+import logging
+from src.polyline import PolylineCache
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+LOGGER.addHandler(handler)
+
+MIN_ZOOM = 11
+MAX_ZOOM = 15
+# Web Mercator can't show the poles
+MAX_LATITUDE = 85.05112878
+
+# Fields of displayed segments kept in tiles; the page derives the rest
+TILE_FIELDS = (
+    "id",
+    "name",
+    "distance",
+    "avg_grade",
+    "climb",
+    "effort_count",
+    "start_latlng",
+    "end_latlng",
+    "polyline",
+    "fastest_athlete",
+    "fastest_time",
+    "fastest_pace",
+    "colour",
+)
+
+
+def tile_xy(lat, lng, zoom):
+    """x and y of the tile at zoom containing lat, lng"""
+    lat = min(max(lat, -MAX_LATITUDE), MAX_LATITUDE)
+    n = 2 ** zoom
+    x = int((lng + 180.0) / 360.0 * n)
+    lat_rad = math.radians(lat)
+    y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bounds(x, y, zoom):
+    """Bounds of a tile, bottom left then top right"""
+    n = 2 ** zoom
+
+    def lat(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+    return [(lat(y + 1), x / n * 360.0 - 180.0), (lat(y), (x + 1) / n * 360.0 - 180.0)]
+
+
+def tiles_covering(bounds, zoom):
+    """(x, y) of every tile at zoom intersecting bounds"""
+    (lat_min, lng_min), (lat_max, lng_max) = bounds
+    x_min, y_max = tile_xy(min(lat_min, lat_max), min(lng_min, lng_max), zoom)
+    x_max, y_min = tile_xy(max(lat_min, lat_max), max(lng_min, lng_max), zoom)
+    return [(x, y) for x in range(x_min, x_max + 1) for y in range(y_min, y_max + 1)]
+
+
+def tile_segment(segment, polyline):
+    """The fields of a displayed segment kept in a tile, NaN as null"""
+    tiled = {}
+    for field in TILE_FIELDS:
+        if field not in segment:
+            continue
+        value = polyline if field == "polyline" else segment[field]
+        if isinstance(value, float) and value != value:
+            value = None
+        tiled[field] = value
+    return tiled
+
+
+def write_tile(filename, body, encodings):
+    """Write body to filename, and compressed copies with each of encodings"""
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    data = body.encode("utf8")
+    with open(filename, "wb") as f:
+        f.write(data)
+    sizes = {"identity": len(data)}
+    if "gzip" in encodings:
+        # mtime=0 so exports of the same data are identical. gzip.compress
+        # only takes mtime from Python 3.8
+        buffer = io.BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=9, mtime=0) as f:
+            f.write(data)
+        compressed = buffer.getvalue()
+        with open(filename + ".gz", "wb") as f:
+            f.write(compressed)
+        sizes["gzip"] = len(compressed)
+    if "br" in encodings:
+        import brotli
+
+        compressed = brotli.compress(data)
+        with open(filename + ".br", "wb") as f:
+            f.write(compressed)
+        sizes["br"] = len(compressed)
+    return sizes
+
+
+def available_encodings():
+    """Compressed encodings which can be written: gzip, and br with brotli installed"""
+    try:
+        import brotli  # noqa: F401
+    except ImportError:
+        return ["gzip"]
+    return ["gzip", "br"]
+
+
+def replace_directory(new_directory, directory):
+    """Move new_directory to directory, deleting the old one only afterwards"""
+    old_directory = directory + ".old"
+    if os.path.exists(old_directory):
+        shutil.rmtree(old_directory)
+    if os.path.exists(directory):
+        os.replace(directory, old_directory)
+    os.replace(new_directory, directory)
+    if os.path.exists(old_directory):
+        shutil.rmtree(old_directory)
+
+
+def export_tiles(segments_db, directory, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM, encodings=None):
+    """Write segments_db as tiles from min_zoom to max_zoom in directory
+
+    Tiles are written to a temporary directory. The old export is renamed
+    aside, the new one renamed into place and only then the old one
+    deleted, so a page never sees a half written export; directory is
+    missing only between the two renames. Returns the manifest.
+    """
+    from src.segment_crawler import segment_bounds
+
+    encodings = available_encodings() if encodings is None else encodings
+    polylines = PolylineCache(min_zoom=min_zoom, max_zoom=max_zoom)
+    displayed = segments_db.display_segments()
+
+    tiles = {}
+    all_bounds = []
+    for segment in displayed:
+        bounds = segment_bounds(segment)
+        if bounds is None:
+            continue
+        all_bounds.append(bounds)
+        for zoom in range(min_zoom, max_zoom + 1):
+            polyline = polylines.get(segment.get("id"), segment.get("polyline"), zoom)
+            tiled = tile_segment(segment, polyline)
+            for x, y in tiles_covering(bounds, zoom):
+                tiles.setdefault((zoom, x, y), []).append(tiled)
+
+    tmp_directory = directory + ".tmp"
+    if os.path.exists(tmp_directory):
+        shutil.rmtree(tmp_directory)
+    totals = {}
+    for (zoom, x, y), segments in sorted(tiles.items()):
+        # Compact, as whitespace is most of an uncompressed tile
+        body = json.dumps(segments, separators=(",", ":"), sort_keys=True)
+        filename = os.path.join(tmp_directory, str(zoom), str(x), f"{y}.json")
+        for encoding, size in write_tile(filename, body, encodings).items():
+            totals[encoding] = totals.get(encoding, 0) + size
+
+    manifest = {
+        "min_zoom": min_zoom,
+        "max_zoom": max_zoom,
+        "bounds": [
+            [min(b[0][0] for b in all_bounds), min(b[0][1] for b in all_bounds)],
+            [max(b[1][0] for b in all_bounds), max(b[1][1] for b in all_bounds)],
+        ]
+        if all_bounds
+        else None,
+        "segments": len(all_bounds),
+        "encodings": encodings,
+        "bytes": totals,
+        "generated_at": int(time.time()),
+        "tiles": {
+            str(zoom): sorted([x, y] for z, x, y in tiles if z == zoom)
+            for zoom in range(min_zoom, max_zoom + 1)
+        },
+    }
+    os.makedirs(tmp_directory, exist_ok=True)
+    with open(os.path.join(tmp_directory, "manifest.json"), "w") as f:
+        json.dump(manifest, f, separators=(",", ":"))
+
+    replace_directory(tmp_directory, directory)
+    LOGGER.info(
+        f"Exported {len(all_bounds)} segments as {len(tiles)} tiles to {directory} "
+        + ", ".join(f"{size / 1024:.0f} KiB {encoding}" for encoding, size in totals.items())
+    )
+    return manifest
+
+
+def tiles_directory(segments_filename):
+    """Tiles exported alongside a segments file"""
+    return os.path.join(os.path.dirname(segments_filename), "tiles")
+
+
+if __name__ == "__main__":
+    from src.segment_crawler import SegmentsData
+    from src.storage import open_store
+
+    parser = argparse.ArgumentParser(description="Export segments as static map tiles")
+    parser.add_argument("location", type=str, nargs="?", default="oxford")
+    parser.add_argument("--min-zoom", type=int, default=MIN_ZOOM)
+    parser.add_argument("--max-zoom", type=int, default=MAX_ZOOM)
+    parser.add_argument("--out", type=str, default=None,
+                        help="Directory to write tiles to (default data/<location>/tiles)")
+    args = parser.parse_args()
+
+    filename = f"data/{args.location}/segments.json"
+    segments = SegmentsData(filename, store=open_store(filename))
+    export_tiles(
+        segments, args.out or tiles_directory(filename), args.min_zoom, args.max_zoom
+    )
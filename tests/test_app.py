@@ -0,0 +1,192 @@
+import os
+import threading
+import pytest
+import app as segments_app
+from src.registry import DatasetRegistry
+from src.segment_crawler import segment_key
+from src.storage import JournalStore
+
+
+@pytest.fixture
+def client():
+    segments_app.app.config["TESTING"] = True
+    segments_app.CACHE.clear()
+    segments_app.DATASETS.clear()
+    with segments_app.app.test_client() as client:
+        yield client
+
+
+def test_index_conditional_get(client):
+    response = client.get("/")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert response.headers["Last-Modified"]
+
+    cached = client.get("/", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.data == b""
+
+    stale = client.get("/", headers={"If-None-Match": '"stale"'})
+    assert stale.status_code == 200
+    assert stale.data == response.data
+
+
+def test_index_reuses_rendered_page(client, mocker):
+    client.get("/")
+    render = mocker.spy(segments_app, "render_template")
+
+    client.get("/")
+
+    assert render.call_count == 0
+
+
+def test_retrieve_runs_in_background(client, mocker):
+    mocker.patch.object(
+        segments_app, "get_default_bounds", return_value=[[0.0, 0.0], [1.0, 1.0]]
+    )
+    release = threading.Event()
+
+    def run_retrieve(job, strava, location, bounds, crawl=True):
+        job.report(pages_total=2, pages_done=1)
+        release.wait(5)
+
+    mocker.patch.object(segments_app, "run_retrieve", side_effect=run_retrieve)
+
+    response = client.get("/retrieve/oxford")
+    assert response.status_code == 202
+    job = response.get_json()
+    assert job["location"] == "oxford"
+    assert response.headers["Location"].endswith(f"/jobs/{job['id']}")
+
+    # Only one job at a time for a location
+    conflict = client.get("/retrieve/oxford")
+    assert conflict.status_code == 409
+    assert conflict.get_json()["id"] == job["id"]
+
+    progress = client.get(f"/jobs/{job['id']}").get_json()
+    assert progress["progress"]["pages_done"] == 1
+    assert progress["phase"] == "pages"
+
+    cancelled = client.post(f"/jobs/{job['id']}/cancel")
+    assert cancelled.status_code == 200
+    release.set()
+    segments_app.JOBS.shutdown()
+    assert client.get(f"/jobs/{job['id']}").get_json()["status"] in (
+        "done",
+        "cancelled",
+    )
+
+    assert client.get("/jobs/unknown").status_code == 404
+    assert client.post("/jobs/unknown/cancel").status_code == 404
+
+
+def test_api_segments(client):
+    everything = client.get("/api/oxford/segments?per_page=500").get_json()
+    assert everything["total"] == 779
+
+    response = client.get(
+        "/api/oxford/segments?bbox=51.74,-1.28,51.76,-1.24&min_distance=500&per_page=5"
+    )
+    assert response.status_code == 200
+    result = response.get_json()
+    assert 0 < result["total"] < everything["total"]
+    assert len(result["segments"]) == min(5, result["total"])
+    assert all(segment["distance"] >= 500 for segment in result["segments"])
+    paces = [segment["fastest_pace"] for segment in result["segments"]]
+    assert paces == sorted(paces, reverse=True)
+
+    second = client.get(
+        "/api/oxford/segments?bbox=51.74,-1.28,51.76,-1.24&min_distance=500&per_page=5&page=2"
+    ).get_json()
+    first_ids = {segment["id"] for segment in result["segments"]}
+    assert not first_ids & {segment["id"] for segment in second["segments"]}
+
+    cached = client.get(
+        "/api/oxford/segments?bbox=51.74,-1.28,51.76,-1.24&min_distance=500&per_page=5",
+        headers={"If-None-Match": response.headers["ETag"]},
+    )
+    assert cached.status_code == 304
+
+    assert client.get("/api/oxford/segments?bbox=1,2,3").status_code == 400
+    assert client.get("/api/oxford/segments?page=0").status_code == 400
+
+
+def test_api_segments_zoom(client):
+    full = client.get("/api/oxford/segments?per_page=50").get_json()
+    zoomed_out = client.get("/api/oxford/segments?per_page=50&zoom=10").get_json()
+
+    assert [seg["id"] for seg in full["segments"]] == [
+        seg["id"] for seg in zoomed_out["segments"]
+    ]
+    full_size = sum(len(seg["polyline"] or "") for seg in full["segments"])
+    zoomed_size = sum(len(seg["polyline"] or "") for seg in zoomed_out["segments"])
+    assert zoomed_size < full_size / 2
+
+
+def test_metrics(client):
+    client.get("/api/oxford/segments?per_page=5")
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/plain")
+    text = response.get_data(as_text=True)
+    assert "# TYPE segments_http_request_seconds histogram" in text
+    assert 'segments_http_request_seconds_count{endpoint="api_segments"}' in text
+
+
+def test_profile_request(client, tmp_path, monkeypatch):
+    monkeypatch.setenv("PROFILE_DIR", str(tmp_path))
+    monkeypatch.setitem(segments_app.app.config, "PROFILE_REQUESTS", False)
+    response = client.get("/api/oxford/segments?per_page=5&profile=1")
+    assert "X-Profile" not in response.headers
+
+    monkeypatch.setitem(segments_app.app.config, "PROFILE_REQUESTS", True)
+    response = client.get("/api/oxford/segments?per_page=5")
+    assert "X-Profile" not in response.headers
+
+    for response in (
+        client.get("/api/oxford/segments?per_page=5&profile=1"),
+        client.get("/api/oxford/segments?per_page=5", headers={"X-Profile": "1"}),
+    ):
+        assert response.status_code == 200
+        filename = response.headers["X-Profile"]
+        assert os.path.dirname(filename) == str(tmp_path)
+        assert os.path.basename(filename).startswith("request-api_segments-")
+    assert len(os.listdir(tmp_path)) == 2
+
+
+def test_run_retrieve_leaves_shared_dataset_alone(tmp_path, mocker):
+    os.makedirs(tmp_path / "oxford")
+    with open(tmp_path / "oxford" / "segments.json", "w") as f:
+        f.write('[{"id": 1, "name": "Hill", "distance": 1000.0, "climb": 1.0}]')
+    datasets = DatasetRegistry(
+        lambda location, filetype: str(tmp_path / location / f"{filetype}.json"),
+        segments_app.load_segments,
+        segments_app.load_regions,
+        flush_delay=60,
+    )
+    mocker.patch.object(segments_app, "DATASETS", datasets)
+    mocker.patch.object(segments_app, "DETAILS_CACHE_PATH", str(tmp_path / "details.json"))
+    used = {}
+
+    def retrieve(segments, progress=None, details=None):
+        used["details"] = details
+        segments.update(segments.get_segment(1), fastest_athlete="A", fastest_time="3:00")
+
+    mocker.patch.object(segments_app, "retrieve_fastest_times", side_effect=retrieve)
+    with datasets.open("oxford") as dataset:
+        shared_details = dataset.segments.details
+
+    job = mocker.MagicMock()
+    segments_app.run_retrieve(job, "job client", "oxford", None, crawl=False)
+
+    with datasets.open("oxford") as dataset:
+        # The job had its own details pipeline, and the shared one is untouched
+        assert used["details"] is not shared_details
+        assert used["details"].client == "job client"
+        assert dataset.segments.details is shared_details
+        assert dataset.segments.client is None
+        # Saves were written, without waiting for the flush delay
+        assert not dataset.pending
+    saved = JournalStore(str(tmp_path / "oxford" / "segments.json")).load(segment_key)
+    assert saved[0]["fastest_athlete"] == "A"
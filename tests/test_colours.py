@@ -0,0 +1,24 @@
+import subprocess
+import sys
+import numpy as np
+import pytest
+from src.colours import VIRIDIS_R, pace_colours
+
+
+def test_matches_matplotlib():
+    mpl = pytest.importorskip("matplotlib")
+    import matplotlib.cm as cm
+
+    paces = np.array([float("nan"), -1.0, 2.5, 2.51, 3.0, 3.3, 4.0, 4.49, 4.5, 9.0])
+    mappable = cm.ScalarMappable(norm=mpl.colors.Normalize(vmin=2.5, vmax=4.5), cmap=cm.viridis_r)
+
+    assert VIRIDIS_R == [mpl.colors.to_hex(cm.viridis_r(i)) for i in range(256)]
+    assert pace_colours(paces) == [mpl.colors.to_hex(mappable.to_rgba(pace)) for pace in paces]
+
+
+@pytest.mark.parametrize("module", ["src.segment_crawler", "app"])
+def test_heavy_modules_not_imported(module):
+    code = f"import sys, {module}; print(','.join(m for m in ('matplotlib', 'numpy', 'bs4') if m in sys.modules))"
+    output = subprocess.run([sys.executable, "-c", code], check=True, stdout=subprocess.PIPE)
+
+    assert output.stdout.decode().strip() == ""
@@ -0,0 +1,152 @@
+import json
+import os
+import pytest
+from src.columnar import SegmentColumns, columns_filename, load_columns
+from src.segment_crawler import DisplayedColumns, SegmentsData
+
+RECORDS = [
+    {
+        "id": 1,
+        "name": "Magdalen Bridge sprint ✓",
+        "distance": 400.5,
+        "avg_grade": 1.2,
+        "climb": 3.0,
+        "effort_count": 10,
+        "start_latlng": [51.75, -1.24],
+        "end_latlng": [51.752, -1.245],
+        "polyline": "_p~iF~ps|U_ulLnnqC_mqNvxq`@",
+        "fastest_athlete": "A. Runner",
+        "fastest_time": "1:05",
+        "fastest_seconds": 65,
+    },
+    {
+        "id": 2,
+        "name": "No leaderboard yet",
+        "distance": 1000.0,
+        "avg_grade": 0.0,
+        "climb": 0.0,
+        "effort_count": 0,
+        "start_latlng": None,
+        "end_latlng": [51.7, -1.2],
+        "polyline": None,
+        "hidden": True,
+    },
+    {"id": 3, "distance": 2000.0, "climb": 1.0, "fastest_time": "8:00"},
+]
+
+
+@pytest.fixture
+def columns():
+    return SegmentColumns.from_records(json.loads(json.dumps(RECORDS)))
+
+
+def test_records_round_trip(columns):
+    assert len(columns) == 3
+    assert columns.to_records() == RECORDS
+    assert columns[0]["name"] == RECORDS[0]["name"]
+    assert columns[1]["polyline"] is None
+    assert "fastest_time" not in columns[1]
+    assert columns[1]["hidden"] is True
+    assert columns[-1]["id"] == 3
+    assert list(columns[2]) == ["id", "distance", "climb", "fastest_time"]
+    with pytest.raises(KeyError):
+        columns[2]["name"]
+
+
+def test_columns(columns):
+    import numpy as np
+
+    distance = columns.column("distance")
+    assert distance.tolist() == [400.5, 1000.0, 2000.0]
+    seconds = columns.column("fastest_seconds")
+    assert seconds[0] == 65 and np.isnan(seconds[1:]).all()
+    assert columns.column("start_latlng").shape == (3, 2)
+    with pytest.raises(KeyError):
+        columns.column("name")
+
+
+def test_record_view_changes(columns):
+    record = columns[2]
+    record["fastest_seconds"] = 480
+    record["fastest_athlete"] = "B. Runner"
+    del columns[0]["polyline"]
+    columns.append({"id": 4, "distance": 50.0})
+
+    assert columns[2]["fastest_athlete"] == "B. Runner"
+    assert "polyline" not in columns[0]
+    assert columns.column("fastest_seconds")[2] == 480
+    assert columns.column("distance").tolist() == [400.5, 1000.0, 2000.0, 50.0]
+    assert columns.to_records()[3] == {"id": 4, "distance": 50.0}
+
+
+def test_memory_mapped_snapshot(columns, tmp_path):
+    filename = str(tmp_path / "segments.json.columns")
+    columns[2]["fastest_time"] = "7:59"
+    columns.save(filename)
+
+    mapped = load_columns(filename)
+    expected = columns.to_records()
+    assert mapped.to_records() == expected
+    assert load_columns(filename, mmap=False).to_records() == expected
+
+    # The arrays are read-only views of the file, but records can still change
+    with pytest.raises(ValueError):
+        mapped._columns["distance"][0] = 1.0
+    mapped[0]["fastest_time"] = "1:00"
+    assert mapped[0]["fastest_time"] == "1:00"
+
+    empty = str(tmp_path / "empty.columns")
+    SegmentColumns.from_records([]).save(empty)
+    assert len(load_columns(empty)) == 0
+
+
+def test_display_columns_without_copying(columns, tmp_path):
+    filename = str(tmp_path / "segments.json")
+    with open(filename, "w") as f:
+        json.dump(RECORDS, f)
+    from_list = SegmentsData(filename)
+    from_columns = SegmentsData(filename, data=columns)
+
+    displayed = from_columns.display_segments()
+    # The cache holds the derived arrays, not copies of the records
+    assert isinstance(displayed, DisplayedColumns)
+    assert displayed is from_columns.display_segments()
+    assert [seg["id"] for seg in displayed] == [3, 1, 2]
+    assert displayed[-1]["url"] == "https://www.strava.com/segments/2"
+    assert [seg["id"] for seg in displayed[:2]] == [3, 1]
+
+    for sort_by in ("distance", "climb", "effort_count"):
+        assert [seg["id"] for seg in from_columns.display_segments(sort_by)] == [
+            seg["id"] for seg in from_list.display_segments(sort_by)
+        ]
+    total, page = from_columns.query(filters={"distance": (500, None)})
+    assert total == 2
+    assert json.dumps(page, sort_keys=True) == json.dumps(
+        from_list.query(filters={"distance": (500, None)})[1], sort_keys=True
+    )
+
+
+def test_segments_data_from_columns(columns, tmp_path):
+    filename = str(tmp_path / "segments.json")
+    with open(filename, "w") as f:
+        json.dump(RECORDS, f)
+    from_list = SegmentsData(filename)
+    from_columns = SegmentsData(filename, data=columns)
+
+    # Compared as JSON, as the pace of segments without a time is NaN
+    assert json.dumps(list(from_columns.display_segments()), sort_keys=True) == json.dumps(
+        from_list.display_segments(), sort_keys=True
+    )
+    assert from_columns.get_segment(3)["distance"] == 2000.0
+
+    from_columns.add_segment({"id": 5, "distance": 10.0, "climb": 0.0})
+    from_columns.get_segment(1)["fastest_athlete"] = "C. Runner"
+    from_columns.touch(from_columns.get_segment(1))
+    from_columns.save()
+
+    with open(filename, "r") as f:
+        saved = json.load(f)
+    assert [seg["id"] for seg in saved] == [1, 2, 3, 5]
+    assert saved[0]["fastest_athlete"] == "C. Runner"
+    assert columns_filename(filename) == filename + ".columns"
+    assert not os.path.exists(columns_filename(filename))
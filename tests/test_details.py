@@ -0,0 +1,73 @@
+import threading
+from stravalib.client import Client
+from src.details import DetailCache, DetailPipeline
+
+
+def test_ids_fetched_once(mock_stravalib):
+    spy = mock_stravalib.spy(Client, "get_segment")
+    pipeline = DetailPipeline(Client(), workers=3)
+
+    pipeline.submit([1, 2, 3])
+    details = pipeline.fetch([3, 2, 2, 4])
+
+    assert [d["id"] for d in details] == [3, 2, 4]
+    assert pipeline.fetch([1])[0]["polyline"] == "abc"
+    assert sorted(call[0][-1] for call in spy.call_args_list) == [1, 2, 3, 4]
+
+
+def test_refresh_fetches_again(mock_stravalib):
+    spy = mock_stravalib.spy(Client, "get_segment")
+    pipeline = DetailPipeline(Client())
+
+    pipeline.fetch([1])
+    pipeline.fetch([1], refresh=True)
+
+    assert spy.call_count == 2
+
+
+def test_flush_drops_queued_fetches(mock_stravalib):
+    started, release = threading.Event(), threading.Event()
+    get_segment = Client.get_segment
+
+    def slow_get_segment(id):
+        started.set()
+        release.wait(5)
+        return get_segment(id)
+
+    spy = mock_stravalib.patch(
+        "stravalib.client.Client.get_segment", side_effect=slow_get_segment
+    )
+    pipeline = DetailPipeline(Client(), workers=1)
+    pipeline.submit([1, 2, 3, 4])
+    started.wait(5)
+    threading.Timer(0.1, release.set).start()
+    pipeline.flush()
+
+    # Only the fetch already running was made
+    assert spy.call_count == 1
+    assert 1 in pipeline.cache
+    # Dropped ids are fetched again when needed
+    assert [d["id"] for d in pipeline.fetch([2])] == [2]
+    assert spy.call_count == 2
+
+
+def test_cache_persisted(mock_stravalib, tmp_path):
+    filename = str(tmp_path / "segment_details.json")
+    pipeline = DetailPipeline(Client(), DetailCache(filename))
+    pipeline.fetch([1, 2])
+    pipeline.close()
+
+    spy = mock_stravalib.spy(Client, "get_segment")
+    details = DetailPipeline(Client(), DetailCache(filename)).fetch([2, 1])
+
+    assert [d["id"] for d in details] == [2, 1]
+    assert details[0]["start_latlng"] == [0.0, 0.0]
+    assert spy.call_count == 0
+
+
+def test_fill_polyline(mock_stravalib, segments_db):
+    segments_db.data = [{"id": 1, "polyline": None}, {"id": 2, "polyline": "xyz"}, {"id": 3}]
+
+    segments_db.fill_polyline()
+
+    assert [seg["polyline"] for seg in segments_db.data] == ["abc", "xyz", "abc"]
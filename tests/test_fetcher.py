@@ -0,0 +1,108 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.error import HTTPError
+import pytest
+import src
+from src.fetcher import Fetcher
+from src.leaderboard import LeaderboardParser
+from src.segment_crawler import fetch_leader
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+with open(os.path.join(DATA_DIR, "example_strava.html"), "rb") as f:
+    EXAMPLE_PAGE = f.read()
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server():
+    """Local server for the example page, which supports ETags and keep-alive"""
+    stats = {"connections": 0, "requests": 0, "not_modified": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            stats["connections"] += 1
+            super().setup()
+
+        def do_GET(self):
+            stats["requests"] += 1
+            if self.path != "/segments/1":
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            elif self.headers.get("If-None-Match") == '"v1"':
+                stats["not_modified"] += 1
+                self.send_response(304)
+                self.send_header("ETag", '"v1"')
+                self.end_headers()
+            else:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(EXAMPLE_PAGE)))
+                self.send_header("ETag", '"v1"')
+                self.end_headers()
+                self.wfile.write(EXAMPLE_PAGE)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{httpd.server_address[1]}", stats
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_connections_are_reused(server):
+    url, stats = server
+    fetcher = Fetcher()
+
+    for _ in range(3):
+        parser = LeaderboardParser()
+        assert fetcher.fetch(url + "/segments/1", parser) == EXAMPLE_PAGE.decode("utf8")
+        assert parser.leader == ("Miles Weatherseed", "4:05")
+
+    assert stats["requests"] == 3
+    assert stats["connections"] == 1
+
+
+def test_cache_and_revalidation(server, tmp_path):
+    url, stats = server
+    fetcher = Fetcher(cache_dir=str(tmp_path), ttl=3600)
+
+    fetcher.fetch(url + "/segments/1")
+    fetcher.fetch(url + "/segments/1")
+    assert stats["requests"] == 1
+
+    fetcher.ttl = 0
+    assert fetcher.fetch(url + "/segments/1") == EXAMPLE_PAGE.decode("utf8")
+    assert stats["not_modified"] == 1
+    assert fetcher.stats == {"hits": 1, "revalidated": 1, "downloaded": 1}
+
+
+def test_http_errors(server):
+    url, _ = server
+
+    with pytest.raises(HTTPError) as error:
+        Fetcher().fetch(url + "/segments/2")
+    assert error.value.code == 404
+
+
+def test_fetch_leader_uses_streaming_parser(server, mocker):
+    url, _ = server
+    mocker.patch("src.segment_crawler.get_fetcher", return_value=Fetcher())
+    mocker.patch("src.segment_crawler.STRAVA_URL", url)
+    full_parse = mocker.spy(src.segment_crawler, "parse_leader")
+
+    assert fetch_leader(1) == ("Miles Weatherseed", "4:05")
+    assert full_parse.call_count == 0
@@ -0,0 +1,113 @@
+import threading
+import pytest
+from src.jobs import Cancelled, Job, JobConflict, JobRunner
+
+
+@pytest.fixture
+def runner():
+    runner = JobRunner(workers=2)
+    try:
+        yield runner
+    finally:
+        runner.shutdown(wait=False)
+
+
+def wait_for(job, timeout=5):
+    for _ in range(int(timeout / 0.01)):
+        if not job.active:
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError(f"Job still {job.status}")
+
+
+def test_job_reports_progress(runner):
+    def work(job):
+        job.report(pages_total=3)
+        for _ in range(3):
+            job.report(pages_done=1)
+
+    job = runner.submit("oxford", "refresh", work)
+    wait_for(job)
+
+    progress = job.to_dict()
+    assert progress["status"] == "done"
+    assert progress["progress"] == {"pages_total": 3, "pages_done": 3}
+    assert progress["phase"] == "pages"
+    assert runner.get(job.id) is job
+
+
+def test_one_job_per_location(runner):
+    release = threading.Event()
+    first = runner.submit("oxford", "retrieve", lambda job: release.wait(5))
+
+    with pytest.raises(JobConflict) as e:
+        runner.submit("oxford", "retrieve", lambda job: None)
+    assert e.value.job is first
+
+    # Other locations aren't held up
+    other = runner.submit("london", "retrieve", lambda job: None)
+    wait_for(other)
+    assert other.status == "done"
+
+    release.set()
+    wait_for(first)
+    again = runner.submit("oxford", "retrieve", lambda job: None)
+    wait_for(again)
+    assert runner.current("oxford") is again
+
+
+def test_cancel_job(runner):
+    started = threading.Event()
+
+    def work(job):
+        started.set()
+        while True:
+            job.report(done=1)
+            threading.Event().wait(0.01)
+
+    job = runner.submit("oxford", "retrieve", work)
+    started.wait(5)
+    assert runner.cancel(job.id) is job
+    wait_for(job)
+
+    assert job.status == "cancelled"
+    assert runner.cancel("unknown") is None
+
+
+def test_failed_job(runner):
+    def work(job):
+        raise ValueError("No bounds")
+
+    job = runner.submit("oxford", "retrieve", work)
+    wait_for(job)
+
+    assert job.status == "failed"
+    assert job.error == "No bounds"
+
+
+def test_eta(mocker):
+    job = Job("oxford", "retrieve")
+    assert job.eta() is None
+
+    now = mocker.patch("src.jobs.time.time", return_value=100.0)
+    job.status = "running"
+    job.started_at = 100.0
+    job.report(regions_total=5)
+    now.return_value = 110.0
+    job.report(regions_done=1)
+    assert job.phase == "regions"
+    assert job.eta() == 40.0
+
+    # The next phase is estimated from when it started
+    now.return_value = 200.0
+    job.report(pages_total=10)
+    assert job.phase == "pages"
+    assert job.eta() is None
+    now.return_value = 205.0
+    job.report(pages_done=5, regions_done=4)
+    assert job.phase == "pages"
+    assert job.eta() == 5.0
+
+    job.cancel()
+    with pytest.raises(Cancelled):
+        job.report(done=1)
@@ -0,0 +1,94 @@
+import os
+import pytest
+import src
+from src.fetcher import Fetcher
+from src.leaderboard import LeaderboardParser, parse_leader
+from src.segment_crawler import fetch_leader
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+@pytest.fixture
+def example_html():
+    with open(os.path.join(DATA_DIR, "example_strava.html"), "r") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 100, 4096, 1000000])
+def test_streaming_matches_full_parse(example_html, chunk_size):
+    parser = LeaderboardParser()
+    fed = 0
+    while not parser.done and fed < len(example_html):
+        parser.feed(example_html[fed:fed + chunk_size])
+        fed += chunk_size
+
+    assert parser.leader == parse_leader(example_html) == ("Miles Weatherseed", "4:05")
+    assert fed < len(example_html) or chunk_size > len(example_html)
+
+
+def test_streaming_parser_unclosed_row():
+    html = (
+        "<table class='table-leaderboard'><tbody>"
+        "<tr><td>1</td><td> Name </td><td>3:20</td>"
+        "<tr><td>2</td><td>Other</td><td>3:30</td>"
+        "</tbody></table>"
+    )
+    parser = LeaderboardParser()
+    parser.feed(html)
+
+    assert parser.leader == parse_leader(html) == ("Name", "3:30")
+
+
+class StreamedPage:
+    """Response streaming a page in chunks, counting the bytes read"""
+
+    status_code = 200
+    headers = {}
+
+    def __init__(self, page):
+        self.page = page
+        self.read = 0
+
+    def iter_content(self, chunk_size):
+        while self.read < len(self.page):
+            chunk = self.page[self.read:self.read + chunk_size]
+            self.read += len(chunk)
+            yield chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+@pytest.mark.parametrize("drain_limit", [0, 20000, None])
+def test_fetch_leader_stops_feeding_parser(mocker, example_html, drain_limit):
+    page = StreamedPage(example_html.encode("utf8"))
+    fetcher = Fetcher(drain_limit=drain_limit)
+    mocker.patch.object(fetcher, "_get", return_value=page)
+    mocker.patch("src.segment_crawler.get_fetcher", return_value=fetcher)
+    fed = []
+    feed = LeaderboardParser.feed
+    mocker.patch.object(LeaderboardParser, "feed", lambda self, data: fed.append(data) or feed(self, data))
+    full_parse = mocker.spy(src.segment_crawler, "parse_leader")
+
+    assert fetch_leader(1) == ("Miles Weatherseed", "4:05")
+    assert full_parse.call_count == 0
+    # The parser is done, and stops being fed, before the end of the page
+    parsed = len("".join(fed))
+    assert parsed < len(example_html)
+
+    if drain_limit is None:
+        assert page.read == len(page.page)
+    else:
+        # Reading stops at the first chunk past the limit
+        assert page.read <= max(parsed, drain_limit) + 16384
+        assert page.read < len(page.page)
+
+
+def test_fetch_leader_falls_back_to_full_parse(mocker):
+    html = "<table class='table-leaderboard'><tbody><tr><td>1</td><td>Name</td><td>1:00</td></tr></tbody></table>"
+    mocker.patch("src.segment_crawler.get_html_from_url", return_value=html)
+
+    assert fetch_leader(1) == ("Name", "1:00")
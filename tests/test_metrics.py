@@ -0,0 +1,91 @@
+import pytest
+from src import metrics
+from src.metrics import Registry
+from src.segment_crawler import SegmentCrawler
+
+
+def test_render_prometheus_text():
+    registry = Registry()
+    calls = registry.counter("api_calls_total", "API calls", ["call"])
+    seconds = registry.histogram("op_seconds", "Latency", ["operation"], buckets=(0.1, 1))
+    depth = registry.gauge("max_zoom", "Deepest zoom")
+
+    calls.inc(call="explore_segments")
+    calls.inc(2, call="get_segment")
+    seconds.observe(0.05, operation="save")
+    seconds.observe(0.5, operation="save")
+    seconds.observe(5, operation="save")
+    depth.set_max(3)
+    depth.set_max(1)
+
+    lines = registry.render().splitlines()
+    assert "# TYPE api_calls_total counter" in lines
+    assert 'api_calls_total{call="get_segment"} 2' in lines
+    assert 'op_seconds_bucket{operation="save",le="0.1"} 1' in lines
+    assert 'op_seconds_bucket{operation="save",le="1"} 2' in lines
+    assert 'op_seconds_bucket{operation="save",le="+Inf"} 3' in lines
+    assert 'op_seconds_count{operation="save"} 3' in lines
+    assert "max_zoom 3" in lines
+
+    assert registry.counter("api_calls_total", "API calls", ["call"]) is calls
+    with pytest.raises(ValueError):
+        registry.gauge("api_calls_total", "API calls")
+    with pytest.raises(ValueError):
+        calls.inc(operation="save")
+
+
+def test_merge_snapshots():
+    def make_registry():
+        registry = Registry()
+        return (
+            registry,
+            registry.counter("api_calls_total", "API calls", ["call"]),
+            registry.histogram("op_seconds", "Latency", ["operation"], buckets=(0.1, 1)),
+            registry.gauge("max_zoom", "Deepest zoom"),
+        )
+
+    worker, calls, seconds, depth = make_registry()
+    calls.inc(3, call="page")
+    seconds.observe(0.5, operation="save")
+    depth.set(4)
+    snapshot = worker.snapshot()
+
+    main, calls, seconds, depth = make_registry()
+    calls.inc(call="page")
+    seconds.observe(2.0, operation="save")
+    depth.set(2)
+    main.merge(snapshot)
+    main.merge(snapshot)
+
+    assert calls.get(call="page") == 7
+    assert seconds.get(operation="save") == {
+        "buckets": [0, 2, 1], "count": 3, "sum": 3.0, "max": 2.0
+    }
+    assert depth.get() == 4
+    # Merging copied the snapshot rather than sharing it
+    assert snapshot["op_seconds"][(("operation", "save"),)]["count"] == 1
+
+
+def test_crawl_metrics(segments_db, regions_db, mock_stravalib):
+    metrics.REGISTRY.reset()
+    mock_stravalib.patch(
+        "stravalib.client.Client.explore_segments",
+        side_effect=lambda bounds, activity_type: [
+            mock_stravalib.Mock(id=int(bounds[0][0] * 1000) + i)
+            for i in range(10 if bounds[1][0] - bounds[0][0] > 0.5 else 3)
+        ],
+    )
+    crawler = SegmentCrawler(segments_db.client, segments_db, regions_db)
+    crawler.retrieve_segments_frontier([[0, 0], [1, 1]])
+
+    assert metrics.API_CALLS.get(call="explore_segments") == 5
+    assert metrics.API_CALLS.get(call="get_segment") == len(segments_db.data)
+    assert metrics.OPERATION_SECONDS.get(operation="explore_segments")["count"] == 5
+    assert metrics.SAVE_BYTES.get(data="segments")["sum"] > 0
+    assert metrics.CRAWL_MAX_ZOOM.get() == 1
+
+    segments_db.display_segments()
+    segments_db.display_segments()
+    assert ("display", 0.5, 2) in metrics.cache_hit_rates()
+    summary = "\n".join(metrics.summary())
+    assert "explore_segments: 5 calls" in summary
@@ -0,0 +1,90 @@
+import pytest
+from src.polyline import (
+    PolylineCache,
+    decode,
+    decode_array,
+    decode_many,
+    encode,
+    polyline_bounds,
+    significance,
+    simplify,
+)
+
+
+def test_decode():
+    assert decode("_p~iF~ps|U_ulLnnqC_mqNvxq`@") == [
+        (38.5, -120.2),
+        (40.7, -120.95),
+        (43.252, -126.453),
+    ]
+    assert decode("") == []
+
+
+def test_polyline_bounds():
+    assert polyline_bounds("_p~iF~ps|U_ulLnnqC_mqNvxq`@") == (
+        (38.5, -126.453),
+        (43.252, -120.2),
+    )
+    assert polyline_bounds(None) is None
+
+
+EXAMPLE = "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+
+
+def test_decode_array_matches_decode():
+    import numpy as np
+
+    points = decode_array(EXAMPLE)
+    assert points.shape == (3, 2)
+    assert np.allclose(points, decode(EXAMPLE))
+    assert decode_array("").shape == (0, 2)
+    with pytest.raises(ValueError):
+        decode_array(EXAMPLE[:-1])
+
+
+def test_encode_round_trip():
+    assert encode(decode(EXAMPLE)) == EXAMPLE
+    assert encode(decode_array(EXAMPLE)) == EXAMPLE
+    assert [encode(points) for points in decode_many([EXAMPLE, ""])] == [EXAMPLE, ""]
+
+
+def test_simplify():
+    import numpy as np
+
+    # A straight line with a small wobble and one big detour
+    points = np.array(
+        [(0.0, 0.0), (1.0, 0.001), (2.0, 0.0), (3.0, 1.0), (4.0, 0.0), (5.0, 0.0)]
+    )
+
+    assert simplify(points, 0.01).tolist() == [
+        [0.0, 0.0], [2.0, 0.0], [3.0, 1.0], [4.0, 0.0], [5.0, 0.0]
+    ]
+    assert simplify(points, 0.0001).tolist() == points.tolist()
+    assert simplify(points, 10).tolist() == [[0.0, 0.0], [5.0, 0.0]]
+
+    kept = significance(points)
+    for tolerance in (0.0001, 0.01, 0.5, 10):
+        assert simplify(points, tolerance).tolist() == points[kept > tolerance].tolist()
+
+
+def test_polyline_cache():
+    cache = PolylineCache(min_zoom=8, max_zoom=17)
+    # A wiggly line a few km long
+    points = [(51.75 + i * 0.0005, -1.25 + 0.00005 * (-1) ** i) for i in range(100)]
+    polyline = encode(points)
+
+    coarse = cache.get(1, polyline, 10)
+    fine = cache.get(1, polyline, 16)
+    assert len(decode(coarse)) < len(decode(fine)) <= len(points)
+    assert decode(coarse)[0] == points[0] and decode(coarse)[-1] == points[-1]
+    # Full detail at high zoom
+    assert cache.get(1, polyline, 17) == polyline
+    # Zoomed out further than min_zoom is the same as min_zoom
+    assert cache.get(1, polyline, 2) == cache.get(1, polyline, 8)
+    assert len(cache) == 1
+
+    # A changed polyline is simplified again
+    assert cache.get(1, EXAMPLE, 10) == cache.get(2, EXAMPLE, 10)
+    assert cache.simplify_segments([{"id": 3, "polyline": None}], 10) == [
+        {"id": 3, "polyline": None}
+    ]
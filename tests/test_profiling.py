@@ -0,0 +1,91 @@
+import os
+import threading
+from src.profiling import SamplingProfiler, folded_stack, profile, profiled
+
+
+def wait_in_here(started, finish):
+    started.set()
+    finish.wait()
+
+
+def test_sampling_profiler(tmp_path):
+    started, finish = threading.Event(), threading.Event()
+    thread = threading.Thread(target=wait_in_here, args=(started, finish), name="waiter")
+    thread.start()
+    started.wait()
+    try:
+        profiler = SamplingProfiler(threads=[thread.ident])
+        profiler.sample()
+        profiler.sample()
+        everyone = SamplingProfiler()
+        everyone.sample()
+    finally:
+        finish.set()
+        thread.join()
+
+    # Only the waiting thread, the same stack each time
+    assert profiler.samples == 2
+    [(stack, count)] = profiler.stacks.items()
+    assert count == 2
+    frames = stack.split(";")
+    assert frames[0].startswith("_bootstrap (")
+    line = wait_in_here.__code__.co_firstlineno
+    assert frames.index(f"wait_in_here (tests/test_profiling.py:{line})") < len(frames) - 1
+    assert frames[-1].startswith("wait (")
+
+    # Every thread but the sampling one, named
+    assert any(stack.startswith("waiter;") for stack in everyone.stacks)
+    assert not any(stack.startswith("MainThread;") for stack in everyone.stacks)
+
+    filename = profiler.write(str(tmp_path / "profiles" / "waiter.folded"))
+    with open(filename) as f:
+        assert f.read() == f"{stack} 2\n"
+
+
+def test_folded_stack():
+    def inner():
+        import sys
+        return folded_stack(sys._getframe())
+
+    stack = inner().split(";")
+    line = test_folded_stack.__code__.co_firstlineno
+    assert stack[-2:] == [
+        f"test_folded_stack (tests/test_profiling.py:{line})",
+        f"inner (tests/test_profiling.py:{line + 1})",
+    ]
+    # Library code is named by its package
+    assert any(frame.startswith("pytest_pyfunc_call (_pytest/python.py:") for frame in stack)
+
+
+def busy(seconds):
+    import time
+    end = time.perf_counter() + seconds
+    total = 0
+    while time.perf_counter() < end:
+        total += 1
+    return total
+
+
+def test_profile(tmp_path, monkeypatch):
+    monkeypatch.setenv("PROFILE_DIR", str(tmp_path))
+    with profile("some crawl", interval=0.001) as profiler:
+        busy(0.1)
+
+    assert profiler.samples > 0
+    assert os.path.dirname(profiler.filename) == str(tmp_path)
+    assert os.path.basename(profiler.filename).startswith("some_crawl-")
+    with open(profiler.filename) as f:
+        lines = f.read().splitlines()
+    assert any("busy (tests/test_profiling.py" in line for line in lines)
+    assert all(int(line.rsplit(" ", 1)[1]) > 0 for line in lines)
+
+
+def test_profiled(tmp_path):
+    func = profiled(busy, "job", directory=str(tmp_path))
+    assert func(0.05) > 0
+    [filename] = os.listdir(tmp_path)
+    assert filename.startswith("job-") and filename.endswith(".folded")
+    with open(tmp_path / filename) as f:
+        lines = f.read().splitlines()
+    # Only the calling thread, so no thread names
+    assert all("test_profiled (tests/test_profiling.py" in line for line in lines)
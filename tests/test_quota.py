@@ -0,0 +1,152 @@
+import multiprocessing
+import pytest
+from stravalib.client import Client
+from stravalib.exc import RateLimitExceeded
+from src.quota import (
+    CHECK_INTERVAL,
+    QuotaExhausted,
+    QuotaScheduler,
+    ScheduledClient,
+    SharedQuotaScheduler,
+    parse_rate_headers,
+)
+
+
+class FakeClock:
+    def __init__(self, now=0.0):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def make_scheduler(clock, cls=QuotaScheduler, **kwargs):
+    return cls(clock=clock, sleep=clock.sleep, **kwargs)
+
+
+def test_parse_rate_headers():
+    headers = {"X-RateLimit-Usage": "5,120", "X-RateLimit-Limit": "100,1000"}
+    assert parse_rate_headers(headers) == (5, 120, 100, 1000)
+    assert parse_rate_headers({}) is None
+    assert parse_rate_headers({"X-RateLimit-Usage": "x", "X-RateLimit-Limit": "1,2"}) is None
+
+
+@pytest.mark.parametrize("cls", [QuotaScheduler, SharedQuotaScheduler])
+def test_waits_for_next_window(cls):
+    clock = FakeClock(now=100.0)
+    scheduler = make_scheduler(clock, cls, short_limit=3, long_limit=100, headroom=0)
+
+    for _ in range(3):
+        scheduler.acquire()
+    assert clock.sleeps == []
+
+    scheduler.acquire()
+    # Quota resets on the quarter hour
+    assert clock.sleeps == [800.0]
+    assert scheduler.requests == 4
+
+
+def test_wait_stops_when_checked():
+    clock = FakeClock(now=0.0)
+    scheduler = make_scheduler(clock, short_limit=1, long_limit=100, headroom=0)
+    scheduler.acquire()
+
+    def check():
+        if clock.now >= 30.0:
+            raise RuntimeError("Cancelled")
+
+    with pytest.raises(RuntimeError):
+        scheduler.acquire(check)
+    # Waited in short sleeps, not until the next window
+    assert clock.sleeps == [CHECK_INTERVAL] * 6
+    assert scheduler.requests == 1
+
+
+def test_follows_response_headers():
+    clock = FakeClock(now=0.0)
+    scheduler = make_scheduler(clock, short_limit=100, long_limit=1000, headroom=1)
+
+    # Other clients of the app have used most of the window
+    scheduler({"X-RateLimit-Usage": "48,200", "X-RateLimit-Limit": "50,1000"})
+    scheduler.acquire()
+    assert clock.sleeps == []
+    scheduler.acquire()
+    assert clock.sleeps == [900.0]
+
+
+@pytest.mark.parametrize("cls", [QuotaScheduler, SharedQuotaScheduler])
+def test_daily_quota_exhausted(cls):
+    clock = FakeClock(now=1000.0)
+    scheduler = make_scheduler(clock, cls, short_limit=100, long_limit=2, headroom=0)
+    scheduler.acquire()
+    scheduler.acquire()
+
+    with pytest.raises(QuotaExhausted) as e:
+        scheduler.acquire()
+    assert e.value.seconds_until_reset == 24 * 60 * 60 - 1000
+
+    # A new day starts with a fresh quota
+    clock.now = 24 * 60 * 60
+    scheduler.acquire()
+
+
+def use_quota(scheduler, granted, attempts):
+    for _ in range(attempts):
+        try:
+            scheduler.acquire()
+        except QuotaExhausted:
+            granted.put(False)
+        else:
+            granted.put(True)
+
+
+def test_shared_quota_across_processes():
+    scheduler = SharedQuotaScheduler(short_limit=100, long_limit=5, headroom=0)
+    granted = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=use_quota, args=(scheduler, granted, 4))
+        for _ in range(2)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    # The processes share the daily quota, rather than each using its own
+    assert sum(granted.get(timeout=5) for _ in range(8)) == 5
+    assert scheduler.requests == 5
+
+
+def test_scheduled_client_paces_calls(mocker):
+    clock = FakeClock(now=0.0)
+    scheduler = make_scheduler(clock, short_limit=2, long_limit=100, headroom=0)
+    explore = mocker.patch(
+        "stravalib.client.Client.explore_segments", return_value=[]
+    )
+    client = ScheduledClient(Client(), scheduler)
+
+    assert client.protocol.rate_limiter is scheduler
+    for _ in range(3):
+        client.explore_segments([(0, 0), (1, 1)], activity_type="running")
+
+    assert explore.call_count == 3
+    assert clock.sleeps == [900.0]
+
+
+def test_scheduled_client_retries_after_rate_limit(mocker):
+    clock = FakeClock(now=60.0)
+    scheduler = make_scheduler(clock, short_limit=100, long_limit=1000)
+    get_segment = mocker.patch(
+        "stravalib.client.Client.get_segment",
+        side_effect=[RateLimitExceeded("Rate limit exceeded"), "segment"],
+    )
+    client = ScheduledClient(Client(), scheduler)
+
+    assert client.get_segment(1) == "segment"
+    assert get_segment.call_count == 2
+    assert clock.sleeps == [840.0]
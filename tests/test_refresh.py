@@ -0,0 +1,80 @@
+from src.refresh import (
+    CHECKED,
+    NEVER_CHECKED,
+    NEVER_RETRIEVED,
+    area_counts,
+    refresh_priority,
+    schedule_refresh,
+)
+
+DAY = 24 * 60 * 60
+NOW = 1000 * DAY
+
+
+def segment(id, checked_days_ago=None, effort_count=10, start=(51.75, -1.25)):
+    seg = {"id": id, "effort_count": effort_count, "start_latlng": list(start)}
+    if checked_days_ago is not None:
+        seg["fastest_athlete"] = "A"
+        seg["checked_at"] = NOW - checked_days_ago * DAY
+    return seg
+
+
+def unchecked(id, effort_count=10, start=(51.75, -1.25)):
+    """Retrieved before checked_at was recorded"""
+    return dict(segment(id, effort_count=effort_count, start=start), fastest_athlete="A")
+
+
+def test_refresh_priority():
+    assert refresh_priority(segment(1), NOW) == (NEVER_RETRIEVED, 0.0)
+    assert refresh_priority(unchecked(1), NOW) == (NEVER_CHECKED, 11.0)
+    assert refresh_priority(unchecked(1, effort_count=1000), NOW) > refresh_priority(unchecked(1), NOW)
+    assert refresh_priority(unchecked(1), NOW, neighbours=50) > refresh_priority(unchecked(1), NOW)
+
+    old = refresh_priority(segment(1, checked_days_ago=30), NOW)
+    recent = refresh_priority(segment(1, checked_days_ago=1), NOW)
+    popular = refresh_priority(segment(1, checked_days_ago=1, effort_count=1000), NOW)
+    busy_area = refresh_priority(segment(1, checked_days_ago=1), NOW, neighbours=50)
+    assert old > recent
+    assert popular > recent
+    assert busy_area > recent
+    assert refresh_priority(segment(1, checked_days_ago=0), NOW) == (CHECKED, 0.0)
+    # Unknown ages come before known ones
+    assert refresh_priority(unchecked(1, effort_count=0), NOW) > old
+
+
+def test_area_counts():
+    segments = [segment(1), segment(2), segment(3, start=(52.0, 0.0)), {"id": 4}]
+    assert sorted(area_counts(segments).values()) == [1, 2]
+
+
+def test_schedule_refresh():
+    segments = [
+        segment(1, checked_days_ago=10),
+        segment(2),
+        segment(3, checked_days_ago=10, effort_count=5000),
+        segment(4, checked_days_ago=0),
+        segment(5, checked_days_ago=100),
+        segment(6),
+    ]
+
+    scheduled = [seg["id"] for seg in schedule_refresh(segments, now=NOW)]
+    # Never retrieved first, and not anything just checked
+    assert scheduled == [2, 6, 3, 5, 1]
+
+    assert [seg["id"] for seg in schedule_refresh(segments, budget=3, now=NOW)] == [2, 6, 3]
+    assert schedule_refresh(segments, budget=0, now=NOW) == []
+
+
+def test_schedule_refresh_without_checked_at():
+    # Data from before checked_at was recorded
+    segments = [
+        unchecked(1, effort_count=10),
+        unchecked(2, effort_count=500),
+        segment(3),
+        unchecked(4, effort_count=10, start=(52.0, 0.0)),
+        unchecked(5, effort_count=10),
+    ]
+
+    scheduled = [seg["id"] for seg in schedule_refresh(segments, now=NOW)]
+    # By effort count, then how busy the area is, rather than stored order
+    assert scheduled == [3, 2, 1, 5, 4]
@@ -1,3 +1,6 @@
+from src.regions import RegionsData
+from src.spatial import QuadTree
+
 
 def test_save(regions_db):
     regions_db.init_region([(0, 1), (2, 3)])
@@ -5,3 +8,40 @@ def test_save(regions_db):
 
     assert regions_db.display() == [{'bounds': [(0, 1), (2, 3)], 'explored': False}]
 
+
+def test_get_region_ignores_sequence_type(regions_db):
+    region = regions_db.init_region([(0, 1), (2, 3)])
+
+    assert regions_db.get_region([[0.0, 1.0], [2.0, 3.0]]) is region
+    assert len(regions_db.data) == 1
+
+
+def test_is_explored_by_coverage(regions_db):
+    regions_db.set_explored([(0, 0), (1, 2)], True)
+    regions_db.set_explored([(1, 0), (2, 2)], True)
+
+    assert regions_db.is_explored([(0, 0), (2, 2)])
+    assert regions_db.is_explored([(0.5, 0.5), (1.5, 1.5)])
+    assert not regions_db.is_explored([(1.5, 1.5), (2.5, 2.5)])
+
+
+def test_explored_regions_reload(regions_db):
+    regions_db.set_explored([(0, 0), (2, 2)], True)
+    regions_db.save()
+
+    reloaded = RegionsData(regions_db.filename)
+    assert reloaded.is_covered([(0.5, 0.5), (1, 1)])
+    assert reloaded.region_path([(0.5, 0.5), (1, 1)]).startswith("2")
+
+
+def test_quadtree_query_and_cover():
+    tree = QuadTree()
+    tree.insert([(0, 0), (1, 1)], "a")
+    tree.insert([(1, 0), (2, 1)], "b")
+    tree.insert([(10, 10), (11, 11)], "c")
+
+    assert sorted(tree.query([(0.5, 0.5), (1.5, 0.6)])) == ["a", "b"]
+    assert tree.covers([(0.2, 0.2), (1.8, 0.8)])
+    assert not tree.covers([(0.2, 0.2), (1.8, 1.2)])
+    assert tree.remove([(10, 10), (11, 11)], "c")
+    assert tree.query([(10, 10), (11, 11)]) == []
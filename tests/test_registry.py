@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+import time
+import pytest
+from src.locking import RWLock
+from src.regions import RegionsData
+from src.registry import CoalescingStore, DatasetRegistry
+from src.segment_crawler import SegmentsData
+from src.storage import JournalStore, SnapshotStore
+
+
+def test_rwlock_readers_share_writers_exclude():
+    lock = RWLock()
+    inside = []
+    both_reading = threading.Barrier(2, timeout=5)
+
+    def reader():
+        with lock.read():
+            # Deadlocks (and times out) unless both can read at once
+            both_reading.wait()
+            inside.append("read")
+
+    threads = [threading.Thread(target=reader) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert inside == ["read", "read"]
+
+    order = []
+
+    def read_after_write():
+        with lock.read():
+            order.append("read")
+
+    with lock.write():
+        reading = threading.Thread(target=read_after_write)
+        reading.start()
+        time.sleep(0.05)
+        order.append("write")
+        # Reentrant, and the writer may also read
+        with lock.write(), lock.read():
+            pass
+    reading.join()
+    assert order == ["write", "read"]
+
+    with lock.read():
+        with pytest.raises(RuntimeError):
+            with lock.write():
+                pass
+
+
+class CountingStore(SnapshotStore):
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.calls = []
+
+    def save(self, data, changed=None):
+        self.calls.append(None if changed is None else list(changed))
+        return super().save(data, changed)
+
+
+def test_coalescing_store(tmp_path):
+    filename = str(tmp_path / "segments.json")
+    store = CountingStore(filename)
+    coalescing = CoalescingStore(store, RWLock(), delay=60)
+    data = [{"id": 1}, {"id": 2}]
+
+    assert coalescing.save(data, [data[0]]) is None
+    coalescing.save(data, [data[1]])
+    coalescing.save(data, [data[0]])
+    assert store.calls == [] and coalescing.pending
+
+    coalescing.flush()
+    assert store.calls == [[data[0], data[1]]]
+    with open(filename) as f:
+        assert json.load(f) == data
+
+    coalescing.save(data, [data[0]])
+    coalescing.save(data)
+    coalescing.flush()
+    coalescing.flush()
+    assert store.calls[1:] == [None]
+    assert (coalescing.saves, coalescing.writes) == (5, 2)
+
+
+def test_coalescing_store_writes_after_delay(tmp_path):
+    store = CountingStore(str(tmp_path / "segments.json"))
+    coalescing = CoalescingStore(store, RWLock(), delay=0.01)
+    for n in range(10):
+        coalescing.save([{"id": n}], [])
+
+    deadline = time.time() + 5
+    while coalescing.pending and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(store.calls) == 1
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    os.makedirs(tmp_path / "oxford")
+    with open(tmp_path / "oxford" / "segments.json", "w") as f:
+        json.dump([{"id": 1, "name": "a", "distance": 1000, "climb": 1, "fastest_time": "3:00"}], f)
+    with open(tmp_path / "oxford" / "regions.json", "w") as f:
+        json.dump([{"bounds": [[0, 0], [1, 1]], "explored": False}], f)
+    return tmp_path
+
+
+def make_registry(data_dir, loads, store=None):
+    def load_segments(path):
+        loads.append(path)
+        return SegmentsData(path, store=store(path) if store else None)
+
+    return DatasetRegistry(
+        lambda location, filetype: str(data_dir / location / f"{filetype}.json"),
+        load_segments,
+        RegionsData,
+        flush_delay=60,
+    )
+
+
+def test_registry_shares_datasets(data_dir):
+    loads = []
+    registry = make_registry(data_dir, loads)
+    datasets = []
+
+    def open_dataset():
+        with registry.open("oxford") as dataset:
+            datasets.append(dataset)
+
+    threads = [threading.Thread(target=open_dataset) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(loads) == 1
+    assert all(dataset is datasets[0] for dataset in datasets)
+
+    with registry.open("oxford") as dataset:
+        version = dataset.version
+        for id in range(2, 12):
+            dataset.segments.add_segment({"id": id, "distance": 1000, "climb": 0})
+            dataset.segments.save()
+        dataset.regions.set_explored([[0, 0], [1, 1]], True)
+        dataset.regions.save()
+        assert dataset.version != version
+        assert dataset.segments.store.saves == 10 and dataset.segments.store.writes == 0
+
+    registry.flush()
+    with open(data_dir / "oxford" / "segments.json") as f:
+        assert len(json.load(f)) == 11
+    with open(data_dir / "oxford" / "regions.json") as f:
+        assert json.load(f)[0]["explored"]
+
+    # Our own writes don't cause a reload
+    with registry.open("oxford"):
+        pass
+    assert len(loads) == 1
+
+
+def test_registry_ignores_own_compaction(data_dir):
+    loads = []
+    registry = make_registry(data_dir, loads, lambda path: JournalStore(path, compact_threshold=1))
+    with registry.open("oxford") as dataset:
+        dataset.segments.add_segment({"id": 2, "distance": 1000, "climb": 0})
+        dataset.segments.save()
+    # Compacts the journal into the snapshot in the background
+    registry.flush()
+    dataset.segments.store.store._wait_for_compaction()
+
+    with registry.open("oxford") as reopened:
+        assert reopened is dataset
+    assert len(loads) == 1
+
+
+def test_registry_reloads_when_changed_on_disk(data_dir):
+    loads = []
+    registry = make_registry(data_dir, loads)
+    with registry.open("oxford") as dataset:
+        pass
+
+    # e.g. run.py updating the location
+    time.sleep(0.01)
+    with open(data_dir / "oxford" / "segments.json", "w") as f:
+        json.dump([], f)
+
+    with registry.open("oxford") as reloaded:
+        assert reloaded is not dataset
+        assert reloaded.segments.data == []
+    assert len(loads) == 2
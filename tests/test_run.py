@@ -0,0 +1,170 @@
+import argparse
+import json
+import multiprocessing
+import os
+from src import run
+from src.locking import file_lock
+from src.metrics import OPERATION_SECONDS, REGISTRY
+from src.quota import SharedQuotaScheduler
+from src.throttle import SharedRateLimiter
+
+
+def make_args(data_dir, **kwargs):
+    defaults = dict(
+        data_dir=str(data_dir),
+        reparse=False,
+        workers=1,
+        rate=0,
+        cache_dir=None,
+        cache_ttl=0,
+        drain_limit=None,
+        processes=2,
+        budget=None,
+        stats=False,
+        profile=False,
+        profile_dir=None,
+    )
+    defaults.update(kwargs)
+    return argparse.Namespace(**defaults)
+
+
+def make_location(data_dir, location, count):
+    os.makedirs(data_dir / location)
+    segments = [{"id": id, "name": f"{location} {id}", "distance": 1000.0, "climb": 1.0}
+                for id in range(count)]
+    with open(data_dir / location / "segments.json", "w") as f:
+        json.dump(segments, f)
+
+
+def fake_retrieve(segments, force_retrieve=False, workers=1, rate_limiter=None, progress=None,
+                  budget=None, refresh_stats=False):
+    to_fill = [seg for seg in segments.data if "fastest_athlete" not in seg]
+    progress(pages_total=len(to_fill))
+    for segment in to_fill:
+        segments.update(segment, fastest_athlete="A", fastest_time="3:00")
+        progress(pages_done=1)
+
+
+def test_refresh_location(tmp_path, mocker):
+    mocker.patch("src.run.retrieve_fastest_times", side_effect=fake_retrieve)
+    make_location(tmp_path, "oxford", 3)
+    make_location(tmp_path, "bristol", 2)
+    os.makedirs(tmp_path / "empty")
+    args = make_args(tmp_path)
+
+    assert run.find_locations(str(tmp_path)) == ["bristol", "oxford"]
+
+    progress = []
+    result = run.refresh_location("oxford", args, None, lambda *p: progress.append(p))
+    assert result["status"] == "done"
+    assert (result["pages_total"], result["pages_done"]) == (3, 3)
+    assert progress[0] == ("oxford", {"pages_total": 3})
+    with open(tmp_path / "oxford" / "segments.json") as f:
+        assert all(seg["fastest_athlete"] == "A" for seg in json.load(f))
+
+    # Another run of the same location is skipped
+    with file_lock(str(tmp_path / "bristol" / run.LOCK_FILENAME)):
+        assert run.refresh_location("bristol", args, None)["status"] == "locked"
+
+
+def test_run_batch(tmp_path, mocker):
+    # Workers are forked, so inherit the patch
+    mocker.patch("src.run.retrieve_fastest_times", side_effect=fake_retrieve)
+    for n, location in enumerate(["a", "b", "c"]):
+        make_location(tmp_path, location, n + 1)
+
+    REGISTRY.reset()
+    results = run.run_batch(["a", "b", "c"], make_args(tmp_path), report_interval=0)
+
+    assert [result["location"] for result in results] == ["a", "b", "c"]
+    assert [result["status"] for result in results] == ["done"] * 3
+    assert [result["pages_done"] for result in results] == [1, 2, 3]
+    for location in ["a", "b", "c"]:
+        with open(tmp_path / location / "segments.json") as f:
+            assert all("fastest_athlete" in seg for seg in json.load(f))
+    # The workers' metrics are merged in this process
+    assert OPERATION_SECONDS.get(operation="save_segments")["count"] >= 3
+
+
+def test_run_batch_shares_quota(tmp_path, mocker):
+    mocker.patch("src.run.retrieve_fastest_times", side_effect=fake_retrieve)
+    quota = SharedQuotaScheduler()
+    mocker.patch("src.run.SharedQuotaScheduler", return_value=quota)
+    # Each location's client makes one API call
+    mocker.patch("src.run.make_client", side_effect=lambda quota: quota.acquire())
+    for location in ["a", "b", "c"]:
+        make_location(tmp_path, location, 1)
+
+    results = run.run_batch(["a", "b", "c"], make_args(tmp_path, stats=True), report_interval=60)
+    assert [result["status"] for result in results] == ["done"] * 3
+    # Counted against the same quota in every worker process
+    assert quota.requests == 3
+
+
+def chatty_retrieve(segments, force_retrieve=False, progress=None, **kwargs):
+    progress(pages_total=20000)
+    for _ in range(20000):
+        progress(pages_done=1)
+
+
+def test_run_batch_reads_all_progress(tmp_path, mocker):
+    # More progress than a pipe holds, still queued when the workers finish
+    mocker.patch("src.run.retrieve_fastest_times", side_effect=chatty_retrieve)
+    make_location(tmp_path, "a", 1)
+    make_location(tmp_path, "b", 1)
+
+    results = run.run_batch(["a", "b"], make_args(tmp_path), report_interval=60)
+    assert [result["pages_done"] for result in results] == [20000, 20000]
+
+
+def dying_retrieve(segments, force_retrieve=False, progress=None, **kwargs):
+    if segments.filename.endswith(os.path.join("b", "segments.json")):
+        # As if killed for using too much memory
+        os._exit(1)
+    fake_retrieve(segments, progress=progress)
+
+
+def test_run_batch_reports_dead_worker(tmp_path, mocker):
+    mocker.patch("src.run.retrieve_fastest_times", side_effect=dying_retrieve)
+    for location in ["a", "b", "c"]:
+        make_location(tmp_path, location, 1)
+
+    results = run.run_batch(["a", "b", "c"], make_args(tmp_path), report_interval=60)
+    assert [result["status"] for result in results] == ["done", "failed: worker exited", "done"]
+
+
+def record_requests(limiter, slots, count):
+    for _ in range(count):
+        slots.put(limiter.wait("https://www.strava.com/segments/1"))
+
+
+def test_shared_rate_limiter_spaces_requests_across_processes():
+    limiter = SharedRateLimiter(requests_per_second=20)
+    slots = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=record_requests, args=(limiter, slots, 3))
+        for _ in range(2)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    # The slots handed out, rather than when each process woke, which
+    # depends on scheduling
+    requests = sorted(slots.get(timeout=5) for _ in range(6))
+    gaps = [later - earlier for earlier, later in zip(requests, requests[1:])]
+    assert min(gaps) >= 0.05 - 1e-6
+
+
+def test_refresh_location_profile(tmp_path, mocker):
+    mocker.patch("src.run.retrieve_fastest_times", side_effect=fake_retrieve)
+    make_location(tmp_path / "data", "oxford", 3)
+    profiles = tmp_path / "profiles"
+    args = make_args(tmp_path / "data", profile=True, profile_dir=str(profiles))
+
+    result = run.refresh_location("oxford", args, None)
+    assert result["status"] == "done"
+    assert os.path.dirname(result["profile"]) == str(profiles)
+    assert os.path.basename(result["profile"]).startswith("run-oxford-")
+    assert os.path.exists(result["profile"])
@@ -5,10 +5,18 @@ from stravalib.model import SegmentExplorerResult
 from stravalib.client import Client
 import pytest
 import src
+from src.crawl_state import CrawlState
+from src.details import DetailCache, DetailPipeline
+from src.jobs import Cancelled
+from src.quota import QuotaExhausted
+from src.regions import RegionsData
+from src.spatial import bounds_key
 from src.segment_crawler import (
+    parse_time,
     split_box,
     retrieve_fastest_times,
     SegmentCrawler,
+    SegmentsData,
 )
 
 LOGGER = logging.getLogger(__name__)
@@ -160,3 +168,279 @@ def test_not_explored(mock_stravalib, segments_db, regions_db):
 
     assert not is_explored
     assert len(segments_db.data) == 25
+
+
+def test_segment_index(segments_db):
+    segments_db.data = [{"id": 1, "name": "First"}, {"id": 1, "name": "Duplicate"}]
+    segments_db.add_segment({"id": 2, "name": "Second"})
+
+    assert segments_db.get_segment(1)["name"] == "First"
+    assert segments_db.segment_exists(2)
+    assert not segments_db.segment_exists(3)
+
+    segments_db.save()
+    reloaded = SegmentsData(segments_db.filename)
+    assert reloaded.get_segment(2) == {"id": 2, "name": "Second"}
+
+
+def test_upsert_segments(segments_db):
+    segments_db.add_segment({"id": 1, "name": "Old name", "effort_count": 5})
+    segments_db.upsert_segments(
+        [{"id": 1, "name": "New name"}, {"id": 2, "name": "Another"}]
+    )
+
+    assert len(segments_db.data) == 2
+    assert segments_db.get_segment(1) == {"id": 1, "name": "New name", "effort_count": 5}
+    assert segments_db.get_segment(2)["name"] == "Another"
+
+
+def test_retrieve_fastest_times_concurrent(mocker, segments_db):
+    """
+    Results should be applied to the right segments and saved periodically
+    """
+    def leader_for(segment_id, rate_limiter=None):
+        return f"Athlete {segment_id}", f"{segment_id}:00"
+
+    mocker.patch("src.segment_crawler.fetch_leader", side_effect=leader_for)
+    save = mocker.spy(segments_db, "save")
+    segments_db.data = [{"id": id, "name": f"Segment {id}"} for id in range(25)]
+
+    retrieve_fastest_times(segments_db, workers=4, save_interval=10)
+
+    assert save.call_count == 2
+    for segment in segments_db.data:
+        assert segment["fastest_athlete"] == f"Athlete {segment['id']}"
+        assert segment["fastest_time"] == f"{segment['id']}:00"
+
+
+def test_frontier_matches_recursive(mock_stravalib, tmp_path):
+    """
+    Both crawl engines should reach the same result, and agree on every region
+    they both visit. The recursive crawl stops visiting siblings once one is
+    unexplored, so the frontier crawl may visit more regions.
+    """
+    points = [(0.1 * i, 0.1 * i) for i in range(20)] + [(1.5, 0.5), (1.6, 0.4)]
+
+    def segments_for_region(bounds, activity_type):
+        (lat_min, lng_min), (lat_max, lng_max) = bounds
+        ids = [
+            id for id, (lat, lng) in enumerate(points)
+            if lat_min <= lat < lat_max and lng_min <= lng < lng_max
+        ]
+        return [SegmentExplorerResult(id=id) for id in ids[:10]]
+
+    mock_stravalib.patch(
+        "stravalib.client.Client.explore_segments", side_effect=segments_for_region
+    )
+
+    def crawl(method, max_zoom):
+        segments_file = tmp_path / f"segments_{method}.json"
+        regions_file = tmp_path / f"regions_{method}.json"
+        segments_file.write_text("[]")
+        regions_file.write_text("[]")
+        segments = SegmentsData(str(segments_file), Client())
+        regions = RegionsData(str(regions_file))
+        crawler = SegmentCrawler(Client(), segments, regions, max_zoom=max_zoom)
+        result = getattr(crawler, method)([(0, 0), (2, 2)])
+        visited = {bounds_key(r["bounds"]): r["explored"] for r in regions.data}
+        return result, visited, {seg["id"] for seg in segments.data}
+
+    for max_zoom, expected in [(1, False), (2, True)]:
+        frontier, frontier_regions, frontier_ids = crawl(
+            "retrieve_segments_frontier", max_zoom
+        )
+        recursive, recursive_regions, recursive_ids = crawl(
+            "retrieve_segments_recursively", max_zoom
+        )
+
+        assert frontier is recursive is expected
+        assert recursive_ids <= frontier_ids
+        for key, explored in recursive_regions.items():
+            assert frontier_regions[key] == explored
+
+
+@pytest.mark.parametrize("fail_method", ["explore_segments", "get_segment"])
+def test_frontier_resumes_after_interruption(mock_stravalib, tmp_path, fail_method):
+    """
+    A crawl interrupted by running out of quota should resume from its saved
+    state, making no API call twice and ending with the same data
+    """
+    points = [(0.1 * i, 0.1 * i) for i in range(20)] + [(1.5, 0.5), (1.6, 0.4)]
+    calls = {"explore_segments": 0, "get_segment": 0}
+    fail_at = {}
+
+    def count(method):
+        if calls[method] == fail_at.get(method):
+            fail_at.pop(method)
+            raise QuotaExhausted(60)
+        calls[method] += 1
+
+    def segments_for_region(bounds, activity_type):
+        count("explore_segments")
+        (lat_min, lng_min), (lat_max, lng_max) = bounds
+        ids = [
+            id for id, (lat, lng) in enumerate(points)
+            if lat_min <= lat < lat_max and lng_min <= lng < lng_max
+        ]
+        return [SegmentExplorerResult(id=id) for id in ids[:10]]
+
+    get_segment = Client.get_segment
+
+    def segment(id):
+        count("get_segment")
+        return get_segment(id)
+
+    mock_stravalib.patch(
+        "stravalib.client.Client.explore_segments", side_effect=segments_for_region
+    )
+    mock_stravalib.patch("stravalib.client.Client.get_segment", side_effect=segment)
+
+    def crawl(name):
+        segments_file = tmp_path / f"segments_{name}.json"
+        regions_file = tmp_path / f"regions_{name}.json"
+        state_file = str(tmp_path / f"crawl_state_{name}.json")
+        details_file = str(tmp_path / f"details_{name}.json")
+        segments_file.write_text("[]")
+        regions_file.write_text("[]")
+        while True:
+            details = DetailPipeline(Client(), DetailCache(details_file))
+            segments = SegmentsData(str(segments_file), Client(), details=details)
+            regions = RegionsData(str(regions_file))
+            crawler = SegmentCrawler(Client(), segments, regions, max_zoom=2)
+            try:
+                result = crawler.retrieve_segments_frontier(
+                    [(0, 0), (2, 2)], CrawlState.load(state_file)
+                )
+                break
+            except QuotaExhausted:
+                assert os.path.exists(state_file)
+            finally:
+                details.close()
+
+        assert not os.path.exists(state_file)
+        visited = {bounds_key(r["bounds"]): r["explored"] for r in regions.data}
+        return result, visited, sorted(seg["id"] for seg in segments.data)
+
+    expected = crawl("uninterrupted")
+    expected_calls = dict(calls)
+
+    calls.update({"explore_segments": 0, "get_segment": 0})
+    fail_at[fail_method] = 3
+    assert crawl("interrupted") == expected
+    assert calls == expected_calls
+
+
+def test_frontier_progress_and_cancel(mock_stravalib, segments_db, regions_db, tmp_path):
+    """Progress is reported per region, and raising from it stops the crawl"""
+    mock_stravalib.patch(
+        "stravalib.client.Client.explore_segments",
+        side_effect=lambda bounds, activity_type: [
+            SegmentExplorerResult(id=id) for id in range(10)
+        ],
+    )
+    reports = []
+
+    def progress(**increments):
+        reports.append(increments)
+        if len(reports) == 3:
+            raise Cancelled()
+
+    crawler = SegmentCrawler(
+        Client(), segments_db, regions_db, max_zoom=2, progress=progress
+    )
+    state = CrawlState(str(tmp_path / "crawl_state.json"))
+    with pytest.raises(Cancelled):
+        crawler.retrieve_segments_frontier([(0, 0), (2, 2)], state)
+
+    assert reports[:2] == [
+        {"regions_total": 1},
+        {"regions_total": 4},
+    ]
+    assert reports[2] == {"regions_done": 1, "regions_explored": 1, "segments_added": 10}
+    # Cancelling saved the crawl, to be resumed later
+    assert CrawlState.load(state.filename).frontier == [1, 2, 3, 4]
+
+
+def test_parse_time():
+    assert parse_time("4:05") == 245
+    assert parse_time("1:02:03") == 3723
+    assert parse_time("45s") == 45
+    with pytest.raises(Exception):
+        parse_time("unknown")
+
+
+def test_display_segments(segments_db):
+    segments_db.data = [
+        {"id": 1, "distance": 1000.0, "climb": 1.234, "fastest_time": "3:00"},
+        {"id": 2, "distance": 1000.0, "climb": 0.0, "fastest_seconds": 270},
+        {"id": 3, "distance": 1000.0, "climb": 0.0},
+    ]
+
+    displayed = segments_db.display_segments()
+
+    assert [seg["id"] for seg in displayed] == [2, 1, 3]
+    assert [seg["fastest_pace"] for seg in displayed[:2]] == [4.5, 3.0]
+    assert [seg["colour"] for seg in displayed] == ["#440154", "#5cc863", "#000000"]
+    assert displayed[1]["climb"] == 1.23
+    assert "colour" not in segments_db.data[0]
+
+    segments_db.data[2]["fastest_time"] = "5:00"
+    segments_db.touch(segments_db.data[2])
+    assert segments_db.display_segments()[0]["id"] == 3
+
+
+def test_query_segments(segments_db):
+    segments_db.data = [
+        # Route bounds come from the polyline, which goes outside start/end
+        {"id": 1, "distance": 1000.0, "climb": 0.0, "avg_grade": 1.0,
+         "fastest_seconds": 180, "start_latlng": [38.5, -120.2],
+         "end_latlng": [38.5, -120.2], "polyline": "_p~iF~ps|U_ulLnnqC_mqNvxq`@"},
+        {"id": 2, "distance": 2000.0, "climb": 0.0, "avg_grade": 5.0,
+         "fastest_seconds": 480, "start_latlng": [41.0, -121.0],
+         "end_latlng": [41.5, -121.5]},
+        {"id": 3, "distance": 500.0, "climb": 0.0, "avg_grade": 0.0,
+         "start_latlng": [10.0, 10.0], "end_latlng": [10.1, 10.1]},
+    ]
+
+    total, page = segments_db.query([(40.0, -122.0), (42.0, -120.0)])
+    assert total == 2
+    # Same order as display_segments: slowest pace first
+    assert [seg["id"] for seg in page] == [2, 1]
+    assert page[0]["fastest_pace"] == 4.0
+
+    assert segments_db.query([(43.0, -127.0), (44.0, -126.0)])[0] == 1
+    assert segments_db.query(None, {"avg_grade": (2.0, None)})[1][0]["id"] == 2
+    assert segments_db.query(None, {"fastest_pace": (None, 3.5)})[0] == 1
+    assert segments_db.query(None, offset=1, limit=1)[1][0]["id"] == 1
+
+    segments_db.add_segment(
+        {"id": 4, "distance": 100.0, "climb": 0.0, "start_latlng": [41.0, -121.0],
+         "end_latlng": [41.0, -121.0]}
+    )
+    assert segments_db.query([(40.0, -122.0), (42.0, -120.0)])[0] == 3
+
+
+def test_retrieve_fastest_times_budget(mock_stravalib, segments_db):
+    """
+    A budget should refresh the stalest segments, recording when, and their effort counts
+    """
+    def leader_for(segment_id, rate_limiter=None):
+        return f"Athlete {segment_id}", "3:00"
+
+    mock_stravalib.patch("src.segment_crawler.fetch_leader", side_effect=leader_for)
+    segments_db.data = [
+        {"id": 1, "name": "Fresh", "fastest_athlete": "A", "checked_at": 9000, "effort_count": 5},
+        {"id": 2, "name": "Stale", "fastest_athlete": "B", "checked_at": 1000, "effort_count": 5},
+        {"id": 3, "name": "New", "effort_count": 5},
+    ]
+
+    retrieve_fastest_times(segments_db, budget=2, refresh_stats=True, clock=lambda: 10000.0)
+
+    fresh, stale, new = segments_db.data
+    assert fresh["fastest_athlete"] == "A" and fresh["checked_at"] == 9000
+    assert stale["fastest_athlete"] == "Athlete 2"
+    assert new["fastest_athlete"] == "Athlete 3"
+    assert stale["checked_at"] == new["checked_at"] == 10000
+    # From the mocked get_segment
+    assert stale["effort_count"] == new["effort_count"] == 0
+    assert fresh["effort_count"] == 5
@@ -0,0 +1,83 @@
+import random
+from stravalib.client import Client
+from stravalib.model import SegmentExplorerResult
+from src.segment_crawler import SegmentCrawler
+from src.spatial import contains, normalise_bounds
+from src.splitting import MedianSplitter
+
+
+def area(box):
+    (lat_min, lng_min), (lat_max, lng_max) = normalise_bounds(box)
+    return (lat_max - lat_min) * (lng_max - lng_min)
+
+
+def add_points(segments_db, points):
+    segments_db.data = [
+        {"id": id, "start_latlng": list(point), "end_latlng": list(point)}
+        for id, point in enumerate(points)
+    ]
+
+
+def test_few_known_points_split_into_quadrants(segments_db):
+    add_points(segments_db, [(0.5, 0.5)] * 5)
+    splitter = MedianSplitter(segments_db)
+
+    assert splitter([(0, 0), (2, 2)]) == [
+        [(0.0, 0.0), (1.0, 1.0)],
+        [(0.0, 1.0), (1.0, 2.0)],
+        [(1.0, 1.0), (2.0, 2.0)],
+        [(1.0, 0.0), (2.0, 1.0)],
+    ]
+
+
+def test_median_split_covers_box(segments_db):
+    rng = random.Random(0)
+    # A dense cluster in one corner of a mostly empty box
+    points = [(rng.uniform(0, 0.2), rng.uniform(0, 0.2)) for _ in range(100)]
+    points += [(rng.uniform(0, 2), rng.uniform(0, 2)) for _ in range(10)]
+    add_points(segments_db, points)
+    splitter = MedianSplitter(segments_db, target=8, max_parts=64)
+
+    bounds = [(0, 0), (2, 2)]
+    boxes = splitter(bounds)
+
+    assert len(boxes) > 4
+    assert abs(sum(area(box) for box in boxes) - area(bounds)) < 1e-9
+    for box in boxes:
+        assert contains(normalise_bounds(bounds), normalise_bounds(box))
+        assert len(splitter.points(normalise_bounds(box))) < 8
+    # Most of the empty space is left in a few large boxes
+    assert max(area(box) for box in boxes) >= area(bounds) / 4
+
+
+def test_splitter_saves_explore_calls(mocker, regions_db, segments_db):
+    """Re-crawling with known segments takes fewer calls than quadrants"""
+    rng = random.Random(1)
+    points = [(rng.gauss(1, 0.1), rng.gauss(1, 0.1)) for _ in range(200)]
+    points = [(min(max(lat, 0), 1.99), min(max(lng, 0), 1.99)) for lat, lng in points]
+
+    def segments_for_region(bounds, activity_type):
+        (lat_min, lng_min), (lat_max, lng_max) = bounds
+        return [
+            SegmentExplorerResult(id=id)
+            for id, (lat, lng) in enumerate(points)
+            if lat_min <= lat < lat_max and lng_min <= lng < lng_max
+        ][:10]
+
+    mocker.patch(
+        "stravalib.client.Client.explore_segments", side_effect=segments_for_region
+    )
+
+    def crawl(splitter):
+        add_points(segments_db, points)
+        regions_db.data = []
+        crawler = SegmentCrawler(
+            Client(), segments_db, regions_db, max_zoom=12, splitter=splitter
+        )
+        assert crawler.retrieve_segments_frontier([(0, 0), (2, 2)])
+        return crawler.stats["explore_calls"]
+
+    quadtree_calls = crawl(None)
+    median_calls = crawl(MedianSplitter(segments_db))
+
+    assert median_calls < quadtree_calls
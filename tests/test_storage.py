@@ -0,0 +1,166 @@
+import json
+import os
+import pytest
+from src.migrate import export_location, import_location
+from src.regions import RegionsData
+from src.segment_crawler import SegmentsData, segment_bounds, segment_key
+from src.storage import JournalStore, SqliteStore, open_store
+
+
+def journal_lines(filename):
+    with open(filename + ".journal") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_journal_appends_only_changes(tmp_path):
+    filename = str(tmp_path / "segments.json")
+    with open(filename, "w") as f:
+        json.dump([{"id": 1, "name": "Existing"}], f)
+
+    segments = SegmentsData(filename, store=JournalStore(filename))
+    segments.add_segment({"id": 2, "name": "New"})
+    segments.save()
+    segments.get_segment(1)["fastest_time"] = "3:20"
+    segments.touch(segments.get_segment(1))
+    segments.save()
+
+    assert journal_lines(filename) == [
+        {"id": 2, "name": "New"},
+        {"id": 1, "name": "Existing", "fastest_time": "3:20"},
+    ]
+    with open(filename) as f:
+        assert json.load(f) == [{"id": 1, "name": "Existing"}]
+
+    reloaded = SegmentsData(filename, store=JournalStore(filename))
+    assert reloaded.data == [
+        {"id": 1, "name": "Existing", "fastest_time": "3:20"},
+        {"id": 2, "name": "New"},
+    ]
+
+
+def test_journal_compacts_on_close(tmp_path):
+    filename = str(tmp_path / "regions.json")
+    with open(filename, "w") as f:
+        json.dump([], f)
+
+    regions = RegionsData(filename, store=JournalStore(filename))
+    regions.set_explored([(0, 0), (1, 1)], True)
+    regions.close()
+
+    assert not os.path.exists(filename + ".journal")
+    assert RegionsData(filename).data == [
+        {"bounds": [[0, 0], [1, 1]], "explored": True}
+    ]
+
+
+def test_journal_compacts_at_threshold(tmp_path):
+    filename = str(tmp_path / "segments.json")
+    store = JournalStore(filename, compact_threshold=3)
+    with open(filename, "w") as f:
+        json.dump([], f)
+
+    segments = SegmentsData(filename, store=store)
+    for id in range(4):
+        segments.add_segment({"id": id})
+        segments.save()
+    store._wait_for_compaction()
+
+    with open(filename) as f:
+        assert [seg["id"] for seg in json.load(f)] == [0, 1, 2]
+    assert journal_lines(filename) == [{"id": 3}]
+    reloaded = SegmentsData(filename, store=JournalStore(filename))
+    assert [seg["id"] for seg in reloaded.data] == [0, 1, 2, 3]
+
+
+def test_sqlite_store_round_trip(tmp_path):
+    db_filename = str(tmp_path / "data.sqlite")
+    segments_json = str(tmp_path / "segments.json")
+
+    segments = SegmentsData(segments_json, store=SqliteStore(db_filename, "segments"))
+    segments.add_segment({"id": 1, "start_latlng": [0.0, 0.0], "end_latlng": [1.0, 1.0]})
+    segments.add_segment({"id": 2, "start_latlng": [5.0, 5.0], "end_latlng": [6.0, 5.5]})
+    segments.save()
+    segments.get_segment(1)["fastest_time"] = "3:20"
+    segments.touch(segments.get_segment(1))
+    segments.save()
+
+    reloaded = SegmentsData(segments_json, store=SqliteStore(db_filename, "segments"))
+    assert reloaded.data == [
+        {"id": 1, "start_latlng": [0.0, 0.0], "end_latlng": [1.0, 1.0], "fastest_time": "3:20"},
+        {"id": 2, "start_latlng": [5.0, 5.0], "end_latlng": [6.0, 5.5]},
+    ]
+    assert [seg["id"] for seg in reloaded.store.query_bbox([(0.5, 0.5), (2, 2)])] == [1]
+    assert [seg["id"] for seg in reloaded.store.query_bbox([(4, 4), (7, 7)])] == [2]
+
+
+def test_sqlite_store_save_before_load(tmp_path):
+    db_filename = str(tmp_path / "data.sqlite")
+    records = [{"id": 1, "start_latlng": [0.0, 0.0], "end_latlng": [1.0, 1.0]}]
+
+    with pytest.raises(ValueError):
+        SqliteStore(db_filename, "segments").save(records)
+
+    SqliteStore(db_filename, "segments", key=segment_key).save(records)
+    assert SqliteStore(db_filename, "segments").load(segment_key) == records
+
+
+def test_sqlite_store_removes_unbounded_records_from_index(tmp_path):
+    store = SqliteStore(str(tmp_path / "data.sqlite"), "segments", key=segment_key)
+    segment = {"id": 1, "start_latlng": [0.0, 0.0], "end_latlng": [1.0, 1.0]}
+    store.save([segment])
+    assert store.query_bbox([(0, 0), (1, 1)]) == [segment]
+
+    del segment["start_latlng"]
+    store.save([segment], [segment])
+    assert store.query_bbox([(0, 0), (1, 1)]) == []
+
+
+def test_sqlite_segments_query_without_loading(tmp_path, mocker):
+    db_filename = str(tmp_path / "data.sqlite")
+    segments_json = str(tmp_path / "segments.json")
+    records = [
+        # Route bounds come from the polyline, which goes outside start/end
+        {"id": 1, "distance": 1000.0, "climb": 0.0, "fastest_seconds": 180,
+         "start_latlng": [38.5, -120.2], "end_latlng": [38.5, -120.2],
+         "polyline": "_p~iF~ps|U_ulLnnqC_mqNvxq`@"},
+        {"id": 2, "distance": 2000.0, "climb": 0.0, "fastest_seconds": 480,
+         "start_latlng": [41.0, -121.0], "end_latlng": [41.5, -121.5]},
+        {"id": 3, "distance": 500.0, "climb": 0.0,
+         "start_latlng": [10.0, 10.0], "end_latlng": [10.1, 10.1]},
+    ]
+    SqliteStore(db_filename, "segments", segment_key, segment_bounds).save(records)
+
+    store = SqliteStore(db_filename, "segments", bounds=segment_bounds)
+    load = mocker.spy(store, "load")
+    segments = SegmentsData(segments_json, store=store)
+    bounds = [(40.0, -122.0), (42.0, -120.0)]
+    total, page = segments.query(bounds, {"fastest_pace": (None, 5.0)})
+    assert not segments.loaded and load.call_count == 0
+
+    loaded = SegmentsData(segments_json, store=SqliteStore(db_filename, "segments"))
+    assert len(loaded.data) == 3
+    assert (total, page) == loaded.query(bounds, {"fastest_pace": (None, 5.0)})
+    assert [seg["id"] for seg in page] == [2, 1]
+
+    # Changes need every segment
+    segments.update(segments.get_segment(3), fastest_seconds=100)
+    assert segments.loaded and load.call_count == 1
+    segments.save()
+    assert segments.query([(9, 9), (11, 11)])[1][0]["fastest_seconds"] == 100
+
+
+def test_import_export(tmp_path):
+    with open(tmp_path / "segments.json", "w") as f:
+        json.dump([{"id": 1, "name": "Segment"}], f)
+    with open(tmp_path / "regions.json", "w") as f:
+        json.dump([{"bounds": [[0, 0], [1, 1]], "explored": True}], f)
+
+    import_location(str(tmp_path))
+    os.remove(tmp_path / "segments.json")
+    regions = RegionsData(
+        str(tmp_path / "regions.json"), store=open_store(str(tmp_path / "regions.json"))
+    )
+    assert regions.is_explored([(0, 0), (0.5, 0.5)])
+
+    export_location(str(tmp_path))
+    assert SegmentsData(str(tmp_path / "segments.json")).data == [{"id": 1, "name": "Segment"}]
@@ -0,0 +1,36 @@
+from urllib.error import HTTPError
+import pytest
+from src.throttle import HostRateLimiter, with_retries
+
+
+def test_with_retries_succeeds_after_failures():
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ConnectionError("Connection reset")
+        return "ok"
+
+    assert with_retries(flaky, retries=3, backoff=0) == "ok"
+    assert len(calls) == 3
+
+
+def test_with_retries_gives_up():
+    def not_found():
+        raise HTTPError("https://www.strava.com/segments/1", 404, "Not found", {}, None)
+
+    with pytest.raises(HTTPError):
+        with_retries(not_found, retries=3, backoff=0, should_retry=lambda e: e.code >= 500)
+
+
+def test_rate_limiter_spaces_requests_per_host(mocker):
+    sleep = mocker.patch("src.throttle.time.sleep")
+    mocker.patch("src.throttle.time.monotonic", return_value=100.0)
+    limiter = HostRateLimiter(requests_per_second=2)
+
+    limiter.wait("https://www.strava.com/segments/1")
+    limiter.wait("https://www.strava.com/segments/2")
+    limiter.wait("https://example.com/")
+
+    sleep.assert_called_once_with(0.5)
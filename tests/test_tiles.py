@@ -0,0 +1,96 @@
+import gzip
+import json
+import os
+import pytest
+from src.polyline import decode, encode
+from src.tiles import export_tiles, tile_bounds, tile_xy, tiles_covering
+
+
+def test_tile_xy():
+    # Oxford, checked against openstreetmap.org
+    assert tile_xy(51.75, -1.25, 14) == (8135, 5430)
+    assert tile_xy(0, 0, 0) == (0, 0)
+    assert tile_xy(90, 180, 2) == (3, 0)
+
+    (lat_min, lng_min), (lat_max, lng_max) = tile_bounds(8135, 5430, 14)
+    assert lat_min < 51.75 < lat_max and lng_min < -1.25 < lng_max
+    assert tile_xy(lat_min + 1e-9, lng_min + 1e-9, 14) == (8135, 5430)
+
+
+def test_tiles_covering():
+    bounds = tile_bounds(10, 20, 6)
+    inside = [
+        (bounds[0][0] + 0.1, bounds[0][1] + 0.1),
+        (bounds[1][0] - 0.1, bounds[1][1] - 0.1),
+    ]
+    assert tiles_covering(inside, 6) == [(10, 20)]
+    assert len(tiles_covering(inside, 8)) == 16
+
+
+def route(lat, lng, points=200):
+    return [(lat + i * 1e-4, lng + (i % 7) * 2e-5) for i in range(points)]
+
+
+@pytest.fixture
+def tiled_segments(segments_db):
+    segments_db.data = [
+        {
+            "id": 1,
+            "name": "Hill",
+            "distance": 1000.0,
+            "avg_grade": 5.0,
+            "climb": 50.0,
+            "start_latlng": [51.75, -1.25],
+            "end_latlng": [51.77, -1.25],
+            "polyline": encode(route(51.75, -1.25)),
+            "fastest_athlete": "A",
+            "fastest_time": "3:00",
+        },
+        {
+            "id": 2,
+            "name": "Unretrieved",
+            "distance": 500.0,
+            "avg_grade": 0.0,
+            "climb": 0.0,
+            "start_latlng": [51.70, -1.30],
+            "end_latlng": [51.70, -1.29],
+            "polyline": None,
+        },
+    ]
+    return segments_db
+
+
+def test_export_tiles(tiled_segments, tmp_path):
+    directory = str(tmp_path / "tiles")
+    manifest = export_tiles(tiled_segments, directory, min_zoom=10, max_zoom=16, encodings=["gzip"])
+
+    with open(os.path.join(directory, "manifest.json")) as f:
+        assert json.load(f) == manifest
+    assert manifest["segments"] == 2
+    assert manifest["encodings"] == ["gzip"]
+
+    found = {}
+    for zoom in range(10, 17):
+        for x, y in manifest["tiles"][str(zoom)]:
+            filename = os.path.join(directory, str(zoom), str(x), f"{y}.json")
+            with open(filename, "rb") as f:
+                body = f.read()
+            with open(filename + ".gz", "rb") as f:
+                assert gzip.decompress(f.read()) == body
+            for segment in json.loads(body):
+                found.setdefault(zoom, {})[segment["id"]] = segment
+
+    # Every segment is in some tile at every zoom
+    assert all(set(segments) == {1, 2} for segments in found.values())
+    hill, unretrieved = found[16][1], found[16][2]
+    assert hill["fastest_pace"] == 3.0
+    assert hill["colour"].startswith("#")
+    assert unretrieved["fastest_pace"] is None
+    # Simplified when zoomed out
+    assert len(decode(found[10][1]["polyline"])) < len(decode(hill["polyline"])) == 200
+
+    # Exporting again replaces the tiles
+    export_tiles(tiled_segments, directory, min_zoom=12, max_zoom=12, encodings=[])
+    assert sorted(os.listdir(directory)) == ["12", "manifest.json"]
+    assert not os.path.exists(directory + ".old")
+    assert not os.path.exists(directory + ".tmp")